@@ -0,0 +1,300 @@
+# Admission control for the routes that cost database time.
+#
+# Each limited endpoint belongs to a priority class (ROUTE_CLASSES). A
+# request is admitted only if:
+#
+#   1. its user and its client IP both have a token left in the class's
+#      token buckets (otherwise 429). Buckets refill at ADMISSION_<CLASS>_RATE
+#      tokens a second up to ADMISSION_<CLASS>_BURST; the per-IP buckets are
+#      ADMISSION_IP_FACTOR times larger, since several users can share an IP.
+#      With the sqlite backend the buckets live in one file shared by every
+#      worker process on the host, so the limits hold however requests are
+#      spread across workers.
+#   2. the process isn't already running its class's share of DB_POOL_SIZE
+#      requests (ADMISSION_<CLASS>_SHARE), and, for classes that don't get
+#      to wait, the connection pool isn't exhausted (otherwise 503).
+#
+# Checkout gets its own buckets, may use the whole pool and waits for a
+# connection; search may use half the pool and is turned away as soon as
+# the pool runs dry, so a burst of searches can't starve payments. Requests
+# that still time out waiting for a connection get a 503 from app.py.
+#
+# If the bucket store fails, requests are let through rather than refused.
+import logging
+import math
+import os
+import sqlite3
+import threading
+import time
+
+from flask import Response, g, request, session
+
+from db_connection import get_pool
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    'ADMISSION_ENABLED': '1',
+    'ADMISSION_BACKEND': 'sqlite',          # sqlite (shared by processes) or memory
+    'ADMISSION_SQLITE_PATH': None,          # default: <instance path>/admission.sqlite3
+    'ADMISSION_SEARCH_RATE': 2.0,           # tokens per second, per user
+    'ADMISSION_SEARCH_BURST': 20,
+    'ADMISSION_SEARCH_SHARE': 0.5,          # of DB_POOL_SIZE, per process
+    'ADMISSION_CHECKOUT_RATE': 0.5,
+    'ADMISSION_CHECKOUT_BURST': 10,
+    'ADMISSION_CHECKOUT_SHARE': 1.0,
+    'ADMISSION_IP_FACTOR': 5.0,
+    'ADMISSION_SWEEP_INTERVAL': 60.0,
+}
+
+# (endpoint, method) -> priority class
+ROUTE_CLASSES = {
+    ('search_flights', 'POST'): 'search',
+    ('flight_selection', 'GET'): 'search',
+    ('payment', 'GET'): 'checkout',
+    ('payment', 'POST'): 'checkout',
+    ('book_flight', 'POST'): 'checkout',
+}
+
+# Classes that queue for a connection when the pool is exhausted rather than being shed.
+WAITING_CLASSES = ('checkout',)
+
+
+def _spend(limits, buckets, now):
+    # Refills each bucket for the time since it was last touched and takes a
+    # token from all of them if every one has a token. buckets maps key ->
+    # (tokens, updated at); missing buckets start full. Returns the new token
+    # counts and 0, or the unchanged counts and the seconds until the
+    # emptiest bucket has a token again.
+    tokens = []
+    for key, rate, burst in limits:
+        left, updated_at = buckets.get(key, (burst, now))
+        tokens.append(min(burst, left + (now - updated_at) * rate))
+    wait = max((1 - left) / limit[1] for limit, left in zip(limits, tokens))
+    if wait > 0:
+        return tokens, wait
+    return [left - 1 for left in tokens], 0
+
+
+class MemoryBuckets:
+    # Token buckets for a single process.
+
+    def __init__(self):
+        self._buckets = {}  # key -> (tokens, updated at)
+        self._lock = threading.Lock()
+
+    def take(self, limits, now=None):
+        # limits: [(key, rate, burst)]. Takes a token from every bucket, or
+        # from none of them; returns 0 if it did, or else the seconds until
+        # the emptiest bucket has a token again.
+        now = time.time() if now is None else now
+        with self._lock:
+            tokens, wait = _spend(limits, self._buckets, now)
+            for limit, left in zip(limits, tokens):
+                self._buckets[limit[0]] = (left, now)
+        return wait
+
+    def sweep(self, max_idle, now=None):
+        now = time.time() if now is None else now
+        with self._lock:
+            stale = [key for key, (_, updated_at) in self._buckets.items() if now - updated_at > max_idle]
+            for key in stale:
+                del self._buckets[key]
+        return len(stale)
+
+    def stats(self):
+        return {'buckets': len(self._buckets)}
+
+
+class SQLiteBuckets:
+    # Token buckets in a SQLite file, shared by every process that opens it.
+    SCHEMA = [
+        """
+        CREATE TABLE IF NOT EXISTS buckets (
+            key TEXT PRIMARY KEY,
+            tokens REAL NOT NULL,
+            updated_at REAL NOT NULL
+        ) WITHOUT ROWID
+        """,
+    ]
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        connection = self._connection()
+        for statement in self.SCHEMA:
+            connection.execute(statement)
+
+    def _connection(self):
+        # One connection per thread, reopened after a fork.
+        connection = getattr(self._local, 'connection', None)
+        if connection is None or self._local.pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=1.0, isolation_level=None)
+            connection.execute("PRAGMA journal_mode = WAL")
+            connection.execute("PRAGMA synchronous = NORMAL")
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    def take(self, limits, now=None):
+        # Same contract as MemoryBuckets.take. BEGIN IMMEDIATE takes the write
+        # lock up front, so concurrent processes can't both spend the last token.
+        now = time.time() if now is None else now
+        keys = [limit[0] for limit in limits]
+        connection = self._connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            rows = {row[0]: row[1:] for row in connection.execute(
+                f"SELECT key, tokens, updated_at FROM buckets WHERE key IN ({', '.join(['?'] * len(keys))})", keys
+            )}
+            tokens, wait = _spend(limits, rows, now)
+            connection.executemany(
+                "INSERT OR REPLACE INTO buckets (key, tokens, updated_at) VALUES (?, ?, ?)",
+                [(key, left, now) for key, left in zip(keys, tokens)]
+            )
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        return wait
+
+    def sweep(self, max_idle, now=None):
+        now = time.time() if now is None else now
+        cursor = self._connection().execute("DELETE FROM buckets WHERE updated_at < ?", (now - max_idle,))
+        return cursor.rowcount
+
+    def stats(self):
+        return {'buckets': self._connection().execute("SELECT COUNT(*) FROM buckets").fetchone()[0]}
+
+
+class AdmissionController:
+    def __init__(self, buckets=None, limits=None, shares=None, ip_factor=5.0, sweep_interval=60.0, pool=get_pool):
+        self.buckets = buckets
+        self.limits = limits or {}    # class -> (rate, burst)
+        self.shares = shares or {}    # class -> fraction of the pool
+        self.ip_factor = ip_factor
+        self.sweep_interval = sweep_interval
+        self.pool = pool
+        self._in_flight = {}
+        self._lock = threading.Lock()
+        self._swept_at = time.monotonic()
+        self._counts = {}             # (class, outcome) -> requests
+
+    def _count(self, priority, outcome):
+        with self._lock:
+            self._counts[(priority, outcome)] = self._counts.get((priority, outcome), 0) + 1
+
+    def check_rate(self, priority, user, ip):
+        # Seconds to wait before retrying, or 0 if a token was taken.
+        rate, burst = self.limits[priority]
+        limits = [(f'{priority}:ip:{ip}', rate * self.ip_factor, burst * self.ip_factor)]
+        if user:
+            limits.append((f'{priority}:user:{user}', rate, burst))
+        try:
+            return self.buckets.take(limits)
+        except Exception:
+            logger.exception("Rate limit store failed; admitting request")
+            return 0
+
+    def enter(self, priority):
+        # Claims one of the class's slots; False if the request should be shed.
+        pool = self.pool()
+        stats = pool.stats()
+        if priority not in WAITING_CLASSES and stats['idle'] == 0 and stats['open'] >= stats['size']:
+            return False
+        cap = max(1, math.floor(pool.size * self.shares.get(priority, 1.0)))
+        with self._lock:
+            if self._in_flight.get(priority, 0) >= cap:
+                return False
+            self._in_flight[priority] = self._in_flight.get(priority, 0) + 1
+        return True
+
+    def leave(self, priority):
+        with self._lock:
+            self._in_flight[priority] -= 1
+
+    def admit(self, priority, user, ip):
+        # None if the request may go ahead (and must call leave()), or else
+        # the response to send instead.
+        self._maybe_sweep()
+        wait = self.check_rate(priority, user, ip)
+        if wait > 0:
+            self._count(priority, 'limited')
+            return _refusal(429, 'Too many requests, please slow down.', wait)
+        if not self.enter(priority):
+            self._count(priority, 'shed')
+            return _refusal(503, 'The server is busy, please try again in a moment.', 1)
+        self._count(priority, 'admitted')
+        return None
+
+    def _maybe_sweep(self):
+        # Buckets idle long enough to have refilled completely are dropped.
+        if time.monotonic() - self._swept_at < self.sweep_interval:
+            return
+        self._swept_at = time.monotonic()
+        longest = max((burst / rate for rate, burst in self.limits.values()), default=0)
+        try:
+            self.buckets.sweep(longest)
+        except Exception:
+            logger.exception("Rate limit sweep failed")
+
+    def stats(self):
+        with self._lock:
+            stats = {f'{priority}_{outcome}': count for (priority, outcome), count in self._counts.items()}
+            stats.update({f'{priority}_in_flight': count for priority, count in self._in_flight.items()})
+        if self.buckets is not None:
+            stats.update(self.buckets.stats())
+        return stats
+
+
+def _refusal(status, message, retry_after):
+    return Response(message, status=status, mimetype='text/plain',
+                    headers={'Retry-After': str(max(1, math.ceil(retry_after)))})
+
+
+def _before_request():
+    priority = ROUTE_CLASSES.get((request.endpoint, request.method))
+    if priority is None:
+        return None
+    refusal = admission.admit(priority, session.get('username'), request.remote_addr)
+    if refusal is None:
+        g._admission_class = priority
+    return refusal
+
+
+def _teardown_request(exc=None):
+    priority = g.pop('_admission_class', None)
+    if priority is not None:
+        admission.leave(priority)
+
+
+def init_app(app):
+    settings = {key: app.config.get(key, os.environ.get(key, default)) for key, default in DEFAULTS.items()}
+    if str(settings['ADMISSION_ENABLED']).lower() in ('0', 'false', 'no', ''):
+        return None
+    if settings['ADMISSION_BACKEND'] == 'memory':
+        buckets = MemoryBuckets()
+    elif settings['ADMISSION_BACKEND'] == 'sqlite':
+        buckets = SQLiteBuckets(settings['ADMISSION_SQLITE_PATH'] or os.path.join(app.instance_path, 'admission.sqlite3'))
+    else:
+        raise ValueError(f"Unknown ADMISSION_BACKEND {settings['ADMISSION_BACKEND']!r}")
+
+    classes = {priority for priority in ROUTE_CLASSES.values()}
+    admission.buckets = buckets
+    admission.limits = {
+        priority: (float(settings[f'ADMISSION_{priority.upper()}_RATE']), float(settings[f'ADMISSION_{priority.upper()}_BURST']))
+        for priority in classes
+    }
+    admission.shares = {priority: float(settings[f'ADMISSION_{priority.upper()}_SHARE']) for priority in classes}
+    admission.ip_factor = float(settings['ADMISSION_IP_FACTOR'])
+    admission.sweep_interval = float(settings['ADMISSION_SWEEP_INTERVAL'])
+    app.before_request(_before_request)
+    app.teardown_request(_teardown_request)
+    return admission
+
+
+# Shared by every request in this process; the sqlite buckets are shared across processes.
+admission = AdmissionController()
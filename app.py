@@ -1,31 +1,102 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, session, g # type: ignore
+from flask import Flask, render_template, request, redirect, url_for, flash, session, g, jsonify, Response, stream_with_context # type: ignore
 from functools import wraps
-from db_connection import get_db_connection
-from collections import defaultdict
+from werkzeug.middleware.proxy_fix import ProxyFix # type: ignore
+import os
+import secrets
+import sys
+import time
+import click # type: ignore
+import mysql.connector # type: ignore
+from db_connection import get_db_connection, get_pool, PoolTimeout, init_app as init_db
+from read_replicas import get_read_connection, stick_to_primary, replica_stats, init_app as init_read_replicas
+from flight_index import flight_index, init_app as init_flight_index
+import booking_service
+import pricing
+from notification_queue import notification_queue, init_app as init_notification_queue
+import notification_store
+import auth
+import loyalty
+from render_cache import cached_page, cached_render_lazy, render_cache
+from instrumentation import init_app as init_instrumentation
+import seat_inventory
+import route_search
+import schedule_io
+import history
+import migrations
+import refund_jobs
+import session_store
+import ticket_store
+import ratings
+import admission
 
 app = Flask(__name__)
-app.secret_key = 'your_secret_key'  # Needed for session management and flash messages
-
-# Global flag to clear session on app start
-session_cleared = False
+# Signs the session id cookie; must be the same in every worker process
+app.secret_key = os.environ.get('SECRET_KEY')
+if not app.secret_key:
+    app.logger.warning("SECRET_KEY is not set; using a random key, so sessions won't survive a restart")
+    app.secret_key = secrets.token_hex(32)
+
+# Sessions are stored server side (SESSION_BACKEND: sqlite or memory)
+session_store.init_app(app)
+
+# Pooled database connections; DB_* settings come from the environment or app.config
+init_db(app)
+# Optional read replicas (DB_REPLICAS) for read-only routes
+init_read_replicas(app)
+# In-memory flight search index, refreshed incrementally from the flights table
+init_flight_index(app)
+# Notifications are written in the background from a spooled queue
+init_notification_queue(app)
+# Refund requests are queued and applied in batches by worker threads
+refund_jobs.init_app(app)
+# Fare tables and quote cache TTLs
+pricing.init_app(app)
+# Rendered tickets are kept on disk (TICKET_CACHE_DIR)
+ticket_store.init_app(app)
+# Route latency and SQL timing, exported on /metrics (local requests only)
+init_instrumentation(app, gauges={
+    'db_pool': lambda: get_pool().stats(),
+    'db_replicas': replica_stats,
+    'render_cache': render_cache.stats,
+    'notification_queue': notification_queue.stats,
+    'refund_jobs': refund_jobs.refund_processor.stats,
+    'fare_table': pricing.fare_table.stats,
+    'quote_cache': pricing.quote_cache.stats,
+    'auth_token_cache': lambda: {'hits': auth.token_cache.hits, 'misses': auth.token_cache.misses},
+    'sessions': app.session_interface.stats,
+    'tickets': ticket_store.ticket_store.stats,
+    'admission': admission.admission.stats,
+})
+# Behind a reverse proxy or load balancer, take the client address (used by
+# the per-IP rate limits) from X-Forwarded-For; TRUSTED_PROXY_COUNT is how
+# many proxies in front of the app append to it. Leave it at 0 otherwise,
+# or clients could pick their own address.
+trusted_proxies = int(app.config.get('TRUSTED_PROXY_COUNT', os.environ.get('TRUSTED_PROXY_COUNT', 0)))
+if trusted_proxies:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=trusted_proxies, x_proto=trusted_proxies)
+# Per-user and per-IP rate limits and load shedding for search and checkout
+admission.init_app(app)
+
+# Requests that waited the full DB_POOL_TIMEOUT for a connection are turned away
+@app.errorhandler(PoolTimeout)
+def pool_timeout(e):
+    return Response('The server is busy, please try again in a moment.', status=503, mimetype='text/plain', headers={'Retry-After': '1'})
 
 def login_required(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
-        if 'username' not in session:
+        # The session token is checked against a small in-process cache first,
+        # so this normally doesn't touch the database
+        if 'username' not in session or auth.session_username(session.get('auth_token')) != session['username']:
+            session.clear()
             return redirect(url_for('login'))
         return f(*args, **kwargs)
     return decorated_function
 
 @app.before_request
 def before_request():
-    global session_cleared
     g.user = None
 
-    if not session_cleared:
-        session.clear()
-        session_cleared = True
-
     if 'username' in session:
         g.user = session['username']
 
@@ -45,15 +116,43 @@ def login():
         connection = get_db_connection()
         cursor = connection.cursor()
 
-        # Check if the username and password match
-        cursor.execute("SELECT * FROM users WHERE username = %s AND password = %s", (username, password))
+        # Failed attempts are counted in the database, shared by every worker
+        if auth.is_locked_out(cursor, username):
+            cursor.close()
+            connection.close()
+            flash('Too many failed login attempts. Please try again later.', 'danger')
+            return render_template('login.html')
+
+        # Fetch the stored password hash and check it off the request thread
+        cursor.execute("SELECT password FROM users WHERE username = %s", (username,))
         user = cursor.fetchone()
 
+        try:
+            valid, needs_rehash = auth.verify_password(password, user[0] if user else None)
+            if valid and needs_rehash:
+                # Upgrade plaintext or old-cost hashes now that we know the password
+                cursor.execute("UPDATE users SET password = %s WHERE username = %s", (auth.hash_password(password), username))
+        except auth.AuthBusy:
+            cursor.close()
+            connection.close()
+            flash('The server is busy, please try again in a moment.', 'danger')
+            return render_template('login.html')
+
+        if valid:
+            auth.clear_failures(cursor, username)
+            token = auth.create_session(cursor, username)
+        else:
+            auth.record_failure(cursor, username)
+        connection.commit()
+
         cursor.close()
         connection.close()
 
-        if user:
+        if valid:
+            # New session id on login, so an id set before login can't be reused
+            session.regenerate()
             session['username'] = username
+            session['auth_token'] = token
             flash('Login successful!', 'success')
             return redirect(url_for('home'))
         else:
@@ -78,8 +177,13 @@ def signup():
         if existing_user:
             flash('Username already exists', 'danger')
         else:
-            # Insert the new user into the database
-            cursor.execute("INSERT INTO users (username, password) VALUES (%s, %s)", (username, password))
+            # Insert the new user into the database with a hashed password
+            try:
+                password_hash = auth.hash_password(password)
+            except auth.AuthBusy:
+                flash('The server is busy, please try again in a moment.', 'danger')
+                return render_template('signup.html')
+            cursor.execute("INSERT INTO users (username, password) VALUES (%s, %s)", (username, password_hash))
             connection.commit()
             flash('Signup successful! Please log in.', 'success')
             return redirect(url_for('login'))
@@ -92,6 +196,7 @@ def signup():
 # Route for the homepage
 @app.route('/home')
 @login_required
+@cached_page
 def home():
     return render_template('homepage.html')
 
@@ -104,18 +209,8 @@ def search_flights():
         destination = request.form.get('destination')
         departure_date = request.form.get('departure_date')
 
-        connection = get_db_connection()
-        cursor = connection.cursor(dictionary=True)  # Use dictionary=True for easier access to column names
-
-        # Query flights from the database
-        cursor.execute(
-            "SELECT * FROM flights WHERE source = %s AND destination = %s AND departure_date = %s",
-            (source, destination, departure_date)
-        )
-        filtered_flights = cursor.fetchall()
-
-        cursor.close()
-        connection.close()
+        # Look the flights up in the in-memory index instead of querying MySQL
+        filtered_flights = flight_index.search(source, destination, departure_date) if departure_date else []
 
         if not filtered_flights:
             flash('No flights available', 'danger')
@@ -131,44 +226,59 @@ def flight_selection():
     origin = request.args.get('origin')
     destination = request.args.get('destination')
 
-    # Optional parameters (not used for filtering)
+    # Optional parameters
     trip_type = request.args.get('tripType')
-    departure_date = request.args.get('departureDate')
-    return_date = request.args.get('returnDate')
+    # Dates that don't parse are treated as not given
+    departure_date = route_search.parse_date(request.args.get('departureDate'))
+    return_date = route_search.parse_date(request.args.get('returnDate'))
     passengers = request.args.get('passengers')
     class_type = request.args.get('classType')
+    if trip_type != 'round-trip':
+        return_date = None
+
+    # The rendered page is cached per search, flight index version, fare
+    # table revision and ratings epoch; the key is built first so a hit
+    # skips the searches, pricing and ratings lookup as well as the render.
+    cache_key = (
+        'flight-selection',
+        flight_index.current_version(),
+        pricing.fare_table.current_revision(),
+        ratings.cache_epoch(),
+        tuple(sorted(request.args.items(multi=True))),
+    )
 
-    connection = get_db_connection()
-    cursor = connection.cursor(dictionary=True)
-
-    # Query flights from the database based on origin and destination
-    query = """
-        SELECT * FROM flights
-        WHERE source = %s AND destination = %s
-    """
-    cursor.execute(query, (origin, destination))
-    filtered_flights = cursor.fetchall()
-
-    cursor.close()
-    connection.close()
+    def page_context():
+        # Direct flights for the route (on the chosen day, if any), already
+        # grouped by flight_number in the index, priced for the class and party size
+        fare_class = pricing.fare_class(class_type)
+        party = pricing.passenger_count(passengers)
+        flights_by_number = pricing.price_flights(flight_index.grouped(origin, destination, departure_date), fare_class, party)
+
+        # Direct and connecting itineraries, or outbound/return pairs for round trips
+        itineraries = route_search.search_itineraries(origin, destination, departure_date, return_date)
+        itineraries = pricing.price_itineraries(itineraries, fare_class, party)
+
+        # Average ratings for every flight number shown, and for the route, in one lookup
+        flight_ratings, route_ratings = ratings.lookup(get_read_connection, flights_by_number, [(origin, destination)])
+        for number, flights in flights_by_number.items():
+            for flight in flights:
+                flight['rating'] = flight_ratings[number]
+
+        # Pass the filtered flights and optional parameters to the template
+        return dict(
+            flights_by_number=flights_by_number,
+            itineraries=itineraries,
+            route_rating=route_ratings[(origin, destination)],
+            origin=origin,
+            destination=destination,
+            trip_type=trip_type,
+            departure_date=departure_date,
+            return_date=return_date,
+            passengers=passengers,
+            class_type=class_type
+        )
 
-    # Group flights by flight_number
-    flights_by_number = defaultdict(list)
-    for flight in filtered_flights:
-        flights_by_number[flight['flight_number']].append(flight)
-
-    # Pass the filtered flights and optional parameters to the template
-    return render_template(
-        'flight-selection.html',
-        flights_by_number=flights_by_number,
-        origin=origin,
-        destination=destination,
-        trip_type=trip_type,
-        departure_date=departure_date,
-        return_date=return_date,
-        passengers=passengers,
-        class_type=class_type
-    )
+    return cached_render_lazy(cache_key, 'flight-selection.html', page_context)
 
 # Route for booking a flight
 @app.route('/book/<int:flight_id>', methods=['POST'])
@@ -176,26 +286,14 @@ def flight_selection():
 def book_flight(flight_id):
     passenger_name = request.form.get('passenger_name')
 
+    # Booking and its notification go in as one transaction
     connection = get_db_connection()
-    cursor = connection.cursor()
-
-    # Insert booking into the database
-    cursor.execute(
-        "INSERT INTO bookings (flight_id, username, passenger_name, booking_date) VALUES (%s, %s, %s, NOW())",
-        (flight_id, session['username'], passenger_name)
-    )
-    connection.commit()
-
-    # Send a notification to the user
-    cursor.execute(
-        "INSERT INTO notifications (username, message) VALUES (%s, %s)",
-        (session['username'], f"Your flight with ID {flight_id} has been successfully booked.")
-    )
-    connection.commit()
-
-    cursor.close()
+    booking_service.book(connection, session['username'], flight_id, passenger_name)
     connection.close()
 
+    flight_index.invalidate(flight_id)
+    stick_to_primary()
+
     flash('Flight booked successfully!', 'success')
     return redirect(url_for('bookings'))
 
@@ -203,7 +301,7 @@ def book_flight(flight_id):
 @app.route('/payment', methods=['GET', 'POST'])
 @login_required
 def payment():
-    MINIMUM_POINTS_FOR_REDEMPTION = 50  # Minimum points required to redeem
+    MINIMUM_POINTS_FOR_REDEMPTION = booking_service.MINIMUM_POINTS_FOR_REDEMPTION
 
     flight_id = request.args.get('flight_id')
     if flight_id is None:
@@ -223,13 +321,11 @@ def payment():
         flash('Flight not found.', 'danger')
         return redirect(url_for('home'))
 
-    # Fetch user's loyalty points
-    cursor.execute("""
-        SELECT points, total_points_left FROM loyalty_points
-        WHERE user_id = (SELECT id FROM users WHERE username = %s)
-    """, (session['username'],))
-    loyalty_points = cursor.fetchone()
-    available_points = loyalty_points['total_points_left'] if loyalty_points else 0
+    # Fetch user's loyalty points (cached per user, cleared on checkout)
+    available_points = loyalty.balance(cursor, session['username'])
+
+    # Fare for the class and party size chosen on the search form
+    quote = pricing.quote(flight, request.args.get('classType'), request.args.get('passengers'))
 
     if request.method == 'POST':
         passenger_name = request.form.get('passenger_name')
@@ -238,193 +334,142 @@ def payment():
 
         if not passenger_name:
             flash('Passenger name is required.', 'danger')
-            return redirect(url_for('payment', flight_id=flight_id))
+            return redirect(url_for('payment', flight_id=flight_id, classType=quote['class_type'], passengers=quote['passengers']))
 
         # Check if the user has enough points to redeem
         if points_to_redeem > available_points:
             flash('You do not have enough loyalty points to redeem.', 'danger')
-            return redirect(url_for('payment', flight_id=flight_id))
+            return redirect(url_for('payment', flight_id=flight_id, classType=quote['class_type'], passengers=quote['passengers']))
 
         # Check if the points to redeem meet the minimum threshold
         if points_to_redeem > 0 and points_to_redeem < MINIMUM_POINTS_FOR_REDEMPTION:
             flash(f'You must redeem at least {MINIMUM_POINTS_FOR_REDEMPTION} points.', 'danger')
-            return redirect(url_for('payment', flight_id=flight_id))
-
-        # Calculate discount and final price
-        discount = points_to_redeem * 0.1  # Example: 1 point = $0.10
-        final_price = max(0, float(flight['price']) - discount)
-
-        # Calculate loyalty points earned (e.g., 1 point per $10 spent)
-        loyalty_points_earned = int(final_price // 10)
+            return redirect(url_for('payment', flight_id=flight_id, classType=quote['class_type'], passengers=quote['passengers']))
 
         try:
-            # Insert booking into the database
-            cursor.execute(
-                """
-                INSERT INTO bookings (flight_id, username, passenger_name, booking_date, payment_status, final_price)
-                VALUES (%s, %s, %s, NOW(), %s, %s)
-                """,
-                (flight_id, session['username'], passenger_name, 'confirmed', final_price)
-            )
-            connection.commit()
-
-            # Get the booking ID
-            booking_id = cursor.lastrowid
-
-            # Insert transaction into the database
-            cursor.execute(
-                """
-                INSERT INTO transactions (booking_id, username, amount, transaction_type, status, payment_method, discount_applied)
-                VALUES (%s, %s, %s, %s, %s, %s, %s)
-                """,
-                (booking_id, session['username'], final_price, 'payment', 'success', payment_method, discount)
-            )
-            connection.commit()
-
-            # Update loyalty points table
-            if loyalty_points:
-                # Update existing loyalty points
-                cursor.execute("""
-                    UPDATE loyalty_points
-                    SET points = points + %s, total_points_left = total_points_left - %s + %s
-                    WHERE user_id = (SELECT id FROM users WHERE username = %s)
-                """, (loyalty_points_earned, points_to_redeem, loyalty_points_earned, session['username']))
-            else:
-                # Insert new loyalty points record
-                cursor.execute("""
-                    INSERT INTO loyalty_points (user_id, points, total_points_left)
-                    VALUES ((SELECT id FROM users WHERE username = %s), %s, %s)
-                """, (session['username'], loyalty_points_earned, loyalty_points_earned - points_to_redeem))
-            connection.commit()
-
-            # Notify the user about the booking confirmation
-            cursor.execute(
-                "INSERT INTO notifications (username, message) VALUES (%s, %s)",
-                (session['username'], f"Booking confirmed! Flight from {flight['source']} to {flight['destination']} on {flight['departure_date']}. Final price: ${final_price:.2f}.")
-            )
-            connection.commit()
-
-            # Notify the user about the discount applied
-            if points_to_redeem > 0:
-                cursor.execute(
-                    "INSERT INTO notifications (username, message) VALUES (%s, %s)",
-                    (session['username'], f"You redeemed {points_to_redeem} points and received a discount of ${discount:.2f}.")
-                )
-                connection.commit()
-
-            # Notify the user about the points earned
-            if loyalty_points_earned > 0:
-                cursor.execute(
-                    "INSERT INTO notifications (username, message) VALUES (%s, %s)",
-                    (session['username'], f"You earned {loyalty_points_earned} loyalty points for this booking.")
-                )
-                connection.commit()
-
+            # Booking, transaction, loyalty points and notifications in a single commit
+            result = booking_service.checkout(connection, session['username'], flight, passenger_name, payment_method, points_to_redeem, quote)
+            flight_index.invalidate(flight_id)
+            # Keep this user's next reads on the primary so /bookings shows the booking
+            stick_to_primary()
             flash('Payment confirmed successfully!', 'success')
+            # Render the ticket now so /ticket is served from the ticket store
+            try:
+                ticket_store.ensure_ticket(cursor, result['booking_id'], session['username'])
+            except Exception:
+                app.logger.exception("Could not pre-render ticket for booking %s", result['booking_id'])
+        except booking_service.BookingError as e:
+            flash(str(e), 'danger')
+            return redirect(url_for('payment', flight_id=flight_id, classType=quote['class_type'], passengers=quote['passengers']))
         except Exception as e:
-            connection.rollback()
-            print(f"Error processing payment: {e}")
+            app.logger.exception(f"Error processing payment: {e}")
             flash('An error occurred while processing the payment.', 'danger')
-            return redirect(url_for('payment', flight_id=flight_id))
+            return redirect(url_for('payment', flight_id=flight_id, classType=quote['class_type'], passengers=quote['passengers']))
         finally:
             cursor.close()
             connection.close()
 
         return redirect(url_for('bookings'))
 
+    # Hold the seats while the user fills in the payment form; a deadlock or
+    # lock wait timeout against another buyer is retried once
+    for attempt in range(2):
+        try:
+            seat_inventory.hold(cursor, flight['id'], session['username'], seats=quote['passengers'])
+            connection.commit()
+            break
+        except seat_inventory.SoldOut:
+            connection.rollback()
+            cursor.close()
+            connection.close()
+            flash('Sorry, this flight is sold out.', 'danger')
+            return redirect(url_for('home'))
+        except mysql.connector.Error as e:
+            connection.rollback()
+            if attempt == 0 and e.errno in (1205, 1213):
+                continue
+            app.logger.exception(f"Error holding seats on flight {flight['id']}: {e}")
+            cursor.close()
+            connection.close()
+            flash('We could not reserve your seats. Please try again.', 'danger')
+            return redirect(url_for('home'))
+
     cursor.close()
     connection.close()
-    return render_template('payment.html', flight=flight, available_points=available_points)
+    # The template shows flight.price as the amount due
+    return render_template('payment.html', flight=dict(flight, price=quote['total']), quote=quote, available_points=available_points)
 
 # Route for ticket confirmation
 @app.route('/ticket')
 @login_required
 def ticket():
-    booking_id = request.args.get('booking_id')
+    booking_id = request.args.get('booking_id', type=int)
 
     if not booking_id:
         return "Booking ID is missing."
 
-    connection = get_db_connection()
-    cursor = connection.cursor(dictionary=True)
-
-    # Fetch the booking and flight details using booking_id
-    cursor.execute("""
-        SELECT f.*, b.passenger_name
-        FROM bookings b
-        JOIN flights f ON b.flight_id = f.id
-        WHERE b.id = %s AND b.username = %s
-    """, (booking_id, session['username']))
-    ticket_details = cursor.fetchone()
-
-    cursor.close()
-    connection.close()
+    # Use the stored ticket document, rendering it first if there isn't one
+    entry = ticket_store.ticket_store.lookup(booking_id)
+    if entry is None:
+        connection = get_read_connection()
+        cursor = connection.cursor(dictionary=True)
+        entry = ticket_store.ensure_ticket(cursor, booking_id, session['username'])
+        cursor.close()
+        connection.close()
 
-    if not ticket_details:
+    if not entry or entry['username'] != session['username']:
         return "Ticket not found."
 
-    # Pass the ticket details to the template
-    return render_template('ticket.html', flight=ticket_details, passenger_name=ticket_details['passenger_name'])
+    # Send the browser to the document's permanent, cacheable URL
+    response = redirect(url_for('ticket_document', booking_id=booking_id, digest=entry['digest']))
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+# Route for a stored ticket document; its content never changes
+@app.route('/tickets/<int:booking_id>/<digest>')
+@login_required
+def ticket_document(booking_id, digest):
+    entry = ticket_store.ticket_store.lookup(booking_id)
+    if entry is None or entry['username'] != session['username'] or entry['digest'] != digest:
+        # Cancelled, refunded or re-rendered since this link was issued
+        return redirect(url_for('ticket', booking_id=booking_id))
+    body = ticket_store.ticket_store.read(digest)
+    if body is None:
+        return redirect(url_for('ticket', booking_id=booking_id))
+    return ticket_store.respond(digest, body)
 
 # Route for viewing bookings
 @app.route('/bookings')
 @login_required
 def bookings():
-    connection = get_db_connection()
+    connection = get_read_connection()
     cursor = connection.cursor(dictionary=True)
 
-    # Fetch bookings for the logged-in user
-    cursor.execute("""
-        SELECT b.id AS booking_id, f.flight_number, f.source, f.destination, 
-               f.departure_date, b.final_price AS price, 
-               b.passenger_name, b.booking_date, b.status
-        FROM bookings b
-        JOIN flights f ON b.flight_id = f.id
-        WHERE b.username = %s
-    """, (session['username'],))
-    bookings = cursor.fetchall()
+    # Fetch one page of bookings for the logged-in user, most recent first
+    bookings, next_cursor = history.bookings_page(cursor, session['username'], before=request.args.get('before'))
 
     cursor.close()
     connection.close()
 
-    return render_template('bookings.html', bookings=bookings)
+    return render_template('bookings.html', bookings=bookings, next_cursor=next_cursor)
 
 # Route for cancelling a booking
 @app.route('/cancel-booking/<int:booking_id>', methods=['POST'])
 @login_required
 def cancel_booking(booking_id):
     connection = get_db_connection()
-    cursor = connection.cursor(dictionary=True)
 
-    # Fetch booking details for the notification
-    cursor.execute("""
-        SELECT f.source, f.destination, f.departure_date
-        FROM bookings b
-        JOIN flights f ON b.flight_id = f.id
-        WHERE b.id = %s AND b.username = %s
-    """, (booking_id, session['username']))
-    booking = cursor.fetchone()
+    # Cancel the booking and notify the user in one transaction
+    booking = booking_service.cancel(connection, session['username'], booking_id)
+    connection.close()
 
     if not booking:
         flash('Invalid booking ID or unauthorized access.', 'danger')
         return redirect(url_for('bookings'))
 
-    # Update the booking status to 'cancelled'
-    cursor.execute(
-        "UPDATE bookings SET status = %s WHERE id = %s AND username = %s",
-        ('cancelled', booking_id, session['username'])
-    )
-    connection.commit()
-
-    # Send a notification to the user
-    cursor.execute(
-        "INSERT INTO notifications (username, message) VALUES (%s, %s)",
-        (session['username'], f"Your booking from {booking['source']} to {booking['destination']} on {booking['departure_date']} has been canceled.")
-    )
-    connection.commit()
-
-    cursor.close()
-    connection.close()
+    flight_index.invalidate(booking['flight_id'])
+    ticket_store.ticket_store.invalidate(booking_id)
+    stick_to_primary()
 
     flash('Booking cancelled successfully!', 'success')
     return redirect(url_for('bookings'))
@@ -433,26 +478,35 @@ def cancel_booking(booking_id):
 @app.route('/transactions')
 @login_required
 def transactions():
-    connection = get_db_connection()
+    connection = get_read_connection()
     cursor = connection.cursor(dictionary=True)
 
-    # Fetch transactions for the logged-in user
-    cursor.execute("""
-        SELECT t.id, t.booking_id, t.amount AS amount, t.discount_applied, 
-               t.transaction_type, t.transaction_date, t.status, t.payment_method, 
-               f.flight_number, f.source, f.destination
-        FROM transactions t
-        JOIN bookings b ON t.booking_id = b.id
-        JOIN flights f ON b.flight_id = f.id
-        WHERE t.username = %s
-        ORDER BY t.transaction_date DESC
-    """, (session['username'],))
-    transactions = cursor.fetchall()
+    # Fetch one page of transactions for the logged-in user, newest first
+    transactions, next_cursor = history.transactions_page(cursor, session['username'], before=request.args.get('before'))
 
     cursor.close()
     connection.close()
 
-    return render_template('transactions.html', transactions=transactions)
+    return render_template('transactions.html', transactions=transactions, next_cursor=next_cursor)
+
+# Full transaction history as a CSV download, streamed as it is read
+@app.route('/transactions/statement.csv')
+@login_required
+def transactions_statement():
+    username = session['username']
+
+    def generate():
+        connection = get_read_connection()
+        try:
+            yield from history.statement_csv(connection, username)
+        finally:
+            connection.close()
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/csv',
+        headers={'Content-Disposition': 'attachment; filename=statement.csv'}
+    )
 
 # Route for feedback
 @app.route('/feedback/<int:booking_id>', methods=['GET', 'POST'])
@@ -474,17 +528,31 @@ def feedback(booking_id):
         return redirect(url_for('bookings'))
 
     if request.method == 'POST':
-        rating = request.form.get('rating')
         comments = request.form.get('comments')
+        try:
+            rating = ratings.parse_rating(request.form.get('rating'))
+        except ratings.InvalidRating:
+            cursor.close()
+            connection.close()
+            flash('Please give a rating from 1 to 5.', 'danger')
+            return redirect(url_for('feedback', booking_id=booking_id))
 
-        # Insert feedback into the database
-        cursor.execute("""
-            INSERT INTO feedback (booking_id, username, rating, comments)
-            VALUES (%s, %s, %s, %s)
-        """, (booking_id, session['username'], rating, comments))
-        connection.commit()
+        # Insert the feedback and update the flight and route ratings in one commit
+        try:
+            added = ratings.submit(cursor, booking, session['username'], rating, comments)
+            connection.commit()
+        except mysql.connector.Error as e:
+            connection.rollback()
+            cursor.close()
+            connection.close()
+            app.logger.exception(f"Error saving feedback for booking {booking_id}: {e}")
+            flash('We could not save your feedback. Please try again.', 'danger')
+            return redirect(url_for('feedback', booking_id=booking_id))
 
-        flash('Thank you for your feedback!', 'success')
+        if added:
+            flash('Thank you for your feedback!', 'success')
+        else:
+            flash('You have already left feedback for this booking.', 'info')
         cursor.close()
         connection.close()
         return redirect(url_for('bookings'))
@@ -498,31 +566,55 @@ def feedback(booking_id):
 @app.route('/notifications')
 @login_required
 def notifications():
-    connection = get_db_connection()
+    connection = get_read_connection()
     cursor = connection.cursor(dictionary=True)
 
-    # Fetch notifications for the logged-in user
-    cursor.execute("""
-        SELECT * FROM notifications WHERE username = %s ORDER BY created_at DESC
-    """, (session['username'],))
-    notifications = cursor.fetchall()
+    # Fetch one page of notifications for the logged-in user, newest first
+    notifications, next_cursor = notification_store.page(cursor, session['username'], before=request.args.get('before'))
+    unread_count = notification_store.unread_count(cursor, session['username'], seed=False)
+    connection.commit()
 
     cursor.close()
     connection.close()
 
-    return render_template('notifications.html', notifications=notifications)
+    # Newest id the user has seen, carried along from the first page, so
+    # "Mark All as Read" never touches notifications that arrived since
+    newest_id = max([request.args.get('seen', 0, type=int)] + [n['id'] for n in notifications]) or None
+
+    return render_template('notifications.html', notifications=notifications, next_cursor=next_cursor, unread_count=unread_count, newest_id=newest_id)
+
+# JSON endpoint for polling new notifications since the last id the client saw
+@app.route('/notifications/poll')
+@login_required
+def poll_notifications():
+    after_id = request.args.get('since', 0, type=int)
+
+    connection = get_read_connection()
+    cursor = connection.cursor(dictionary=True)
+    new_notifications = notification_store.since(cursor, session['username'], after_id)
+    unread_count = notification_store.unread_count(cursor, session['username'], seed=False)
+    connection.commit()
+    cursor.close()
+    connection.close()
+
+    return jsonify(
+        notifications=new_notifications,
+        cursor=new_notifications[-1]['id'] if new_notifications else after_id,
+        unread=unread_count,
+    )
 
 @app.route('/notifications/mark-as-read', methods=['POST'])
 @login_required
 def mark_notifications_as_read():
+    up_to_id = request.form.get('up_to_id', type=int)
+
     connection = get_db_connection()
-    cursor = connection.cursor()
+    cursor = connection.cursor(dictionary=True)
 
-    # Mark all notifications as read for the logged-in user
-    cursor.execute("""
-        UPDATE notifications SET is_read = TRUE WHERE username = %s
-    """, (session['username'],))
+    # Mark unread notifications up to the newest one the user has seen
+    notification_store.mark_read(cursor, session['username'], up_to_id)
     connection.commit()
+    stick_to_primary()
 
     cursor.close()
     connection.close()
@@ -534,25 +626,30 @@ def mark_notifications_as_read():
 @app.route('/loyalty-points')
 @login_required
 def loyalty_points():
-    connection = get_db_connection()
+    connection = get_read_connection()
     cursor = connection.cursor(dictionary=True)
 
     # Fetch loyalty points for the logged-in user
-    cursor.execute("""
-        SELECT total_points_left FROM loyalty_points
-        WHERE user_id = (SELECT id FROM users WHERE username = %s)
-    """, (session['username'],))
-    points = cursor.fetchone()
+    points = loyalty.balance(cursor, session['username'])
 
     cursor.close()
     connection.close()
 
-    return render_template('loyalty_points.html', points=points['total_points_left'] if points else 0)
+    return render_template('loyalty_points.html', points=points)
 
 # Route for logout
 @app.route('/logout')
 def logout():
-    session.pop('username', None)
+    if session.get('auth_token'):
+        connection = get_db_connection()
+        cursor = connection.cursor()
+        auth.revoke_session(cursor, session['auth_token'])
+        connection.commit()
+        cursor.close()
+        connection.close()
+    # Drops the session from the store; the flash below goes in a new one
+    session.clear()
+    session.regenerate()
     flash('You have been logged out.', 'success')
     return redirect(url_for('login'))
 
@@ -560,48 +657,254 @@ def logout():
 @app.route('/refunds')
 @login_required
 def refunds():
-    connection = get_db_connection()
+    connection = get_read_connection()
     cursor = connection.cursor(dictionary=True)
-    cursor.execute("""
-        SELECT b.id, b.final_price AS price, b.refund_status, f.flight_number, f.departure_date
-        FROM bookings b
-        JOIN flights f ON b.flight_id = f.id
-        WHERE b.username = %s AND b.status = 'cancelled'
-    """, (session['username'],))
-    cancelled_bookings = cursor.fetchall()
+    cancelled_bookings, next_cursor = history.refunds_page(cursor, session['username'], before=request.args.get('before'))
     cursor.close()
     connection.close()
-    return render_template('refunds.html', bookings=cancelled_bookings)
+    return render_template('refunds.html', bookings=cancelled_bookings, next_cursor=next_cursor)
 
 @app.route('/request_refund/<int:booking_id>', methods=['POST'])
 @login_required
 def request_refund(booking_id):
+    # Queue the refund; repeated submits for the same booking find the same job
     connection = get_db_connection()
-    cursor = connection.cursor()
-    # Update booking refund status
-    cursor.execute("""
-        UPDATE bookings SET refund_status = 'REFUNDED'
-        WHERE id = %s AND username = %s AND status = 'cancelled'
-    """, (booking_id, session['username']))
-    # Update transaction status to refunded where it was success
-    cursor.execute("""
-        UPDATE transactions SET status = 'refunded'
-        WHERE booking_id = %s AND username = %s AND status = 'success'
-    """, (booking_id, session['username']))
-    connection.commit()
-    cursor.close()
+    job = refund_jobs.request_refund(connection, session['username'], booking_id)
     connection.close()
-    flash('Refund processed successfully!', 'success')
+    stick_to_primary()
+
+    if job is None:
+        flash('Only cancelled bookings can be refunded.', 'danger')
+    elif job['status'] == 'done':
+        flash('This booking has already been refunded.', 'info')
+    elif job['status'] == 'failed':
+        flash(f"The refund could not be processed: {job['last_error'] or 'unknown error'}", 'danger')
+    else:
+        flash('Refund requested. It will be processed shortly.', 'success')
     return redirect(url_for('refunds'))
 
+# JSON endpoint the refunds page polls for the progress of queued refunds
+@app.route('/refunds/status')
+@login_required
+def refund_status():
+    connection = get_read_connection()
+    cursor = connection.cursor(dictionary=True)
+    jobs = refund_jobs.status(cursor, session['username'])
+    cursor.close()
+    connection.close()
+
+    return jsonify({'refunds': [
+        {'booking_id': job['booking_id'], 'status': job['status'], 'attempts': job['attempts']}
+        for job in jobs
+    ]})
+
  
 # Route for help page
 @app.route('/help')
 @login_required
+@cached_page
 def help_page():
     return render_template('help.html')
 
+# Maintenance commands
+@app.cli.command('init-seat-inventory')
+def init_seat_inventory_command():
+    connection = get_db_connection()
+    cursor = connection.cursor()
+    seat_inventory.ensure_schema(cursor)
+    added = seat_inventory.sync_inventory(cursor)
+    connection.commit()
+    cursor.close()
+    connection.close()
+    print(f"Seat inventory ready ({added} flights added).")
+
+@app.cli.command('reconcile-loyalty')
+def reconcile_loyalty_command():
+    connection = get_db_connection()
+    cursor = connection.cursor()
+    loyalty.ensure_schema(cursor)
+    connection.commit()
+    cursor.close()
+    rebuilt = loyalty.reconcile(connection)
+    connection.close()
+    print(f"Rebuilt loyalty balances ({rebuilt} rows changed).")
+
+@app.cli.command('purge-sessions')
+def purge_sessions_command():
+    connection = get_db_connection()
+    cursor = connection.cursor()
+    auth.ensure_schema(cursor)
+    purged = auth.purge_expired_sessions(cursor)
+    failures = auth.purge_failures(cursor)
+    connection.commit()
+    cursor.close()
+    connection.close()
+    print(f"Purged {purged} expired or revoked sessions and {failures} stale login failure counters.")
+
+@app.cli.command('rebuild-notification-counters')
+def rebuild_notification_counters_command():
+    connection = get_db_connection()
+    cursor = connection.cursor()
+    notification_store.ensure_schema(cursor)
+    notification_store.rebuild_counters(cursor)
+    connection.commit()
+    cursor.close()
+    connection.close()
+    print("Notification counters rebuilt.")
+
+@app.cli.command('rebuild-ratings')
+def rebuild_ratings_command():
+    connection = get_db_connection()
+    cursor = connection.cursor()
+    ratings.ensure_schema(cursor)
+    flights, routes = ratings.rebuild(cursor)
+    connection.commit()
+    cursor.close()
+    connection.close()
+    print(f"Rebuilt ratings for {flights} flight numbers and {routes} routes.")
+
+@app.cli.command('release-seat-holds')
+def release_seat_holds_command():
+    connection = get_db_connection()
+    released = seat_inventory.release_expired_holds(connection)
+    connection.close()
+    print(f"Released {released} expired seat holds.")
+
+@app.cli.command('prerender-tickets')
+@click.option('--hours', type=int, default=24, show_default=True, help='flights departing within this many hours')
+@click.option('--prune/--no-prune', default=True, help='also delete documents no booking uses any more')
+def prerender_tickets_command(hours, prune):
+    connection = get_db_connection()
+    started = time.perf_counter()
+
+    def progress(done, total, rendered):
+        print(f"  {done}/{total} flights, {rendered} tickets rendered", file=sys.stderr)
+
+    # Rendering needs a request context for url_for in the template
+    with app.test_request_context():
+        rendered = ticket_store.prerender_departing(connection, hours, progress=progress)
+    connection.close()
+    print(f"Rendered {rendered} tickets in {time.perf_counter() - started:.1f}s.")
+    if prune:
+        print(f"Pruned {ticket_store.ticket_store.prune()} unused ticket documents.")
+
+@app.cli.command('migrate')
+@click.option('--to', 'target', type=int, help='stop after this version')
+def migrate_command(target):
+    connection = get_db_connection()
+    applied = migrations.migrate(connection, target)
+    connection.close()
+    print(f"Applied {len(applied)} migrations." if applied else "Schema is up to date.")
+
+@app.cli.command('migrate-status')
+def migrate_status_command():
+    connection = get_db_connection()
+    cursor = connection.cursor()
+    done = migrations.applied_versions(cursor)
+    connection.commit()
+    cursor.close()
+    connection.close()
+    for version, name, _ in migrations.MIGRATIONS:
+        print(f"{version:>4}  {'applied' if version in done else 'pending':8} {name}")
+
+@app.cli.command('verify-queries')
+def verify_queries_command():
+    connection = get_db_connection()
+    full_scans, errors, skipped, checked = migrations.verify(connection, app.root_path)
+    connection.close()
+    for query in full_scans:
+        print(f"FULL SCAN on {query['table']} (~{query['rows']} rows) {query['file']}:{query['line']} {query['function']}: {query['sql']}")
+    for query in errors:
+        print(f"ERROR {query['file']}:{query['line']} {query['function']}: {query['error']}")
+    for query in skipped:
+        print(f"skipped {query['file']}:{query['line']} {query['function']} (dynamic SQL)")
+    print(f"Checked {checked} queries: {len(full_scans)} full scans, {len(errors)} errors.")
+    if full_scans or errors:
+        sys.exit(1)
+
+@app.cli.command('process-refunds')
+@click.option('--once', is_flag=True, help='drain the queue and exit instead of running continuously')
+def process_refunds_command(once):
+    if once:
+        total = 0
+        while True:
+            handled = refund_jobs.refund_processor.run_once()
+            total += handled
+            if handled < refund_jobs.refund_processor.batch_size:
+                break
+        notification_queue.flush()
+        print(f"Processed {total} refund jobs.")
+        return
+    refund_jobs.refund_processor.workers = max(1, refund_jobs.refund_processor.workers)
+    refund_jobs.refund_processor.start()
+    print("Processing refunds (Ctrl+C to stop).")
+    try:
+        while True:
+            time.sleep(60)
+    except KeyboardInterrupt:
+        refund_jobs.refund_processor.stop()
+        notification_queue.flush()
+
+@app.cli.command('cancel-flight')
+@click.argument('flight_id', type=int)
+def cancel_flight_command(flight_id):
+    connection = get_db_connection()
+    cancelled = refund_jobs.cancel_flight(connection, flight_id)
+    connection.close()
+    notification_queue.flush()
+    print(f"Cancelled {cancelled} bookings on flight {flight_id}; refunds queued.")
+
+@app.cli.command('import-schedule')
+@click.argument('path')
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'jsonl']), help='defaults to the file extension')
+@click.option('--batch-size', default=schedule_io.BATCH_SIZE, show_default=True, help='rows per INSERT')
+@click.option('--chunk-size', default=schedule_io.CHUNK_SIZE, show_default=True, help='rows per transaction')
+def import_schedule_command(path, fmt, batch_size, chunk_size):
+    connection = get_db_connection()
+    cursor = connection.cursor()
+    schedule_io.ensure_schema(cursor)
+    seat_inventory.ensure_schema(cursor)
+    connection.commit()
+    cursor.close()
+
+    def progress(stats):
+        print(f"  {stats['read']:,} rows read ({schedule_io.rate(stats):,.0f} rows/s)", file=sys.stderr)
+
+    stats = schedule_io.import_schedule(connection, path, fmt, batch_size, chunk_size, progress)
+
+    # New flights need seat counters
+    cursor = connection.cursor()
+    added = seat_inventory.sync_inventory(cursor)
+    connection.commit()
+    cursor.close()
+    connection.close()
+
+    print(f"Imported {stats['imported']:,} of {stats['read']:,} rows in {stats['seconds']:.1f}s "
+          f"({schedule_io.rate(stats):,.0f} rows/s); {added} new seat counters.")
+    if stats['rejected']:
+        print(f"Rejected {stats['rejected']:,} rows (first lines: {stats['rejected_lines']}).")
+
+@app.cli.command('export-data')
+@click.argument('table', type=click.Choice(sorted(schedule_io.EXPORTS)))
+@click.option('--output', default='-', help='file to write (default: stdout)')
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'jsonl']), default='csv', show_default=True)
+@click.option('--since', help='only rows dated on or after YYYY-MM-DD')
+@click.option('--batch-size', default=schedule_io.BATCH_SIZE, show_default=True, help='rows per query')
+def export_data_command(table, output, fmt, since, batch_size):
+    connection = get_db_connection()
+    out = sys.stdout if output == '-' else open(output, 'w', encoding='utf-8', newline='')
+    try:
+        count = schedule_io.export_table(connection, table, out, fmt, since, batch_size)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+        connection.close()
+    print(f"Exported {count:,} {table} rows.", file=sys.stderr)
+
 # Run the app
 if __name__ == '__main__':
+    # Load the flight index up front so the first search doesn't pay for it
+    with app.app_context():
+        flight_index.warm()
 
     app.run(debug=True)
@@ -0,0 +1,167 @@
+# ASGI entry point:
+#
+#   uvicorn asgi:application --host 0.0.0.0 --port 8000
+#
+# The endpoints clients hit most often and with the most concurrency (the
+# notification poll and refund status poll) are served natively here on
+# async_db, so thousands of open polls wait on the event loop rather than
+# each holding a thread. Everything else is the regular Flask app, run
+# through asgiref's WSGI adapter on a pool of ASGI_WSGI_THREADS threads (by
+# default asgiref runs every WSGI request on one shared thread, one at a
+# time). Both read sessions from the same server-side store, so users move
+# between the two freely.
+import asyncio
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.cookies import SimpleCookie
+from urllib.parse import parse_qs
+
+from asgiref.sync import SyncToAsync
+from asgiref.wsgi import WsgiToAsgi, WsgiToAsgiInstance
+
+import async_db
+from app import app
+from db_connection import DEFAULT_CONFIG, PoolTimeout
+from flight_index import flight_index
+from instrumentation import metrics
+from notification_queue import notification_queue
+
+WSGI_THREADS = int(os.environ.get('ASGI_WSGI_THREADS', 32))
+
+_wsgi_executor = ThreadPoolExecutor(max_workers=WSGI_THREADS, thread_name_prefix='wsgi')
+
+
+class _ThreadedWsgiInstance(WsgiToAsgiInstance):
+    # WsgiToAsgiInstance.run_wsgi_app is wrapped in sync_to_async with
+    # thread_sensitive=True, which serialises every Flask request onto a
+    # single thread. Re-wrap the same function to run on our own pool.
+    run_wsgi_app = SyncToAsync(
+        WsgiToAsgiInstance.__dict__['run_wsgi_app'].func,
+        thread_sensitive=False,
+        executor=_wsgi_executor,
+    )
+
+
+class _ThreadedWsgiToAsgi(WsgiToAsgi):
+    async def __call__(self, scope, receive, send):
+        await _ThreadedWsgiInstance(self.wsgi_application)(scope, receive, send)
+
+
+flask_application = _ThreadedWsgiToAsgi(app)
+
+
+def _session(scope):
+    # Looks the session cookie up in the same store app.session_interface
+    # uses. The store may be a SQLite file, so callers on the event loop run
+    # this in a thread.
+    cookie_name = app.config['SESSION_COOKIE_NAME']
+    for name, value in scope.get('headers', ()):
+        if name == b'cookie':
+            cookie = SimpleCookie()
+            cookie.load(value.decode('latin-1'))
+            if cookie_name in cookie:
+                loaded = app.session_interface.load(app, cookie[cookie_name].value)
+                return loaded[1] if loaded else {}
+    return {}
+
+
+async def _current_user(scope):
+    # Same check as login_required in app.py.
+    session = await asyncio.to_thread(_session, scope)
+    username = session.get('username')
+    if username and await async_db.session_username(session.get('auth_token')) == username:
+        return username
+    return None
+
+
+async def _send(send, status, body=b'', headers=()):
+    await send({'type': 'http.response.start', 'status': status, 'headers': list(headers)})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def _send_json(send, payload, status=200):
+    body = app.json.dumps(payload).encode('utf-8')
+    await _send(send, status, body, [(b'content-type', b'application/json'), (b'cache-control', b'no-store')])
+
+
+async def poll_notifications(scope, username):
+    query = parse_qs(scope.get('query_string', b'').decode('latin-1'))
+    try:
+        after_id = int(query.get('since', ['0'])[0])
+    except ValueError:
+        after_id = 0
+    async with async_db.cursor() as cur:
+        new_notifications = await async_db.notifications_since(cur, username, after_id)
+        unread = await async_db.unread_count(cur, username)
+    return {
+        'notifications': new_notifications,
+        'cursor': new_notifications[-1]['id'] if new_notifications else after_id,
+        'unread': unread,
+    }
+
+
+async def refund_status(scope, username):
+    async with async_db.cursor() as cur:
+        jobs = await async_db.refund_status(cur, username)
+    return {'refunds': [
+        {'booking_id': job['booking_id'], 'status': job['status'], 'attempts': job['attempts']}
+        for job in jobs
+    ]}
+
+
+# (method, path) -> coroutine returning a JSON payload; same URLs and
+# responses as the Flask routes they replace.
+NATIVE_ROUTES = {
+    ('GET', '/notifications/poll'): poll_notifications,
+    ('GET', '/refunds/status'): refund_status,
+}
+
+
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            try:
+                overrides = {key: app.config[key] for key in DEFAULT_CONFIG if key in app.config}
+                await async_db.init_pool(overrides)
+                await asyncio.to_thread(flight_index.warm)
+            except Exception as error:
+                await send({'type': 'lifespan.startup.failed', 'message': str(error)})
+                return
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await async_db.close_pool()
+            await asyncio.to_thread(notification_queue.flush)
+            _wsgi_executor.shutdown(wait=False)
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def application(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        await _lifespan(receive, send)
+        return
+    handler = NATIVE_ROUTES.get((scope.get('method'), scope.get('path'))) if scope['type'] == 'http' else None
+    if handler is None:
+        await flask_application(scope, receive, send)
+        return
+
+    # The session lookup needs a connection too, so it is inside the
+    # PoolTimeout handler. These routes aren't admission-limited in app.py
+    # either, and read the primary, so read-your-writes holds without
+    # stick_to_primary(); they are recorded in /metrics like Flask routes.
+    started = time.perf_counter()
+    try:
+        username = await _current_user(scope)
+        if username is None:
+            status = 302
+            await _send(send, status, headers=[(b'location', b'/login')])
+        else:
+            payload = await handler(scope, username)
+            status = 200
+            await _send_json(send, payload)
+    except PoolTimeout:
+        status = 503
+        await _send_json(send, {'error': 'busy'}, status=status)
+    metrics.record_request(scope['path'], scope['method'], status, time.perf_counter() - started, 0, 0.0)
@@ -0,0 +1,137 @@
+# Async data access on aiomysql, for the ASGI entry point (asgi.py).
+#
+# The pool is sized and configured from the same DB_* settings as the sync
+# pool in db_connection, plus DB_ASYNC_POOL_SIZE. Coroutines waiting for a
+# connection cost a few KB each instead of a thread, so one process can keep
+# thousands of requests in flight while the database sees a bounded number
+# of connections.
+#
+# Only the hot read paths served natively by asgi.py have async versions;
+# the queries are the same as their sync counterparts in auth and
+# notification_store and must be kept in step with them.
+import asyncio
+import os
+from contextlib import asynccontextmanager
+
+try:
+    import aiomysql
+except ImportError:  # optional: only needed for the ASGI mode
+    aiomysql = None
+
+import auth
+import notification_store
+import refund_jobs
+from db_connection import PoolTimeout, load_config
+
+POOL_SIZE = int(os.environ.get('DB_ASYNC_POOL_SIZE', 20))
+
+_pool = None
+_timeout = 5.0
+
+
+async def init_pool(overrides=None, size=None):
+    global _pool, _timeout
+    if aiomysql is None:
+        raise RuntimeError("The async mode needs aiomysql (pip install aiomysql).")
+    config = load_config(overrides)
+    _timeout = config['DB_POOL_TIMEOUT']
+    _pool = await aiomysql.create_pool(
+        host=config['DB_HOST'],
+        port=config['DB_PORT'],
+        user=config['DB_USER'],
+        password=config['DB_PASSWORD'],
+        db=config['DB_NAME'],
+        minsize=min(config['DB_POOL_MIN_IDLE'], size or POOL_SIZE),
+        maxsize=size or POOL_SIZE,
+        pool_recycle=int(config['DB_POOL_IDLE_TIMEOUT']),
+        autocommit=False,
+    )
+    return _pool
+
+
+async def close_pool():
+    global _pool
+    if _pool is not None:
+        _pool.close()
+        await _pool.wait_closed()
+        _pool = None
+
+
+def pool_stats():
+    if _pool is None:
+        return {}
+    return {'size': _pool.size, 'free': _pool.freesize, 'max_size': _pool.maxsize}
+
+
+@asynccontextmanager
+async def cursor():
+    # A dictionary cursor on a pooled connection; the transaction is
+    # committed on the way out (rolled back on error) like the sync routes do.
+    try:
+        connection = await asyncio.wait_for(_pool.acquire(), _timeout)
+    except asyncio.TimeoutError:
+        raise PoolTimeout(f"No async database connection free after {_timeout}s")
+    try:
+        async with connection.cursor(aiomysql.DictCursor) as cur:
+            yield cur
+        await connection.commit()
+    except BaseException:
+        await connection.rollback()
+        raise
+    finally:
+        _pool.release(connection)
+
+
+# -- hot reads -----------------------------------------------------------------
+
+async def session_username(token):
+    # See auth.session_username; shares its in-process token cache.
+    if not token:
+        return None
+    token_hash = auth._token_hash(token)
+    username = auth.token_cache.get(token_hash)
+    if username is not None:
+        return username
+    async with cursor() as cur:
+        await cur.execute("""
+            SELECT username, TIMESTAMPDIFF(SECOND, NOW(), expires_at) AS ttl FROM user_sessions
+            WHERE token_hash = %s AND revoked_at IS NULL AND expires_at > NOW()
+        """, (token_hash,))
+        row = await cur.fetchone()
+    if row is None:
+        return None
+    auth.token_cache.put(token_hash, row['username'], ttl=row['ttl'])
+    return row['username']
+
+
+async def notifications_since(cur, username, after_id, limit=notification_store.POLL_LIMIT):
+    await cur.execute("""
+        SELECT id, message, is_read, created_at FROM notifications
+        WHERE username = %s AND id > %s
+        ORDER BY id
+        LIMIT %s
+    """, (username, after_id, limit))
+    return list(await cur.fetchall())
+
+
+async def unread_count(cur, username):
+    await cur.execute("SELECT unread FROM notification_counters WHERE username = %s", (username,))
+    row = await cur.fetchone()
+    if row is not None:
+        return row['unread']
+    # Like notification_store.unread_count(seed=False): a poll only counts,
+    # and leaves seeding the counter to the primary's write paths.
+    await cur.execute(
+        "SELECT COUNT(*) AS unread FROM notifications WHERE username = %s AND is_read = FALSE",
+        (username,)
+    )
+    return (await cur.fetchone())['unread']
+
+
+async def refund_status(cur, username):
+    await cur.execute("""
+        SELECT booking_id, status, attempts, created_at, finished_at
+        FROM refund_jobs WHERE username = %s
+        ORDER BY id DESC LIMIT %s
+    """, (username, refund_jobs.STATUS_LIMIT))
+    return list(await cur.fetchall())
@@ -0,0 +1,257 @@
+# Password hashing, login sessions and failed-login throttling.
+#
+# Passwords are stored as salted PBKDF2-SHA256 hashes with a configurable
+# iteration count. Hashing runs on a small bounded thread pool so a burst of
+# logins can't tie up every request thread; when the pool's queue is full the
+# login is turned away with AuthBusy instead of waiting.
+#
+# A successful login creates a random session token. Only its SHA-256 is
+# stored (in user_sessions), and recently checked tokens are kept in an LRU so
+# login_required normally does no database work. Cached entries live for
+# AUTH_TOKEN_CACHE_TTL seconds, which bounds how long a token revoked by
+# another process can still be accepted here.
+#
+# Failed logins are counted per username in login_failures, so the limit
+# holds however the attempts are spread across worker processes and hosts.
+# A user is locked out once MAX_FAILED_LOGINS failures land within
+# LOCKOUT_SECONDS of the first one, until that window runs out.
+import base64
+import hashlib
+import hmac
+import os
+import secrets
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeout
+from datetime import datetime, timedelta
+
+from db_connection import get_db_connection
+
+HASH_ALGORITHM = 'pbkdf2_sha256'
+HASH_ITERATIONS = int(os.environ.get('AUTH_HASH_ITERATIONS', 200000))
+HASH_WORKERS = int(os.environ.get('AUTH_HASH_WORKERS', 4))
+HASH_QUEUE = int(os.environ.get('AUTH_HASH_QUEUE', 32))     # hashes waiting or running
+HASH_TIMEOUT = float(os.environ.get('AUTH_HASH_TIMEOUT', 5))
+SESSION_TTL = int(os.environ.get('AUTH_SESSION_TTL', 7 * 24 * 3600))
+TOKEN_CACHE_SIZE = int(os.environ.get('AUTH_TOKEN_CACHE_SIZE', 10000))
+TOKEN_CACHE_TTL = float(os.environ.get('AUTH_TOKEN_CACHE_TTL', 60))
+MAX_FAILED_LOGINS = int(os.environ.get('AUTH_MAX_FAILED_LOGINS', 5))
+LOCKOUT_SECONDS = float(os.environ.get('AUTH_LOCKOUT_SECONDS', 300))
+
+SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS user_sessions (
+        token_hash CHAR(64) PRIMARY KEY,
+        username VARCHAR(255) NOT NULL,
+        created_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        expires_at DATETIME NOT NULL,
+        revoked_at DATETIME NULL,
+        KEY user_sessions_username (username)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS login_failures (
+        username VARCHAR(255) PRIMARY KEY,
+        failures INT NOT NULL,
+        window_start DATETIME NOT NULL
+    )
+    """,
+]
+
+
+class AuthBusy(Exception):
+    pass
+
+
+def ensure_schema(cursor):
+    for statement in SCHEMA:
+        cursor.execute(statement)
+
+
+# -- password hashing --------------------------------------------------------
+
+def _b64(raw):
+    return base64.b64encode(raw).decode('ascii').rstrip('=')
+
+
+def _unb64(text):
+    return base64.b64decode(text + '=' * (-len(text) % 4))
+
+
+def _pbkdf2(password, salt, iterations):
+    return hashlib.pbkdf2_hmac('sha256', password.encode('utf-8'), salt, iterations)
+
+
+def hash_password_sync(password, iterations=None):
+    iterations = iterations or HASH_ITERATIONS
+    salt = secrets.token_bytes(16)
+    return f"{HASH_ALGORITHM}${iterations}${_b64(salt)}${_b64(_pbkdf2(password, salt, iterations))}"
+
+
+def verify_password_sync(password, stored):
+    # Returns (matches, needs_rehash). Rows that still hold a plaintext
+    # password are accepted once and flagged so the caller upgrades them.
+    if stored is None:
+        # Unknown user: burn the same amount of time so usernames can't be probed.
+        _pbkdf2(password or '', b'\0' * 16, HASH_ITERATIONS)
+        return False, False
+    if not stored.startswith(HASH_ALGORITHM + '$'):
+        return hmac.compare_digest(stored.encode('utf-8'), (password or '').encode('utf-8')), True
+    try:
+        _, iterations, salt, expected = stored.split('$')
+        iterations = int(iterations)
+    except ValueError:
+        return False, False
+    actual = _pbkdf2(password or '', _unb64(salt), iterations)
+    return hmac.compare_digest(actual, _unb64(expected)), iterations != HASH_ITERATIONS
+
+
+_hash_pool = ThreadPoolExecutor(max_workers=HASH_WORKERS, thread_name_prefix='auth-hash')
+_hash_slots = threading.BoundedSemaphore(HASH_QUEUE)
+
+
+def _run_hashing(fn, *args):
+    # hashlib releases the GIL while hashing, so the pool runs in parallel.
+    if not _hash_slots.acquire(blocking=False):
+        raise AuthBusy()
+    try:
+        future = _hash_pool.submit(fn, *args)
+    except Exception:
+        _hash_slots.release()
+        raise
+    future.add_done_callback(lambda _: _hash_slots.release())
+    try:
+        return future.result(timeout=HASH_TIMEOUT)
+    except FutureTimeout:
+        raise AuthBusy()
+
+
+def hash_password(password):
+    return _run_hashing(hash_password_sync, password)
+
+
+def verify_password(password, stored):
+    return _run_hashing(verify_password_sync, password, stored)
+
+
+# -- failed login throttling (caller commits) --------------------------------
+
+def is_locked_out(cursor, username):
+    cursor.execute("""
+        SELECT failures FROM login_failures
+        WHERE username = %s AND window_start > NOW() - INTERVAL %s SECOND
+    """, (username, LOCKOUT_SECONDS))
+    row = cursor.fetchone()
+    return row is not None and row[0] >= MAX_FAILED_LOGINS
+
+
+def record_failure(cursor, username):
+    # Starts a new window if the last one has run out. Both assignments read
+    # the old window_start, so failures must be set first.
+    cursor.execute("""
+        INSERT INTO login_failures (username, failures, window_start) VALUES (%s, 1, NOW())
+        ON DUPLICATE KEY UPDATE
+            failures = IF(window_start > NOW() - INTERVAL %s SECOND, failures + 1, 1),
+            window_start = IF(window_start > NOW() - INTERVAL %s SECOND, window_start, NOW())
+    """, (username, LOCKOUT_SECONDS, LOCKOUT_SECONDS))
+
+
+def clear_failures(cursor, username):
+    cursor.execute("DELETE FROM login_failures WHERE username = %s", (username,))
+
+
+def purge_failures(cursor):
+    cursor.execute("DELETE FROM login_failures WHERE window_start <= NOW() - INTERVAL %s SECOND", (LOCKOUT_SECONDS,))
+    return cursor.rowcount
+
+
+# -- session tokens ----------------------------------------------------------
+
+class TokenCache:
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        self._entries = OrderedDict()  # token hash -> (username, cached until)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, token_hash):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(token_hash)
+            if entry is None or entry[1] < now:
+                self._entries.pop(token_hash, None)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(token_hash)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, token_hash, username, ttl=None):
+        with self._lock:
+            self._entries[token_hash] = (username, time.monotonic() + min(ttl or self.ttl, self.ttl))
+            self._entries.move_to_end(token_hash)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def discard(self, token_hash):
+        with self._lock:
+            self._entries.pop(token_hash, None)
+
+
+token_cache = TokenCache(TOKEN_CACHE_SIZE, TOKEN_CACHE_TTL)
+
+
+def _token_hash(token):
+    return hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+
+def create_session(cursor, username):
+    token = secrets.token_urlsafe(32)
+    token_hash = _token_hash(token)
+    cursor.execute(
+        "INSERT INTO user_sessions (token_hash, username, expires_at) VALUES (%s, %s, %s)",
+        (token_hash, username, datetime.now() + timedelta(seconds=SESSION_TTL))
+    )
+    token_cache.put(token_hash, username)
+    return token
+
+
+def session_username(token):
+    # Username the token belongs to, or None if it is unknown, expired or revoked.
+    if not token:
+        return None
+    token_hash = _token_hash(token)
+    username = token_cache.get(token_hash)
+    if username is not None:
+        return username
+
+    connection = get_db_connection()
+    cursor = connection.cursor()
+    cursor.execute("""
+        SELECT username, TIMESTAMPDIFF(SECOND, NOW(), expires_at) FROM user_sessions
+        WHERE token_hash = %s AND revoked_at IS NULL AND expires_at > NOW()
+    """, (token_hash,))
+    row = cursor.fetchone()
+    cursor.close()
+    connection.close()
+    if row is None:
+        return None
+    token_cache.put(token_hash, row[0], ttl=row[1])
+    return row[0]
+
+
+def revoke_session(cursor, token):
+    if not token:
+        return
+    token_hash = _token_hash(token)
+    token_cache.discard(token_hash)
+    cursor.execute("UPDATE user_sessions SET revoked_at = NOW() WHERE token_hash = %s", (token_hash,))
+
+
+def purge_expired_sessions(cursor):
+    cursor.execute("DELETE FROM user_sessions WHERE expires_at <= NOW() OR revoked_at IS NOT NULL")
+    return cursor.rowcount
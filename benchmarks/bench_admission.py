@@ -0,0 +1,83 @@
+# Rate limit overhead and accuracy: memory vs shared SQLite token buckets.
+#
+#   python -m benchmarks.bench_admission --processes 4 --requests 5000
+#
+# Each process spends tokens from the same small set of per-user and per-IP
+# buckets, the way workers behind serve.py would. Reports the latency of a
+# take() and how many requests were admitted against how many the limits
+# allow. The memory backend is per process, so with several processes it
+# admits several times too many; the sqlite backend holds the limit.
+# No database needed.
+import argparse
+import multiprocessing
+import os
+import tempfile
+import time
+
+from admission import MemoryBuckets, SQLiteBuckets
+from benchmarks.common import report, summarize
+
+
+def worker(backend, path, users, requests, rate, burst, ip_factor, results):
+    buckets = SQLiteBuckets(path) if backend == 'sqlite' else MemoryBuckets()
+    latencies = []
+    admitted = 0
+    for i in range(requests):
+        user = i % users
+        limits = [('search:ip:127.0.0.1', rate * ip_factor, burst * ip_factor), (f'search:user:{user}', rate, burst)]
+        started = time.perf_counter()
+        if buckets.take(limits) == 0:
+            admitted += 1
+        latencies.append(time.perf_counter() - started)
+    results.put((admitted, latencies))
+
+
+def run(backend, args):
+    path = os.path.join(tempfile.mkdtemp(), 'admission.sqlite3')
+    if backend == 'sqlite':
+        SQLiteBuckets(path)
+    results = multiprocessing.Queue()
+    started = time.perf_counter()
+    processes = [
+        multiprocessing.Process(target=worker, args=(
+            backend, path, args.users, args.requests, args.rate, args.burst, args.ip_factor, results
+        ))
+        for _ in range(args.processes)
+    ]
+    for process in processes:
+        process.start()
+    outcomes = [results.get() for _ in processes]
+    for process in processes:
+        process.join()
+    elapsed = time.perf_counter() - started
+
+    # Upper bound on what the limits allow in the time the run took.
+    allowed = min(
+        args.users * (args.burst + args.rate * elapsed),
+        args.burst * args.ip_factor + args.rate * args.ip_factor * elapsed,
+    )
+    summary = summarize([latency for _, latencies in outcomes for latency in latencies], elapsed)
+    summary['admitted'] = sum(admitted for admitted, _ in outcomes)
+    summary['allowed'] = int(allowed)
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Token bucket store overhead and accuracy')
+    parser.add_argument('--processes', type=int, default=4)
+    parser.add_argument('--requests', type=int, default=5000, help='per process')
+    parser.add_argument('--users', type=int, default=10)
+    parser.add_argument('--rate', type=float, default=2.0)
+    parser.add_argument('--burst', type=float, default=20)
+    parser.add_argument('--ip-factor', type=float, default=5.0)
+    args = parser.parse_args()
+
+    report({
+        'processes': args.processes,
+        'memory': run('memory', args),
+        'sqlite': run('sqlite', args),
+    })
+
+
+if __name__ == '__main__':
+    main()
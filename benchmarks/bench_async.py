@@ -0,0 +1,114 @@
+# Sync vs async serving of the notification poll, the same workload both ways.
+#
+#   python -m benchmarks.bench_async --concurrency 16 256 2048 --requests 5000
+#
+# Each of `concurrency` simulated clients polls back to back. In sync mode a
+# poll runs on a fixed pool of --threads worker threads (like a threaded WSGI
+# server) using the regular connection pool; in async mode it runs as a
+# coroutine on async_db's pool. Both pools get --db-connections connections,
+# so the difference is how many requests can wait for the database at once.
+# Latency is measured from when the client issued the request. Needs the
+# seeded bench users (benchmarks.seed) and aiomysql.
+import argparse
+import asyncio
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import async_db
+import notification_store
+from benchmarks.common import open_pool, report, summarize
+from benchmarks.seed import USER_PREFIX
+
+
+def sync_poll(pool, username):
+    connection = pool.acquire()
+    try:
+        cursor = connection.cursor(dictionary=True)
+        notification_store.since(cursor, username, 0)
+        notification_store.unread_count(cursor, username)
+        connection.commit()
+        cursor.close()
+    finally:
+        connection.close()
+
+
+async def async_poll(username):
+    async with async_db.cursor() as cur:
+        await async_db.notifications_since(cur, username, 0)
+        await async_db.unread_count(cur, username)
+
+
+async def drive(concurrency, requests, issue, users, seed):
+    latencies = []
+    errors = 0
+    per_client = max(1, requests // concurrency)
+
+    async def client(number):
+        nonlocal errors
+        rng = random.Random(seed + number)
+        for _ in range(per_client):
+            username = f'{USER_PREFIX}{rng.randrange(users)}'
+            started = time.perf_counter()
+            try:
+                await issue(username)
+            except Exception:
+                errors += 1
+                continue
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(client(i) for i in range(concurrency)))
+    result = summarize(latencies, time.perf_counter() - started)
+    result['errors'] = errors
+    return result
+
+
+async def run_sync(concurrency, args):
+    pool = open_pool(size=args.db_connections)
+    executor = ThreadPoolExecutor(max_workers=args.threads)
+    loop = asyncio.get_running_loop()
+
+    def issue(username):
+        return loop.run_in_executor(executor, sync_poll, pool, username)
+
+    try:
+        return await drive(concurrency, args.requests, issue, args.users, args.seed)
+    finally:
+        executor.shutdown()
+        pool.close_all()
+
+
+async def run_async(concurrency, args):
+    await async_db.init_pool(size=args.db_connections)
+    try:
+        return await drive(concurrency, args.requests, async_poll, args.users, args.seed)
+    finally:
+        await async_db.close_pool()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Sync vs async notification polling')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[16, 256, 2048])
+    parser.add_argument('--requests', type=int, default=5000, help='polls per run')
+    parser.add_argument('--threads', type=int, default=32, help='worker threads in sync mode')
+    parser.add_argument('--db-connections', type=int, default=20)
+    parser.add_argument('--users', type=int, default=10000, help='how many bench users were seeded')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    results = {}
+    for concurrency in args.concurrency:
+        results[str(concurrency)] = {
+            'sync': asyncio.run(run_sync(concurrency, args)),
+            'async': asyncio.run(run_async(concurrency, args)),
+        }
+    report({
+        'threads': args.threads,
+        'db_connections': args.db_connections,
+        'results': results,
+    })
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+# Compares the old payment() write path (one commit per statement, user id
+# resolved by subquery each time) with booking_service.checkout().
+#
+#   python -m benchmarks.bench_checkout --iterations 500
+import argparse
+
+import booking_service
+import pricing
+from notification_queue import notification_queue
+from benchmarks.common import CountingConnection, ensure_flight, ensure_user, open_pool, report, summarize, timed
+
+USERNAME = 'bench_checkout'
+
+
+def legacy_checkout(connection, username, flight, passenger_name, payment_method, points_to_redeem=0):
+    cursor = connection.cursor(dictionary=True)
+    cursor.execute("""
+        SELECT points, total_points_left FROM loyalty_points
+        WHERE user_id = (SELECT id FROM users WHERE username = %s)
+    """, (username,))
+    loyalty_points = cursor.fetchone()
+
+    discount, final_price, earned = pricing.with_points(flight['price'], points_to_redeem)
+    cursor.execute(
+        """
+        INSERT INTO bookings (flight_id, username, passenger_name, booking_date, payment_status, final_price)
+        VALUES (%s, %s, %s, NOW(), %s, %s)
+        """,
+        (flight['id'], username, passenger_name, 'confirmed', final_price)
+    )
+    connection.commit()
+    booking_id = cursor.lastrowid
+    cursor.execute(
+        """
+        INSERT INTO transactions (booking_id, username, amount, transaction_type, status, payment_method, discount_applied)
+        VALUES (%s, %s, %s, %s, %s, %s, %s)
+        """,
+        (booking_id, username, final_price, 'payment', 'success', payment_method, discount)
+    )
+    connection.commit()
+    if loyalty_points:
+        cursor.execute("""
+            UPDATE loyalty_points
+            SET points = points + %s, total_points_left = total_points_left - %s + %s
+            WHERE user_id = (SELECT id FROM users WHERE username = %s)
+        """, (earned, points_to_redeem, earned, username))
+    else:
+        cursor.execute("""
+            INSERT INTO loyalty_points (user_id, points, total_points_left)
+            VALUES ((SELECT id FROM users WHERE username = %s), %s, %s)
+        """, (username, earned, earned - points_to_redeem))
+    connection.commit()
+    for message in ("Booking confirmed!", "You earned points."):
+        cursor.execute("INSERT INTO notifications (username, message) VALUES (%s, %s)", (username, message))
+        connection.commit()
+    cursor.close()
+
+
+def run(name, checkout, pool, flight, iterations):
+    latencies = []
+    commits = statements = 0
+    for i in range(iterations):
+        connection = pool.acquire()
+        counting = CountingConnection(connection)
+        elapsed, _ = timed(checkout, counting, USERNAME, flight, f'Bench Passenger {i}', 'credit_card')
+        connection.close()
+        latencies.append(elapsed)
+        commits += counting.commits
+        statements += counting.statements
+    result = summarize(latencies, sum(latencies))
+    result['commits_per_checkout'] = commits / iterations
+    result['statements_per_checkout'] = statements / iterations
+    return name, result
+
+
+def cleanup(pool):
+    notification_queue.flush()
+    connection = pool.acquire()
+    cursor = connection.cursor()
+    cursor.execute("DELETE FROM transactions WHERE username = %s", (USERNAME,))
+    cursor.execute("DELETE FROM bookings WHERE username = %s", (USERNAME,))
+    cursor.execute("DELETE FROM notifications WHERE username = %s", (USERNAME,))
+    connection.commit()
+    cursor.close()
+    connection.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark legacy vs transactional checkout')
+    parser.add_argument('--iterations', type=int, default=200)
+    args = parser.parse_args()
+
+    pool = open_pool()
+    connection = pool.acquire()
+    cursor = connection.cursor()
+    ensure_user(cursor, USERNAME)
+    flight_id = ensure_flight(cursor, 'BENCH001')
+    connection.commit()
+    cursor.close()
+    cursor = connection.cursor(dictionary=True)
+    cursor.execute("SELECT * FROM flights WHERE id = %s", (flight_id,))
+    flight = cursor.fetchone()
+    cursor.close()
+    connection.close()
+
+    try:
+        results = dict([
+            run('legacy', legacy_checkout, pool, flight, args.iterations),
+            run('booking_service', booking_service.checkout, pool, flight, args.iterations),
+        ])
+    finally:
+        cleanup(pool)
+    report(results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+# Login throughput at different password hash costs.
+#
+#   python -m benchmarks.bench_login --costs 50000 100000 200000 --concurrency 8
+#
+# Only the hashing path is measured (auth.verify_password on the bounded hash
+# pool), so this runs without a database.
+import argparse
+import threading
+import time
+
+import auth
+from benchmarks.common import report, summarize
+
+
+def run(cost, concurrency, logins):
+    stored = auth.hash_password_sync('correct horse battery staple', iterations=cost)
+    latencies = []
+    busy = 0
+    lock = threading.Lock()
+
+    def client(count):
+        nonlocal busy
+        mine = []
+        rejected = 0
+        for _ in range(count):
+            started = time.perf_counter()
+            try:
+                auth.verify_password('correct horse battery staple', stored)
+            except auth.AuthBusy:
+                rejected += 1
+                continue
+            mine.append(time.perf_counter() - started)
+        with lock:
+            latencies.extend(mine)
+            busy += rejected
+
+    per_client = max(1, logins // concurrency)
+    threads = [threading.Thread(target=client, args=(per_client,)) for _ in range(concurrency)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    result = summarize(latencies, elapsed)
+    result['rejected_busy'] = busy
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Login throughput by hash cost')
+    parser.add_argument('--costs', type=int, nargs='+', default=[50000, 100000, 200000, 400000])
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--logins', type=int, default=200)
+    args = parser.parse_args()
+
+    report({
+        'hash_workers': auth.HASH_WORKERS,
+        'concurrency': args.concurrency,
+        'results': {str(cost): run(cost, args.concurrency, args.logins) for cost in args.costs},
+    })
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+# Pricing a page of search results: per-row Python vs the fare table.
+#
+#   python -m benchmarks.bench_pricing --flights 100000 --page 300 --pages 500
+#
+# Uses the synthetic schedule from bench_route_search with random load
+# factors, so this runs without a database. "per_row" prices each flight
+# with pricing.seat_fare(); "fare_table" is one FareTable.fares() lookup for
+# the whole page (vectorised when NumPy is installed).
+import argparse
+import random
+import time
+
+import pricing
+from benchmarks.bench_route_search import synthetic_flights
+from benchmarks.common import report, summarize, timed
+
+
+def run(price_page, pages):
+    latencies = []
+    for page in pages:
+        started = time.perf_counter()
+        price_page(page)
+        latencies.append(time.perf_counter() - started)
+    return summarize(latencies, sum(latencies))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Fare table vs per-row pricing')
+    parser.add_argument('--flights', type=int, default=100_000)
+    parser.add_argument('--page', type=int, default=300, help='flights per search result page')
+    parser.add_argument('--pages', type=int, default=500)
+    parser.add_argument('--passengers', type=int, default=2)
+    parser.add_argument('--class-type', choices=pricing.CLASSES, default='business')
+    parser.add_argument('--seed', type=int, default=7)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    flights = synthetic_flights(args.flights, rng)
+    loads = {flight['id']: rng.random() for flight in flights}
+    pages = [rng.sample(flights, args.page) for _ in range(args.pages)]
+
+    table = pricing.FareTable(connect=None, ttl=float('inf'))
+    build_seconds, _ = timed(table.load, flights, loads)
+
+    def per_row(page):
+        return [
+            round(pricing.seat_fare(flight['price'], args.class_type, loads[flight['id']]) * args.passengers, 2)
+            for flight in page
+        ]
+
+    def fare_table(page):
+        return table.fares(page, args.class_type, args.passengers)
+
+    report({
+        'flights': args.flights,
+        'page': args.page,
+        'numpy': pricing.np is not None,
+        'build_ms': build_seconds * 1000,
+        'per_row': run(per_row, pages),
+        'fare_table': run(fare_table, pages),
+    })
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+# Route search latency on a synthetic schedule.
+#
+#   python -m benchmarks.bench_route_search --flights 100000 --queries 500
+#
+# Builds the same kind of network benchmarks.seed writes to the database
+# (random routes between its airports over the next 180 days), but in memory,
+# so this runs without a database. Reports graph build time and per-query
+# latency for one-way and round-trip searches.
+import argparse
+import random
+import time
+from datetime import date, timedelta
+
+import route_search
+from benchmarks.common import report, summarize, timed
+from benchmarks.seed import AIRPORTS
+
+DAYS = 180
+
+
+def synthetic_flights(count, rng):
+    start = date.today()
+    flights = []
+    for i in range(count):
+        source, destination = rng.sample(AIRPORTS, 2)
+        hour = rng.randrange(0, 24)
+        minutes = rng.choice((0, 15, 30, 45))
+        length = rng.randrange(60, 14 * 60, 5)
+        arrival = (hour * 60 + minutes + length) % (24 * 60)
+        flights.append({
+            'id': i + 1,
+            'flight_number': f'SY{i:06d}',
+            'source': source,
+            'destination': destination,
+            'departure_date': start + timedelta(days=rng.randrange(0, DAYS)),
+            'departure_time': timedelta(hours=hour, minutes=minutes),
+            'arrival_time': timedelta(minutes=arrival),
+            'price': rng.randrange(80, 1500),
+        })
+    return flights
+
+
+def run(graph, queries, rng, round_trip, options):
+    latencies = []
+    found = 0
+    for _ in range(queries):
+        origin, destination = rng.sample(AIRPORTS, 2)
+        outbound = date.today() + timedelta(days=rng.randrange(0, DAYS - 14))
+        started = time.perf_counter()
+        if round_trip:
+            back = outbound + timedelta(days=rng.randrange(1, 14))
+            results = route_search.round_trip(graph, origin, destination, outbound, back, **options)
+        else:
+            results = graph.search(origin, destination, outbound, **options)
+        latencies.append(time.perf_counter() - started)
+        found += bool(results)
+    summary = summarize(latencies, sum(latencies))
+    summary['queries_with_results'] = found
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Route search latency on a synthetic network')
+    parser.add_argument('--flights', type=int, default=100_000)
+    parser.add_argument('--queries', type=int, default=500)
+    parser.add_argument('--max-stops', type=int, default=2)
+    parser.add_argument('--limit', type=int, default=10)
+    parser.add_argument('--sort', choices=('price', 'duration'), default='price')
+    parser.add_argument('--seed', type=int, default=7)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    flights = synthetic_flights(args.flights, rng)
+    build_seconds, graph = timed(route_search.RouteGraph, flights)
+    options = {'max_stops': args.max_stops, 'limit': args.limit, 'sort': args.sort}
+
+    report({
+        'flights': args.flights,
+        'airports': len(AIRPORTS),
+        'build_ms': build_seconds * 1000,
+        'options': options,
+        'one_way': run(graph, args.queries, rng, False, options),
+        'round_trip': run(graph, args.queries, rng, True, options),
+    })
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+# Cold start: how long from launching a server to its first good response.
+#
+#   python -m benchmarks.bench_startup --runs 5 --workers 4
+#
+# Starts `python serve.py` (or `flask run` with --dev, for comparison) on a
+# free port, polls /login until it answers 200, then measures a few more
+# requests so first-request latency can be told apart from steady state.
+# The server is stopped with SIGTERM after each run. Needs the database the
+# DB_* variables point at, since serve.py warms up against it.
+import argparse
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+
+from benchmarks.common import report, summarize
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def fetch(url):
+    started = time.perf_counter()
+    with urllib.request.urlopen(url, timeout=5) as response:
+        response.read()
+        return response.status, time.perf_counter() - started
+
+
+def command(args, port):
+    if args.dev:
+        return [sys.executable, '-m', 'flask', '--app', 'app', 'run', '--port', str(port)]
+    return [sys.executable, 'serve.py', '--bind', f'127.0.0.1:{port}', '--workers', str(args.workers)]
+
+
+def cold_start(args):
+    port = free_port()
+    url = f'http://127.0.0.1:{port}/login'
+    started = time.perf_counter()
+    process = subprocess.Popen(command(args, port), cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        deadline = started + args.timeout
+        while True:
+            if process.poll() is not None:
+                raise RuntimeError(f"server exited with status {process.returncode}")
+            if time.perf_counter() > deadline:
+                raise RuntimeError(f"server not ready after {args.timeout} s")
+            try:
+                status, first_latency = fetch(url)
+                if status == 200:
+                    break
+            except (urllib.error.URLError, ConnectionError, socket.timeout):
+                time.sleep(0.01)
+        ready = time.perf_counter() - started
+        warm = [fetch(url)[1] for _ in range(args.requests)]
+        return ready, first_latency, warm
+    finally:
+        process.send_signal(signal.SIGTERM)
+        try:
+            process.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Cold start to first request')
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--requests', type=int, default=50, help='requests after the first, per run')
+    parser.add_argument('--timeout', type=float, default=60.0)
+    parser.add_argument('--dev', action='store_true', help='measure the Flask development server instead')
+    args = parser.parse_args()
+
+    ready, first, warm = [], [], []
+    for _ in range(args.runs):
+        run_ready, run_first, run_warm = cold_start(args)
+        ready.append(run_ready)
+        first.append(run_first)
+        warm.extend(run_warm)
+
+    report({
+        'server': 'flask run' if args.dev else f'serve.py ({args.workers} workers)',
+        'cold_start': summarize(ready),
+        'first_request': summarize(first),
+        'warm_requests': summarize(warm),
+    })
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+# Helpers shared by the benchmark scripts. Run them from the repo root, e.g.
+#   python -m benchmarks.bench_checkout --iterations 500
+# They talk to the database configured through the usual DB_* variables.
+import json
+import math
+import sys
+import time
+
+from db_connection import configure_pool
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    rank = max(0, math.ceil(pct / 100.0 * len(sorted_values)) - 1)
+    return sorted_values[rank]
+
+
+def summarize(latencies, elapsed=None):
+    values = sorted(latencies)
+    summary = {
+        'count': len(values),
+        'mean_ms': (sum(values) / len(values) * 1000) if values else 0.0,
+        'p50_ms': percentile(values, 50) * 1000,
+        'p95_ms': percentile(values, 95) * 1000,
+        'p99_ms': percentile(values, 99) * 1000,
+        'max_ms': (values[-1] * 1000) if values else 0.0,
+    }
+    if elapsed:
+        summary['throughput_per_s'] = len(values) / elapsed
+    return summary
+
+
+def timed(fn, *args, **kwargs):
+    started = time.perf_counter()
+    result = fn(*args, **kwargs)
+    return time.perf_counter() - started, result
+
+
+class CountingConnection:
+    # Wraps a connection and counts commits and executed statements.
+
+    def __init__(self, connection):
+        self._connection = connection
+        self.commits = 0
+        self.statements = 0
+
+    def cursor(self, *args, **kwargs):
+        return _CountingCursor(self, self._connection.cursor(*args, **kwargs))
+
+    def commit(self):
+        self.commits += 1
+        self._connection.commit()
+
+    def __getattr__(self, name):
+        return getattr(self._connection, name)
+
+
+class _CountingCursor:
+    def __init__(self, owner, cursor):
+        self._owner = owner
+        self._cursor = cursor
+
+    def execute(self, *args, **kwargs):
+        self._owner.statements += 1
+        return self._cursor.execute(*args, **kwargs)
+
+    def executemany(self, *args, **kwargs):
+        self._owner.statements += 1
+        return self._cursor.executemany(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+def open_pool(size=10):
+    return configure_pool({'DB_POOL_SIZE': size})
+
+
+def ensure_user(cursor, username, password='bench'):
+    cursor.execute("SELECT id FROM users WHERE username = %s", (username,))
+    row = cursor.fetchone()
+    if row:
+        return row[0] if not isinstance(row, dict) else row['id']
+    cursor.execute("INSERT INTO users (username, password) VALUES (%s, %s)", (username, password))
+    return cursor.lastrowid
+
+
+def ensure_flight(cursor, flight_number, source='BENCH-A', destination='BENCH-B', price=250):
+    cursor.execute("SELECT id FROM flights WHERE flight_number = %s", (flight_number,))
+    row = cursor.fetchone()
+    if row:
+        return row[0] if not isinstance(row, dict) else row['id']
+    cursor.execute(
+        """
+        INSERT INTO flights (flight_number, source, destination, departure_date, departure_time, arrival_time, price)
+        VALUES (%s, %s, %s, CURDATE() + INTERVAL 30 DAY, '08:00:00', '10:00:00', %s)
+        """,
+        (flight_number, source, destination, price)
+    )
+    return cursor.lastrowid
+
+
+def report(results):
+    json.dump(results, sys.stdout, indent=2, default=str)
+    sys.stdout.write('\n')
@@ -0,0 +1,228 @@
+# Drives the real routes through the whole booking funnel:
+#
+#   login -> /flight-selection -> /payment (GET, POST) -> /bookings
+#         -> /cancel-booking -> /request_refund
+#
+# Each virtual user logs in as one of the seeded bench users (see
+# benchmarks.seed) and repeats the funnel. By default requests go through
+# Flask's test client in this process, with admission control off (set
+# ADMISSION_ENABLED=1 to measure it too); pass --url to hit a running server,
+# started with ADMISSION_ENABLED=0 unless the rate limits are what's being
+# tested, since every virtual user comes from this machine's address.
+#
+#   python -m benchmarks.funnel --users 32 --iterations 10 --output run.json
+#   python -m benchmarks.funnel --url http://127.0.0.1:5000 --baseline run.json
+#
+# Prints per-step throughput and latency percentiles as JSON. With
+# --baseline, exits non-zero if any step's p99 or throughput regressed by
+# more than --tolerance.
+import argparse
+import http.cookiejar
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+from benchmarks.common import report, summarize
+from db_connection import create_pool
+from benchmarks.seed import PASSWORD, USER_PREFIX
+
+STEPS = ('login', 'flight_selection', 'payment_form', 'payment_submit', 'bookings', 'cancel_booking', 'request_refund')
+CANCEL_LINK = re.compile(r'/cancel-booking/(\d+)')
+
+
+class TestClient:
+    def __init__(self, app):
+        self._client = app.test_client()
+
+    def get(self, path):
+        response = self._client.get(path)
+        return response.status_code, response.get_data(as_text=True)
+
+    def post(self, path, data=None):
+        response = self._client.post(path, data=data or {})
+        return response.status_code, response.get_data(as_text=True)
+
+
+class _NoRedirect(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+class HttpClient:
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip('/')
+        self._opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()), _NoRedirect()
+        )
+
+    def _open(self, request):
+        try:
+            with self._opener.open(request, timeout=30) as response:
+                return response.status, response.read().decode('utf-8', 'replace')
+        except urllib.error.HTTPError as error:
+            return error.code, error.read().decode('utf-8', 'replace')
+
+    def get(self, path):
+        return self._open(urllib.request.Request(self.base_url + path))
+
+    def post(self, path, data=None):
+        body = urllib.parse.urlencode(data or {}).encode('ascii')
+        return self._open(urllib.request.Request(self.base_url + path, data=body, method='POST'))
+
+
+class Recorder:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = {step: [] for step in STEPS}
+        self.errors = {step: 0 for step in STEPS}
+        self.rate_limited = {step: 0 for step in STEPS}
+
+    def timed(self, step, call, *args):
+        started = time.perf_counter()
+        status, body = call(*args)
+        elapsed = time.perf_counter() - started
+        with self._lock:
+            self.latencies[step].append(elapsed)
+            if status >= 400:
+                self.errors[step] += 1
+            if status == 429:
+                self.rate_limited[step] += 1
+        return status, body
+
+
+def sample_flights(limit=2000):
+    # A pool of its own: replacing the process-wide one would leave the app
+    # (in-process mode) with a single connection for every virtual user.
+    pool = create_pool({'DB_POOL_SIZE': 1})
+    connection = pool.acquire()
+    cursor = connection.cursor(dictionary=True)
+    cursor.execute("""
+        SELECT id, source, destination FROM flights
+        WHERE departure_date >= CURDATE()
+        ORDER BY RAND() LIMIT %s
+    """, (limit,))
+    flights = cursor.fetchall()
+    cursor.close()
+    connection.close()
+    pool.close_all()
+    return flights
+
+
+def virtual_user(make_client, user_number, flights, iterations, recorder, rng):
+    client = make_client()
+    username = f'{USER_PREFIX}{user_number}'
+    recorder.timed('login', client.post, '/login', {'username': username, 'password': PASSWORD})
+
+    for i in range(iterations):
+        flight = rng.choice(flights)
+        query = urllib.parse.urlencode({'origin': flight['source'], 'destination': flight['destination']})
+        recorder.timed('flight_selection', client.get, f'/flight-selection?{query}')
+        recorder.timed('payment_form', client.get, f"/payment?flight_id={flight['id']}")
+        recorder.timed('payment_submit', client.post, f"/payment?flight_id={flight['id']}", {
+            'passenger_name': f'{username} trip {i}',
+            'payment_method': 'credit_card',
+            'points_to_redeem': '0',
+        })
+        _, page = recorder.timed('bookings', client.get, '/bookings')
+
+        booking_ids = [int(match) for match in CANCEL_LINK.findall(page)]
+        if booking_ids:
+            booking_id = max(booking_ids)
+            recorder.timed('cancel_booking', client.post, f'/cancel-booking/{booking_id}')
+            recorder.timed('request_refund', client.post, f'/request_refund/{booking_id}')
+
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    for step, current in results['steps'].items():
+        previous = baseline.get('steps', {}).get(step)
+        if not previous or not current['count']:
+            continue
+        if current['p99_ms'] > previous['p99_ms'] * (1 + tolerance):
+            regressions.append(f"{step}: p99 {previous['p99_ms']:.1f}ms -> {current['p99_ms']:.1f}ms")
+        if current['throughput_per_s'] < previous['throughput_per_s'] * (1 - tolerance):
+            regressions.append(f"{step}: throughput {previous['throughput_per_s']:.1f}/s -> {current['throughput_per_s']:.1f}/s")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Booking funnel load test')
+    parser.add_argument('--users', type=int, default=16, help='concurrent virtual users')
+    parser.add_argument('--iterations', type=int, default=5, help='funnel runs per user')
+    parser.add_argument('--seeded-users', type=int, default=10000, help='how many bench users were seeded')
+    parser.add_argument('--url', help='base URL of a running server (default: in-process test client)')
+    parser.add_argument('--output', help='also write the results to this file')
+    parser.add_argument('--baseline', help='results file from an earlier run to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    if args.url:
+        def make_client():
+            return HttpClient(args.url)
+    else:
+        # All in-process requests come from 127.0.0.1, so the per-IP limits
+        # would turn most of the funnel into 429s
+        os.environ.setdefault('ADMISSION_ENABLED', '0')
+        from app import app
+        app.config['RENDER_CACHE'] = True
+
+        def make_client():
+            return TestClient(app)
+
+    flights = sample_flights()
+    if not flights:
+        sys.exit('No upcoming flights found; run python -m benchmarks.seed first.')
+
+    recorder = Recorder()
+    picks = random.Random(args.seed).sample(range(args.seeded_users), args.users)
+    threads = [
+        threading.Thread(target=virtual_user, args=(make_client, user, flights, args.iterations, recorder, random.Random(user)))
+        for user in picks
+    ]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    results = {
+        'config': {
+            'users': args.users,
+            'iterations': args.iterations,
+            'target': args.url or 'in-process',
+            'elapsed_s': elapsed,
+        },
+        'steps': {},
+    }
+    for step in STEPS:
+        summary = summarize(recorder.latencies[step], elapsed)
+        summary.setdefault('throughput_per_s', 0.0)
+        summary['errors'] = recorder.errors[step]
+        summary['rate_limited'] = recorder.rate_limited[step]
+        results['steps'][step] = summary
+    if any(recorder.rate_limited.values()):
+        print('Warning: some requests were rate limited (429); the results include admission control.', file=sys.stderr)
+
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as handle:
+            results['regressions'] = compare(results, json.load(handle), args.tolerance)
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as handle:
+            json.dump(results, handle, indent=2, default=str)
+    report(results)
+    if results.get('regressions'):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,196 @@
+# Seeds the configured database with benchmark-sized data.
+#
+#   python -m benchmarks.seed --scale 1.0
+#
+# At scale 1.0 that is 100k flights, 10k users, 1M bookings (each with a
+# payment transaction) and 3M notifications. Everything is inserted in large
+# multi-row batches with a commit per batch. Rows are tagged with a 'bench_'
+# username / 'BN' flight number prefix so --reset can remove them again.
+import argparse
+import random
+import sys
+import time
+from datetime import date, timedelta
+
+import auth
+from benchmarks.common import open_pool
+
+AIRPORTS = [
+    'Karachi', 'Lahore', 'Islamabad', 'Dubai', 'Doha', 'Riyadh', 'Jeddah', 'London',
+    'Paris', 'Rome', 'New York', 'Toronto', 'Tokyo', 'Singapore', 'Bangkok', 'Hong Kong',
+    'Istanbul', 'Frankfurt', 'Amsterdam', 'Kuala Lumpur', 'Beijing', 'Sydney', 'Cairo', 'Madrid',
+]
+USER_PREFIX = 'bench_user_'
+FLIGHT_PREFIX = 'BN'
+PASSWORD = 'benchpass'
+BATCH = 5000
+
+BASE = {'flights': 100_000, 'users': 10_000, 'bookings': 1_000_000, 'notifications_per_booking': 3}
+
+
+def _batches(rows, size=BATCH):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _insert(connection, sql, rows, label):
+    cursor = connection.cursor()
+    started = time.perf_counter()
+    total = 0
+    for batch in _batches(rows):
+        cursor.executemany(sql, batch)
+        connection.commit()
+        total += len(batch)
+        if total % (BATCH * 20) == 0:
+            rate = total / (time.perf_counter() - started)
+            print(f"  {label}: {total:,} rows ({rate:,.0f}/s)", file=sys.stderr)
+    cursor.close()
+    print(f"  {label}: {total:,} rows in {time.perf_counter() - started:.1f}s", file=sys.stderr)
+    return total
+
+
+def seed_users(connection, count):
+    # One hash shared by every bench user keeps seeding fast; logins still
+    # pay the full verification cost.
+    password_hash = auth.hash_password_sync(PASSWORD)
+    rows = ((f'{USER_PREFIX}{i}', password_hash) for i in range(count))
+    return _insert(connection, "INSERT IGNORE INTO users (username, password) VALUES (%s, %s)", rows, 'users')
+
+
+def seed_flights(connection, count, rng):
+    start = date.today()
+
+    def rows():
+        for i in range(count):
+            source, destination = rng.sample(AIRPORTS, 2)
+            departure = start + timedelta(days=rng.randrange(0, 180))
+            hour = rng.randrange(0, 24)
+            minutes = rng.choice((0, 15, 30, 45))
+            length = rng.randrange(60, 14 * 60, 5)
+            arrival = (hour * 60 + minutes + length) % (24 * 60)
+            yield (
+                f'{FLIGHT_PREFIX}{i:06d}', source, destination, departure,
+                f'{hour:02d}:{minutes:02d}:00', f'{arrival // 60:02d}:{arrival % 60:02d}:00',
+                f'{length // 60}h {length % 60}m', rng.randrange(80, 1500),
+            )
+
+    return _insert(connection, """
+        INSERT INTO flights (flight_number, source, destination, departure_date, departure_time, arrival_time, duration, price)
+        VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+    """, rows(), 'flights')
+
+
+def _id_range(connection, query):
+    cursor = connection.cursor()
+    cursor.execute(query)
+    low, high = cursor.fetchone()
+    cursor.close()
+    return low, high
+
+
+def seed_bookings(connection, count, users, rng):
+    low, high = _id_range(connection, f"SELECT MIN(id), MAX(id) FROM flights WHERE flight_number LIKE '{FLIGHT_PREFIX}%'")
+
+    def rows():
+        for i in range(count):
+            cancelled = rng.random() < 0.05
+            yield (
+                rng.randint(low, high), f'{USER_PREFIX}{rng.randrange(users)}', f'Passenger {i}',
+                'confirmed', rng.randrange(80, 1500),
+                'cancelled' if cancelled else 'confirmed',
+                'NONE',
+            )
+
+    cursor = connection.cursor()
+    cursor.execute("SELECT COALESCE(MAX(id), 0) FROM bookings")
+    before = cursor.fetchone()[0]
+    cursor.close()
+
+    total = _insert(connection, """
+        INSERT INTO bookings (flight_id, username, passenger_name, booking_date, payment_status, final_price, status, refund_status)
+        VALUES (%s, %s, %s, NOW() - INTERVAL FLOOR(RAND() * 365) DAY, %s, %s, %s, %s)
+    """, rows(), 'bookings')
+
+    # One payment transaction per new booking, generated set-based in id ranges.
+    cursor = connection.cursor()
+    started = time.perf_counter()
+    _, after = _id_range(connection, "SELECT MIN(id), MAX(id) FROM bookings")
+    step = BATCH * 10
+    for start in range(before + 1, (after or 0) + 1, step):
+        cursor.execute("""
+            INSERT INTO transactions (booking_id, username, amount, transaction_type, status, payment_method, discount_applied, transaction_date)
+            SELECT id, username, final_price, 'payment', 'success', 'credit_card', 0, booking_date
+            FROM bookings WHERE id BETWEEN %s AND %s
+        """, (start, start + step - 1))
+        connection.commit()
+    cursor.close()
+    print(f"  transactions: done in {time.perf_counter() - started:.1f}s", file=sys.stderr)
+    return total
+
+
+def seed_notifications(connection, count, users, rng):
+    messages = [
+        'Booking confirmed! Enjoy your trip.',
+        'You earned loyalty points for this booking.',
+        'Your flight schedule has changed.',
+        'Check-in is now open for your flight.',
+    ]
+    rows = (
+        (f'{USER_PREFIX}{rng.randrange(users)}', rng.choice(messages), rng.random() < 0.7, rng.randrange(0, 365 * 24 * 3600))
+        for _ in range(count)
+    )
+    return _insert(connection, """
+        INSERT INTO notifications (username, message, is_read, created_at)
+        VALUES (%s, %s, %s, NOW() - INTERVAL %s SECOND)
+    """, rows, 'notifications')
+
+
+def reset(connection):
+    cursor = connection.cursor()
+    like_user = f'{USER_PREFIX}%'
+    for statement in (
+        "DELETE FROM notifications WHERE username LIKE %s",
+        "DELETE FROM transactions WHERE username LIKE %s",
+        "DELETE FROM bookings WHERE username LIKE %s",
+        "DELETE FROM users WHERE username LIKE %s",
+    ):
+        cursor.execute(statement, (like_user,))
+        connection.commit()
+    cursor.execute("DELETE FROM flights WHERE flight_number LIKE %s", (f'{FLIGHT_PREFIX}%',))
+    connection.commit()
+    cursor.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Seed the database with benchmark data')
+    parser.add_argument('--scale', type=float, default=1.0, help='1.0 = 100k flights / 1M bookings')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--reset', action='store_true', help='remove previously seeded rows first')
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    counts = {key: max(1, int(value * args.scale)) for key, value in BASE.items() if key != 'notifications_per_booking'}
+
+    pool = open_pool(size=2)
+    connection = pool.acquire()
+    try:
+        if args.reset:
+            print("Removing previous benchmark data", file=sys.stderr)
+            reset(connection)
+        print(f"Seeding {counts}", file=sys.stderr)
+        seed_users(connection, counts['users'])
+        seed_flights(connection, counts['flights'], rng)
+        seed_bookings(connection, counts['bookings'], counts['users'], rng)
+        seed_notifications(connection, counts['bookings'] * BASE['notifications_per_booking'], counts['users'], rng)
+    finally:
+        connection.close()
+
+
+if __name__ == '__main__':
+    main()
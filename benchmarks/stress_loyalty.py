@@ -0,0 +1,110 @@
+# Many threads try to spend the same user's loyalty points at once; checks
+# that points are never double-spent and the ledger matches the balance.
+#
+#   python -m benchmarks.stress_loyalty --threads 32 --balance 1000 --redeem 50
+#
+# Exits non-zero on a double spend or a ledger/balance mismatch.
+import argparse
+import sys
+import threading
+import time
+
+import loyalty
+from benchmarks.common import ensure_user, open_pool, report
+
+USERNAME = 'stress_loyalty'
+
+
+def setup(pool, balance):
+    connection = pool.acquire()
+    cursor = connection.cursor()
+    loyalty.ensure_schema(cursor)
+    user_id = ensure_user(cursor, USERNAME)
+    cursor.execute("DELETE FROM loyalty_ledger WHERE user_id = %s", (user_id,))
+    cursor.execute("DELETE FROM loyalty_points WHERE user_id = %s", (user_id,))
+    loyalty.earn(cursor, user_id, balance, reason='stress_seed')
+    connection.commit()
+    cursor.close()
+    connection.close()
+    return user_id
+
+
+def spender(pool, user_id, points, attempts, counts, lock):
+    spent = refused = 0
+    for _ in range(attempts):
+        connection = pool.acquire()
+        cursor = connection.cursor()
+        try:
+            loyalty.redeem(cursor, user_id, points, reason='stress')
+            connection.commit()
+            spent += 1
+        except loyalty.InsufficientPoints:
+            connection.rollback()
+            refused += 1
+        finally:
+            cursor.close()
+            connection.close()
+    with lock:
+        counts['spent'] += spent
+        counts['refused'] += refused
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Concurrent loyalty redemption stress test')
+    parser.add_argument('--threads', type=int, default=32)
+    parser.add_argument('--attempts', type=int, default=10, help='redemptions per thread')
+    parser.add_argument('--balance', type=int, default=1000)
+    parser.add_argument('--redeem', type=int, default=50)
+    args = parser.parse_args()
+
+    pool = open_pool(size=args.threads)
+    user_id = setup(pool, args.balance)
+
+    counts = {'spent': 0, 'refused': 0}
+    lock = threading.Lock()
+    threads = [
+        threading.Thread(target=spender, args=(pool, user_id, args.redeem, args.attempts, counts, lock))
+        for _ in range(args.threads)
+    ]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    connection = pool.acquire()
+    cursor = connection.cursor()
+    cursor.execute("SELECT total_points_left FROM loyalty_points WHERE user_id = %s", (user_id,))
+    left = cursor.fetchone()[0]
+    cursor.execute("SELECT SUM(delta) FROM loyalty_ledger WHERE user_id = %s", (user_id,))
+    ledger_total = int(cursor.fetchone()[0])
+    cursor.close()
+    connection.close()
+
+    expected_spends = args.balance // args.redeem
+    consistent = (
+        counts['spent'] == expected_spends
+        and left == args.balance - counts['spent'] * args.redeem
+        and ledger_total == left
+    )
+    report({
+        'threads': args.threads,
+        'attempts': args.threads * args.attempts,
+        'starting_balance': args.balance,
+        'redeem_each': args.redeem,
+        'spent': counts['spent'],
+        'refused': counts['refused'],
+        'points_left': left,
+        'ledger_total': ledger_total,
+        'elapsed_s': elapsed,
+        'redemptions_per_s': (args.threads * args.attempts) / elapsed if elapsed else 0.0,
+        'double_spend': left < 0 or counts['spent'] > expected_spends,
+        'consistent': consistent,
+    })
+    if not consistent:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
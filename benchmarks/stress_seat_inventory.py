@@ -0,0 +1,110 @@
+# Fires many concurrent checkouts at one flight and checks it never oversells.
+#
+#   python -m benchmarks.stress_seat_inventory --threads 32 --attempts 20 --capacity 150
+#
+# Exits non-zero if more seats were sold than the flight has.
+import argparse
+import sys
+import threading
+import time
+
+import booking_service
+import seat_inventory
+from benchmarks.common import ensure_flight, ensure_user, open_pool, report
+
+FLIGHT_NUMBER = 'STRESS001'
+USER_PREFIX = 'stress_seat_'
+
+
+def setup(pool, threads, capacity):
+    connection = pool.acquire()
+    cursor = connection.cursor(dictionary=True)
+    seat_inventory.ensure_schema(cursor)
+    flight_id = ensure_flight(cursor, FLIGHT_NUMBER)
+    for i in range(threads):
+        ensure_user(cursor, f'{USER_PREFIX}{i}')
+    cursor.execute("DELETE FROM bookings WHERE flight_id = %s", (flight_id,))
+    cursor.execute("DELETE FROM seat_holds WHERE flight_id = %s", (flight_id,))
+    cursor.execute("""
+        REPLACE INTO seat_inventory (flight_id, capacity, available) VALUES (%s, %s, %s)
+    """, (flight_id, capacity, capacity))
+    connection.commit()
+    cursor.execute("SELECT * FROM flights WHERE id = %s", (flight_id,))
+    flight = cursor.fetchone()
+    cursor.close()
+    connection.close()
+    return flight
+
+
+def buyer(pool, flight, username, attempts, counts, lock):
+    sold = rejected = errors = 0
+    for i in range(attempts):
+        connection = pool.acquire()
+        try:
+            booking_service.checkout(connection, username, flight, f'{username} #{i}', 'credit_card')
+            sold += 1
+        except booking_service.BookingError:
+            rejected += 1
+        except Exception:
+            errors += 1
+        finally:
+            connection.close()
+    with lock:
+        counts['sold'] += sold
+        counts['rejected'] += rejected
+        counts['errors'] += errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Concurrent checkout stress test for one flight')
+    parser.add_argument('--threads', type=int, default=32)
+    parser.add_argument('--attempts', type=int, default=20, help='checkouts per thread')
+    parser.add_argument('--capacity', type=int, default=150)
+    args = parser.parse_args()
+
+    pool = open_pool(size=args.threads)
+    flight = setup(pool, args.threads, args.capacity)
+
+    counts = {'sold': 0, 'rejected': 0, 'errors': 0}
+    lock = threading.Lock()
+    workers = [
+        threading.Thread(target=buyer, args=(pool, flight, f'{USER_PREFIX}{i}', args.attempts, counts, lock))
+        for i in range(args.threads)
+    ]
+    started = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - started
+
+    connection = pool.acquire()
+    cursor = connection.cursor(dictionary=True)
+    available = seat_inventory.available_seats(cursor, flight['id'])
+    cursor.execute("SELECT COUNT(*) AS n FROM bookings WHERE flight_id = %s", (flight['id'],))
+    booked = cursor.fetchone()['n']
+    cursor.close()
+    connection.close()
+
+    consistent = booked <= args.capacity and booked == counts['sold'] and available == args.capacity - booked
+    report({
+        'threads': args.threads,
+        'attempts': args.threads * args.attempts,
+        'capacity': args.capacity,
+        'sold': counts['sold'],
+        'rejected': counts['rejected'],
+        'errors': counts['errors'],
+        'bookings_in_db': booked,
+        'seats_available': available,
+        'elapsed_s': elapsed,
+        'bookings_per_s': counts['sold'] / elapsed if elapsed else 0.0,
+        'attempts_per_s': args.threads * args.attempts / elapsed if elapsed else 0.0,
+        'oversold': booked > args.capacity,
+        'consistent': consistent,
+    })
+    if not consistent:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,148 @@
+# Booking, checkout and cancellation as single database transactions.
+#
+# Each function does all of its writes on one connection and commits exactly
+# once at the end; on any error the whole unit is rolled back, so a crash can
+# never leave a booking without its transaction row or loyalty update.
+# Notifications are handed to the background notification queue only after
+# the commit succeeds, so they are not part of the request's write latency.
+import loyalty
+import pricing
+import seat_inventory
+from notification_queue import notification_queue
+
+MINIMUM_POINTS_FOR_REDEMPTION = 50  # Minimum points required to redeem
+
+
+class BookingError(Exception):
+    pass
+
+
+def resolve_user_id(cursor, username):
+    cursor.execute("SELECT id FROM users WHERE username = %s", (username,))
+    row = cursor.fetchone()
+    if row is None:
+        raise BookingError('Unknown user.')
+    return row['id']
+
+
+def _run(connection, work):
+    cursor = connection.cursor(dictionary=True)
+    try:
+        result = work(cursor)
+        connection.commit()
+        return result
+    except seat_inventory.SoldOut:
+        connection.rollback()
+        raise BookingError('Sorry, this flight is sold out.')
+    except loyalty.InsufficientPoints:
+        connection.rollback()
+        raise BookingError('You do not have enough loyalty points to redeem.')
+    except Exception:
+        connection.rollback()
+        raise
+    finally:
+        cursor.close()
+
+
+def checkout(connection, username, flight, passenger_name, payment_method, points_to_redeem=0, quote=None):
+    # `quote` is the pricing.quote() shown on the payment page (economy, one
+    # passenger if not given); its seats are taken and its total charged.
+    messages = []
+    quote = quote or pricing.quote(flight)
+
+    def work(cursor):
+        user_id = resolve_user_id(cursor, username)
+        discount, final_price, points_earned = pricing.with_points(quote['total'], points_to_redeem)
+
+        cursor.execute(
+            """
+            INSERT INTO bookings (flight_id, username, passenger_name, booking_date, payment_status, final_price, fare_class, seats)
+            VALUES (%s, %s, %s, NOW(), %s, %s, %s, %s)
+            """,
+            (flight['id'], username, passenger_name, 'confirmed', final_price, quote['class_type'], quote['passengers'])
+        )
+        booking_id = cursor.lastrowid
+
+        cursor.execute(
+            """
+            INSERT INTO transactions (booking_id, username, amount, transaction_type, status, payment_method, discount_applied)
+            VALUES (%s, %s, %s, %s, %s, %s, %s)
+            """,
+            (booking_id, username, final_price, 'payment', 'success', payment_method, discount)
+        )
+
+        # Spend first (fails atomically if the points are gone), then earn
+        loyalty.redeem(cursor, user_id, points_to_redeem, booking_id)
+        loyalty.earn(cursor, user_id, points_earned, booking_id)
+
+        messages.append(f"Booking confirmed! Flight from {flight['source']} to {flight['destination']} on {flight['departure_date']}. Final price: ${final_price:.2f}.")
+        if points_to_redeem > 0:
+            messages.append(f"You redeemed {points_to_redeem} points and received a discount of ${discount:.2f}.")
+        if points_earned > 0:
+            messages.append(f"You earned {points_earned} loyalty points for this booking.")
+
+        # Take the seat last so the flight's inventory row stays locked for as
+        # short a time as possible on busy flights.
+        seat_inventory.consume_hold(cursor, flight['id'], username, seats=quote['passengers'])
+
+        return {
+            'booking_id': booking_id,
+            'final_price': final_price,
+            'discount': discount,
+            'points_earned': points_earned,
+        }
+
+    result = _run(connection, work)
+    loyalty.invalidate(username)
+    pricing.invalidate(flight['id'])
+    notification_queue.publish(username, messages)
+    return result
+
+
+def book(connection, username, flight_id, passenger_name):
+    def work(cursor):
+        cursor.execute(
+            "INSERT INTO bookings (flight_id, username, passenger_name, booking_date) VALUES (%s, %s, %s, NOW())",
+            (flight_id, username, passenger_name)
+        )
+        booking_id = cursor.lastrowid
+        seat_inventory.reserve(cursor, flight_id)
+        return booking_id
+
+    booking_id = _run(connection, work)
+    pricing.invalidate(flight_id)
+    notification_queue.publish(username, [f"Your flight with ID {flight_id} has been successfully booked."])
+    return booking_id
+
+
+def cancel(connection, username, booking_id):
+    # Returns the cancelled booking (flight id, route and date), or None if the
+    # booking doesn't exist or belongs to someone else.
+    def work(cursor):
+        cursor.execute("""
+            SELECT b.flight_id, b.seats, f.source, f.destination, f.departure_date
+            FROM bookings b
+            JOIN flights f ON b.flight_id = f.id
+            WHERE b.id = %s AND b.username = %s
+            FOR UPDATE
+        """, (booking_id, username))
+        booking = cursor.fetchone()
+        if not booking:
+            return None
+
+        cursor.execute(
+            "UPDATE bookings SET status = %s WHERE id = %s AND username = %s AND (status IS NULL OR status <> %s)",
+            ('cancelled', booking_id, username, 'cancelled')
+        )
+        # Only hand the seat back the first time a booking is cancelled
+        if cursor.rowcount == 1:
+            seat_inventory.release(cursor, booking['flight_id'], booking['seats'])
+        return booking
+
+    booking = _run(connection, work)
+    if booking:
+        pricing.invalidate(booking['flight_id'])
+        notification_queue.publish(username, [
+            f"Your booking from {booking['source']} to {booking['destination']} on {booking['departure_date']} has been canceled."
+        ])
+    return booking
@@ -1,12 +1,321 @@
 # filepath: c:\ars\ars\database\db_connection.py
+import os
+import threading
+import time
+from collections import deque
+
 import mysql.connector
+from flask import g, has_app_context
 
-def get_db_connection():
-    connection = mysql.connector.connect(
-        host="localhost",
-        user="root",  # Replace with your MySQL username
-        password="",  # Replace with your MySQL password
-        database="flight_booking"
-       
+# Connection settings, read from the environment and overridable through app.config
+# (init_app copies any DB_* keys from app.config over these defaults).
+DEFAULT_CONFIG = {
+    'DB_HOST': 'localhost',
+    'DB_PORT': 3306,
+    'DB_USER': 'root',
+    'DB_PASSWORD': '',
+    'DB_NAME': 'flight_booking',
+    'DB_POOL_SIZE': 10,             # hard cap on open connections
+    'DB_POOL_MIN_IDLE': 2,          # idle connections kept around when reaping
+    'DB_POOL_TIMEOUT': 5.0,         # seconds to wait for a free connection
+    'DB_POOL_IDLE_TIMEOUT': 300.0,  # idle connections older than this get closed
+    'DB_POOL_PING_AFTER': 30.0,     # ping connections idle longer than this on checkout
+}
+
+_INT_KEYS = ('DB_PORT', 'DB_POOL_SIZE', 'DB_POOL_MIN_IDLE')
+_FLOAT_KEYS = ('DB_POOL_TIMEOUT', 'DB_POOL_IDLE_TIMEOUT', 'DB_POOL_PING_AFTER')
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+def load_config(overrides=None):
+    config = {}
+    for key, default in DEFAULT_CONFIG.items():
+        value = os.environ.get(key, default)
+        if overrides and key in overrides:
+            value = overrides[key]
+        if key in _INT_KEYS:
+            value = int(value)
+        elif key in _FLOAT_KEYS:
+            value = float(value)
+        config[key] = value
+    return config
+
+
+def mysql_connector_factory(config):
+    def connect():
+        return mysql.connector.connect(
+            host=config['DB_HOST'],
+            port=config['DB_PORT'],
+            user=config['DB_USER'],
+            password=config['DB_PASSWORD'],
+            database=config['DB_NAME'],
+        )
+    return connect
+
+
+def _ping(raw):
+    # mysql.connector connections have ping(); anything else (e.g. a sqlite3
+    # stand-in) gets a trivial round trip instead.
+    if hasattr(raw, 'ping'):
+        raw.ping(reconnect=False)
+    else:
+        cursor = raw.cursor()
+        cursor.execute("SELECT 1")
+        cursor.fetchall()
+        cursor.close()
+
+
+# Optional callable that wraps every cursor handed out (used by
+# instrumentation to time queries). None means cursors are returned untouched.
+cursor_wrapper = None
+
+
+def set_cursor_wrapper(wrapper):
+    global cursor_wrapper
+    cursor_wrapper = wrapper
+
+
+class PooledConnection:
+    # Thin proxy around a raw connection. close() hands it back to the pool
+    # instead of tearing down the socket, so route code keeps working as-is.
+
+    def __init__(self, pool, raw):
+        self._pool = pool
+        self._raw = raw
+        self._released = False
+
+    def cursor(self, *args, **kwargs):
+        cursor = self._raw.cursor(*args, **kwargs)
+        if cursor_wrapper is not None:
+            return cursor_wrapper(cursor)
+        return cursor
+
+    def commit(self):
+        self._raw.commit()
+
+    def rollback(self):
+        self._raw.rollback()
+
+    def close(self):
+        if not self._released:
+            self._released = True
+            self._pool.release(self._raw)
+
+    def discard(self):
+        # Closes the underlying connection instead of returning it, for when
+        # it is in a state not worth recovering (e.g. a large unread result).
+        if not self._released:
+            self._released = True
+            self._pool._discard(self._raw)
+
+    @property
+    def released(self):
+        return self._released
+
+    def __getattr__(self, name):
+        return getattr(self._raw, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+class ConnectionPool:
+    def __init__(self, connect, size=10, min_idle=2, timeout=5.0, idle_timeout=300.0, ping_after=30.0):
+        self._connect = connect
+        self.size = size
+        self.min_idle = min_idle
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout
+        self.ping_after = ping_after
+
+        self._idle = deque()  # (raw connection, time it was returned)
+        self._open = 0
+        self._cond = threading.Condition()
+
+        self._checkouts = 0
+        self._failures = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+        self._connect_total = 0.0
+        self._reaped = 0
+        self._discarded = 0
+
+    def acquire(self):
+        started = time.monotonic()
+        deadline = started + self.timeout
+        while True:
+            raw = None
+            with self._cond:
+                self._reap_locked()
+                while not self._idle and self._open >= self.size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._failures += 1
+                        raise PoolTimeout(f"No database connection available after {self.timeout}s")
+                    self._cond.wait(remaining)
+                if self._idle:
+                    raw, returned_at = self._idle.pop()
+                else:
+                    self._open += 1
+                    returned_at = None
+
+            if raw is None:
+                raw = self._new_connection()
+            elif time.monotonic() - returned_at > self.ping_after and not self._healthy(raw):
+                # Stale connection; drop it and go round again for another one.
+                self._discard(raw)
+                continue
+
+            waited = time.monotonic() - started
+            with self._cond:
+                self._checkouts += 1
+                self._wait_total += waited
+                self._wait_max = max(self._wait_max, waited)
+            return PooledConnection(self, raw)
+
+    def release(self, raw):
+        try:
+            # Never hand out a connection with a half-finished transaction on it.
+            raw.rollback()
+        except Exception:
+            self._discard(raw)
+            return
+        with self._cond:
+            self._idle.append((raw, time.monotonic()))
+            self._cond.notify()
+
+    def stats(self):
+        with self._cond:
+            idle = len(self._idle)
+            return {
+                'size': self.size,
+                'open': self._open,
+                'idle': idle,
+                'in_use': self._open - idle,
+                'checkouts': self._checkouts,
+                'checkout_failures': self._failures,
+                'wait_seconds_total': self._wait_total,
+                'wait_seconds_max': self._wait_max,
+                'connect_seconds_total': self._connect_total,
+                'reaped': self._reaped,
+                'discarded': self._discarded,
+            }
+
+    def close_all(self):
+        with self._cond:
+            idle = list(self._idle)
+            self._idle.clear()
+            self._open -= len(idle)
+            self._cond.notify_all()
+        for raw, _ in idle:
+            self._close_quietly(raw)
+
+    def _new_connection(self):
+        started = time.monotonic()
+        try:
+            raw = self._connect()
+        except Exception:
+            with self._cond:
+                self._open -= 1
+                self._failures += 1
+                self._cond.notify()
+            raise
+        with self._cond:
+            self._connect_total += time.monotonic() - started
+        return raw
+
+    def _healthy(self, raw):
+        try:
+            _ping(raw)
+            return True
+        except Exception:
+            return False
+
+    def _discard(self, raw):
+        self._close_quietly(raw)
+        with self._cond:
+            self._open -= 1
+            self._discarded += 1
+            self._cond.notify()
+
+    def _reap_locked(self):
+        # Idle connections are stored oldest-first, so stop at the first fresh one.
+        now = time.monotonic()
+        while len(self._idle) > self.min_idle and now - self._idle[0][1] > self.idle_timeout:
+            raw, _ = self._idle.popleft()
+            self._open -= 1
+            self._reaped += 1
+            self._close_quietly(raw)
+
+    @staticmethod
+    def _close_quietly(raw):
+        try:
+            raw.close()
+        except Exception:
+            pass
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def create_pool(config=None, connect=None):
+    config = load_config(config)
+    return ConnectionPool(
+        connect or mysql_connector_factory(config),
+        size=config['DB_POOL_SIZE'],
+        min_idle=config['DB_POOL_MIN_IDLE'],
+        timeout=config['DB_POOL_TIMEOUT'],
+        idle_timeout=config['DB_POOL_IDLE_TIMEOUT'],
+        ping_after=config['DB_POOL_PING_AFTER'],
     )
-    return connection
\ No newline at end of file
+
+
+def configure_pool(config=None, connect=None):
+    # Swap in a new process-wide pool. `connect` lets tests or scripts point the
+    # pool at a different backend (e.g. sqlite3.connect) without touching routes.
+    global _pool
+    with _pool_lock:
+        old, _pool = _pool, create_pool(config, connect)
+    if old is not None:
+        old.close_all()
+    return _pool
+
+
+def get_pool():
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = create_pool()
+    return _pool
+
+
+def get_db_connection():
+    started = time.perf_counter()
+    connection = get_pool().acquire()
+
+    # Inside a request, remember the checkout so teardown can return it even if
+    # the route bails out early without calling close(). The time spent getting
+    # a connection is kept separately from query time for instrumentation.
+    if has_app_context():
+        g.setdefault('_db_connections', []).append(connection)
+        g.db_connect_seconds = g.get('db_connect_seconds', 0.0) + time.perf_counter() - started
+    return connection
+
+
+def release_request_connections(exc=None):
+    for connection in g.pop('_db_connections', []):
+        connection.close()
+
+
+def init_app(app):
+    overrides = {key: app.config[key] for key in DEFAULT_CONFIG if key in app.config}
+    configure_pool(overrides)
+    app.teardown_appcontext(release_request_connections)
@@ -0,0 +1,287 @@
+import logging
+import os
+import threading
+import time
+from datetime import date, datetime
+
+from db_connection import get_db_connection
+
+logger = logging.getLogger(__name__)
+
+CHANGE_LOG_SIZE = 4096  # refreshes remembered for changed_since()
+
+
+def date_key(value):
+    # Flights come back from MySQL with date objects, form input arrives as
+    # 'YYYY-MM-DD' strings; normalise both to the same key.
+    if value is None:
+        return None
+    if isinstance(value, datetime):
+        return value.date().isoformat()
+    if isinstance(value, date):
+        return value.isoformat()
+    return str(value)
+
+
+def _sort_key(flight):
+    return (date_key(flight.get('departure_date')) or '', str(flight.get('departure_time') or ''), flight['id'])
+
+
+class FlightIndex:
+    # In-process copy of the flights table keyed by (source, destination, date).
+    #
+    # The whole table is bulk-loaded once, then kept current by pulling rows with
+    # an id above the highest one seen (the change cursor). Rows that change in
+    # place (seat counts, prices) are refreshed through invalidate(), and the
+    # whole index is reloaded after `ttl` seconds to pick up anything else.
+
+    def __init__(self, connect, refresh_interval=30.0, ttl=600.0):
+        self._connect = connect
+        self.refresh_interval = refresh_interval
+        self.ttl = ttl
+
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._flights = {}       # id -> row
+        self._route_ids = {}     # (source, destination) -> set of ids
+        self._by_route = {}      # (source, destination) -> [rows]
+        self._by_route_date = {} # (source, destination, date) -> [rows]
+        self._route_days = {}    # (source, destination) -> dates present in _by_route_date
+        self._grouped = {}       # (source, destination, date or None) -> {flight_number: [rows]}
+
+        self._cursor = 0
+        self._dirty = set()
+        self._full_reload = True
+        self._loaded_at = 0.0
+        self._refreshed_at = 0.0
+        self._changes = []       # [(version, ids changed by that refresh)] since the last load
+        self._changes_from = 0   # oldest version changed_since() can answer for
+        self.version = 0
+
+    def configure(self, refresh_interval=None, ttl=None):
+        if refresh_interval is not None:
+            self.refresh_interval = float(refresh_interval)
+        if ttl is not None:
+            self.ttl = float(ttl)
+
+    # -- reads ---------------------------------------------------------------
+
+    def search(self, source, destination, departure_date=None):
+        self._maybe_refresh()
+        if departure_date:
+            return self._by_route_date.get((source, destination, date_key(departure_date)), [])
+        return self._by_route.get((source, destination), [])
+
+    def grouped(self, source, destination, departure_date=None):
+        self._maybe_refresh()
+        key = (source, destination, date_key(departure_date) if departure_date else None)
+        return self._grouped.get(key, {})
+
+    def get(self, flight_id):
+        self._maybe_refresh()
+        return self._flights.get(int(flight_id))
+
+    def all_flights(self):
+        self._maybe_refresh()
+        with self._lock:
+            return list(self._flights.values())
+
+    def current_version(self):
+        # The version after any due refresh, without copying anything.
+        self._maybe_refresh()
+        return self.version
+
+    def changed_since(self, version):
+        # Ids of flights added, changed or removed after `version`, or None if
+        # the index has been reloaded since (anything may have changed).
+        with self._lock:
+            if version is None or version < self._changes_from:
+                return None
+            ids = set()
+            for changed_version, flight_ids in reversed(self._changes):
+                if changed_version <= version:
+                    break
+                ids.update(flight_ids)
+            return ids
+
+    # -- maintenance ---------------------------------------------------------
+
+    def invalidate(self, flight_id=None):
+        # Called whenever a booking changes a flight row. With no id the whole
+        # index is thrown away and reloaded on next use.
+        with self._lock:
+            if flight_id is None:
+                self._full_reload = True
+            else:
+                self._dirty.add(int(flight_id))
+
+    def load(self):
+        rows = self._fetch("SELECT * FROM flights ORDER BY id")
+
+        # Build everything off to the side and swap it in, so concurrent
+        # searches see either the old index or the new one, never a partial one.
+        flights = {row['id']: row for row in rows}
+        route_ids = {}
+        for row in rows:
+            route_ids.setdefault((row['source'], row['destination']), set()).add(row['id'])
+        by_route, by_route_date, route_days, grouped = {}, {}, {}, {}
+        for route, ids in route_ids.items():
+            _index_route(route, [flights[i] for i in ids], by_route, by_route_date, route_days, grouped)
+
+        with self._lock:
+            self._flights = flights
+            self._route_ids = route_ids
+            self._by_route = by_route
+            self._by_route_date = by_route_date
+            self._route_days = route_days
+            self._grouped = grouped
+            self._cursor = max(flights, default=0)
+            self._dirty.clear()
+            self._full_reload = False
+            self._loaded_at = self._refreshed_at = time.monotonic()
+            self.version += 1
+            self._changes = []
+            self._changes_from = self.version
+        logger.info("Flight index loaded %d flights on %d routes", len(rows), len(route_ids))
+
+    def refresh(self):
+        with self._lock:
+            dirty = list(self._dirty)
+            self._dirty.clear()
+            cursor = self._cursor
+
+        rows = self._fetch("SELECT * FROM flights WHERE id > %s ORDER BY id", (cursor,))
+        if dirty:
+            placeholders = ', '.join(['%s'] * len(dirty))
+            rows += self._fetch(f"SELECT * FROM flights WHERE id IN ({placeholders})", dirty)
+
+        with self._lock:
+            seen = {row['id'] for row in rows}
+            touched = set()
+            # Dirty ids that didn't come back were deleted.
+            for flight_id in dirty:
+                if flight_id not in seen:
+                    touched.add(self._drop(flight_id))
+            for row in rows:
+                touched.add(self._drop(row['id']))
+                route = (row['source'], row['destination'])
+                self._flights[row['id']] = row
+                self._route_ids.setdefault(route, set()).add(row['id'])
+                touched.add(route)
+                self._cursor = max(self._cursor, row['id'])
+            touched.discard(None)
+            for route in touched:
+                self._rebuild_route(route)
+            self._refreshed_at = time.monotonic()
+            if touched:
+                self.version += 1
+                self._changes.append((self.version, seen.union(dirty)))
+                if len(self._changes) > CHANGE_LOG_SIZE:
+                    self._changes_from = self._changes.pop(0)[0]
+
+    def warm(self):
+        try:
+            self.load()
+            return True
+        except Exception:
+            logger.exception("Flight index warm-up failed; it will load on first search")
+            return False
+
+    def _maybe_refresh(self):
+        now = time.monotonic()
+        reload = self._full_reload or now - self._loaded_at > self.ttl
+        if not reload and not self._dirty and now - self._refreshed_at <= self.refresh_interval:
+            return
+
+        if self._loaded_at == 0.0:
+            # Nothing to serve yet, so everyone waits for the first load.
+            with self._refresh_lock:
+                if self._loaded_at == 0.0:
+                    self.load()
+            return
+
+        # Otherwise one thread refreshes while the rest keep serving the
+        # current (slightly stale) index.
+        if not self._refresh_lock.acquire(blocking=False):
+            return
+        try:
+            if reload:
+                self.load()
+            else:
+                self.refresh()
+        finally:
+            self._refresh_lock.release()
+
+    def _fetch(self, query, params=()):
+        connection = self._connect()
+        try:
+            cursor = connection.cursor(dictionary=True)
+            cursor.execute(query, params)
+            rows = cursor.fetchall()
+            cursor.close()
+        finally:
+            connection.close()
+        return rows
+
+    def _drop(self, flight_id):
+        # Caller holds the lock. Returns the route the flight used to be on.
+        row = self._flights.pop(flight_id, None)
+        if row is None:
+            return None
+        route = (row['source'], row['destination'])
+        self._route_ids.get(route, set()).discard(flight_id)
+        return route
+
+    def _rebuild_route(self, route):
+        # Caller holds the lock.
+        source, destination = route
+        ids = self._route_ids.get(route)
+        flights = [self._flights[i] for i in ids] if ids else []
+        stale_days = self._route_days.get(route, set())
+
+        if flights:
+            _index_route(route, flights, self._by_route, self._by_route_date, self._route_days, self._grouped)
+        else:
+            self._route_ids.pop(route, None)
+            self._by_route.pop(route, None)
+            self._route_days.pop(route, None)
+            self._grouped.pop((source, destination, None), None)
+
+        for day in stale_days - self._route_days.get(route, set()):
+            self._by_route_date.pop((source, destination, day), None)
+            self._grouped.pop((source, destination, day), None)
+
+
+def _index_route(route, flights, by_route, by_route_date, route_days, grouped):
+    # Replaces (never mutates) the lists and dicts for one route, so readers
+    # holding the previous ones are unaffected.
+    source, destination = route
+    flights = sorted(flights, key=_sort_key)
+    by_date = {}
+    for flight in flights:
+        by_date.setdefault(date_key(flight.get('departure_date')), []).append(flight)
+
+    by_route[route] = flights
+    route_days[route] = set(by_date)
+    grouped[(source, destination, None)] = _group_by_number(flights)
+    for day, day_flights in by_date.items():
+        by_route_date[(source, destination, day)] = day_flights
+        grouped[(source, destination, day)] = _group_by_number(day_flights)
+
+
+def _group_by_number(flights):
+    grouped = {}
+    for flight in flights:
+        grouped.setdefault(flight['flight_number'], []).append(flight)
+    return grouped
+
+
+def init_app(app):
+    flight_index.configure(
+        refresh_interval=app.config.get('FLIGHT_INDEX_REFRESH_INTERVAL', os.environ.get('FLIGHT_INDEX_REFRESH_INTERVAL')),
+        ttl=app.config.get('FLIGHT_INDEX_TTL', os.environ.get('FLIGHT_INDEX_TTL')),
+    )
+
+
+# Shared per-process index; routes read from this instead of querying flights.
+flight_index = FlightIndex(get_db_connection)
@@ -0,0 +1,138 @@
+# Booking, refund and transaction history for one user.
+#
+# Pages use keyset pagination: the next page starts after the last row shown
+# instead of at an OFFSET, so every page is a short range scan on the
+# (username, ...) indexes from migrations no matter how long the history is. The CSV
+# statement streams from an unbuffered cursor, a batch at a time, so a
+# corporate account with years of transactions doesn't get loaded into memory.
+import csv
+import io
+from datetime import datetime
+
+PAGE_SIZE = 25
+STREAM_BATCH = 500
+
+STATEMENT_COLUMNS = (
+    'transaction_date', 'id', 'booking_id', 'flight_number', 'source', 'destination',
+    'transaction_type', 'payment_method', 'amount', 'discount_applied', 'status',
+)
+
+
+def encode_cursor(row, column):
+    return f"{row['id']}:{row[column].isoformat()}"
+
+
+def decode_cursor(value):
+    try:
+        row_id, moment = value.split(':', 1)
+        return datetime.fromisoformat(moment), int(row_id)
+    except (AttributeError, ValueError):
+        return None
+
+
+def _decode_id(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _split(rows, limit, next_cursor):
+    if len(rows) > limit:
+        return rows[:limit], next_cursor(rows[limit - 1])
+    return rows, None
+
+
+def transactions_page(cursor, username, before=None, limit=PAGE_SIZE):
+    # Newest first. Returns (rows, cursor for the next page or None).
+    position = decode_cursor(before) if before else None
+    keyset = ""
+    params = [username]
+    if position:
+        keyset = "AND (t.transaction_date < %s OR (t.transaction_date = %s AND t.id < %s))"
+        params += [position[0], position[0], position[1]]
+    cursor.execute(f"""
+        SELECT t.id, t.booking_id, t.amount AS amount, t.discount_applied,
+               t.transaction_type, t.transaction_date, t.status, t.payment_method,
+               f.flight_number, f.source, f.destination
+        FROM transactions t
+        JOIN bookings b ON t.booking_id = b.id
+        JOIN flights f ON b.flight_id = f.id
+        WHERE t.username = %s {keyset}
+        ORDER BY t.transaction_date DESC, t.id DESC
+        LIMIT %s
+    """, (*params, limit + 1))
+    return _split(cursor.fetchall(), limit, lambda row: encode_cursor(row, 'transaction_date'))
+
+
+def bookings_page(cursor, username, before=None, limit=PAGE_SIZE):
+    # Most recent bookings first, keyed on the booking id.
+    before_id = _decode_id(before)
+    keyset = "AND b.id < %s" if before_id else ""
+    params = (username, before_id) if before_id else (username,)
+    cursor.execute(f"""
+        SELECT b.id AS booking_id, f.flight_number, f.source, f.destination,
+               f.departure_date, b.final_price AS price,
+               b.passenger_name, b.booking_date, b.status
+        FROM bookings b
+        JOIN flights f ON b.flight_id = f.id
+        WHERE b.username = %s {keyset}
+        ORDER BY b.id DESC
+        LIMIT %s
+    """, (*params, limit + 1))
+    return _split(cursor.fetchall(), limit, lambda row: str(row['booking_id']))
+
+
+def refunds_page(cursor, username, before=None, limit=PAGE_SIZE):
+    before_id = _decode_id(before)
+    keyset = "AND b.id < %s" if before_id else ""
+    params = (username, before_id) if before_id else (username,)
+    cursor.execute(f"""
+        SELECT b.id, b.final_price AS price, b.refund_status, f.flight_number, f.departure_date
+        FROM bookings b
+        JOIN flights f ON b.flight_id = f.id
+        WHERE b.username = %s AND b.status = 'cancelled' {keyset}
+        ORDER BY b.id DESC
+        LIMIT %s
+    """, (*params, limit + 1))
+    return _split(cursor.fetchall(), limit, lambda row: str(row['id']))
+
+
+def statement_csv(connection, username):
+    # Yields the user's full transaction statement as CSV text chunks. The
+    # cursor is unbuffered, so rows come off the socket as they're written out.
+    cursor = connection.cursor(buffered=False)
+    pending = False
+    try:
+        cursor.execute("""
+            SELECT t.transaction_date, t.id, t.booking_id, f.flight_number, f.source, f.destination,
+                   t.transaction_type, t.payment_method, t.amount, t.discount_applied, t.status
+            FROM transactions t
+            JOIN bookings b ON t.booking_id = b.id
+            JOIN flights f ON b.flight_id = f.id
+            WHERE t.username = %s
+            ORDER BY t.transaction_date DESC, t.id DESC
+        """, (username,))
+        pending = True
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(STATEMENT_COLUMNS)
+        while True:
+            rows = cursor.fetchmany(STREAM_BATCH)
+            if not rows:
+                pending = False
+                break
+            writer.writerows(rows)
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+        if buffer.tell():
+            yield buffer.getvalue()  # header only: no transactions yet
+    finally:
+        if pending:
+            # The client went away mid-download. Draining the rest of the
+            # result could mean reading millions of rows nobody wants, so the
+            # connection is dropped instead of going back to the pool.
+            connection.discard()
+        else:
+            cursor.close()
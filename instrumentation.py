@@ -0,0 +1,292 @@
+# Request and SQL timing, exported as Prometheus text on /metrics.
+#
+# When enabled, every request is timed between before_request and
+# after_request, and every cursor is wrapped so its queries are timed and
+# counted against the current request. Queries slower than SLOW_QUERY_MS are
+# logged with their literals stripped out. When disabled (METRICS_ENABLED=0)
+# none of the hooks are installed, so requests and cursors run untouched.
+import logging
+import hmac
+import ipaddress
+import os
+import re
+import threading
+import time
+from collections import deque
+
+from flask import Response, g, request
+
+import db_connection
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds (seconds) for the latency histogram buckets
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+RESERVOIR_SIZE = 1024   # recent samples kept per series for percentiles
+MAX_QUERY_SHAPES = 500  # distinct normalised statements tracked
+
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.total = 0.0
+        self.count = 0
+        self.recent = deque(maxlen=RESERVOIR_SIZE)
+
+    def observe(self, seconds):
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                self.counts[i] += 1
+                break
+        else:
+            self.counts[-1] += 1
+        self.total += seconds
+        self.count += 1
+        self.recent.append(seconds)
+
+    def quantile(self, q):
+        values = sorted(self.recent)
+        if not values:
+            return 0.0
+        return values[min(len(values) - 1, int(q * len(values)))]
+
+
+class Metrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = {}      # (endpoint, method) -> Histogram
+        self.statuses = {}      # (endpoint, status) -> count
+        self.db_connect = Histogram()
+        self.queries_per_request = Histogram()
+        self.query_shapes = {}  # normalised SQL -> [count, total seconds]
+        self.slow_queries = 0
+
+    def record_request(self, endpoint, method, status, seconds, queries, connect_seconds):
+        with self._lock:
+            self.requests.setdefault((endpoint, method), Histogram()).observe(seconds)
+            key = (endpoint, status)
+            self.statuses[key] = self.statuses.get(key, 0) + 1
+            self.queries_per_request.observe(queries)
+            if connect_seconds:
+                self.db_connect.observe(connect_seconds)
+
+    def record_query(self, sql, seconds, slow=False):
+        with self._lock:
+            if slow:
+                self.slow_queries += 1
+            shape = self.query_shapes.get(sql)
+            if shape is None:
+                if len(self.query_shapes) >= MAX_QUERY_SHAPES:
+                    sql = '<other>'
+                shape = self.query_shapes.setdefault(sql, [0, 0.0])
+            shape[0] += 1
+            shape[1] += seconds
+
+
+metrics = Metrics()
+slow_query_seconds = float(os.environ.get('SLOW_QUERY_MS', 200)) / 1000.0
+
+_STRING = re.compile(r"'(?:[^'\\]|\\.|'')*'|\"(?:[^\"\\]|\\.|\"\")*\"")
+_NUMBER = re.compile(r"\b\d+(?:\.\d+)?\b")
+_PLACEHOLDER = re.compile(r"%s|\?")
+_IN_LIST = re.compile(r"\(\s*\?(?:\s*,\s*\?)*\s*\)")
+_SPACE = re.compile(r"\s+")
+
+
+def normalize_sql(sql):
+    if isinstance(sql, bytes):
+        sql = sql.decode('utf-8', 'replace')
+    sql = _STRING.sub('?', sql)
+    sql = _NUMBER.sub('?', sql)
+    sql = _PLACEHOLDER.sub('?', sql)
+    sql = _IN_LIST.sub('(...)', sql)
+    return _SPACE.sub(' ', sql).strip()
+
+
+class TimedCursor:
+    # Cursor proxy that times execute()/executemany().
+
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    def execute(self, operation, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return self._cursor.execute(operation, *args, **kwargs)
+        finally:
+            _observe_query(operation, time.perf_counter() - started)
+
+    def executemany(self, operation, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return self._cursor.executemany(operation, *args, **kwargs)
+        finally:
+            _observe_query(operation, time.perf_counter() - started)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+def _observe_query(operation, seconds):
+    sql = normalize_sql(operation)
+    slow = seconds >= slow_query_seconds
+    metrics.record_query(sql, seconds, slow)
+    try:
+        g.query_count = g.get('query_count', 0) + 1
+    except RuntimeError:
+        pass  # outside a request (background workers, CLI)
+    if slow:
+        logger.warning("Slow query (%.1f ms): %s", seconds * 1000, sql)
+
+
+def _before_request():
+    g.request_started = time.perf_counter()
+    g.query_count = 0
+
+
+def _record(status):
+    started = g.pop('request_started', None)
+    if started is not None:
+        endpoint = request.url_rule.rule if request.url_rule else '<unmatched>'
+        metrics.record_request(
+            endpoint,
+            request.method,
+            status,
+            time.perf_counter() - started,
+            g.get('query_count', 0),
+            g.get('db_connect_seconds', 0.0),
+        )
+
+
+def _after_request(response):
+    _record(response.status_code)
+    return response
+
+
+def _teardown_request(exc=None):
+    # A request that raised without after_request running (e.g. with
+    # PROPAGATE_EXCEPTIONS, or an after_request hook failing) still counts.
+    _record(500)
+
+
+def _allowed(addr, networks):
+    try:
+        address = ipaddress.ip_address(addr)
+    except ValueError:
+        return False
+    return any(address in network for network in networks)
+
+
+# -- exposition --------------------------------------------------------------
+
+def _label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"')
+
+
+def _series(name, labels=''):
+    return f'{name}{{{labels}}}' if labels else name
+
+
+def _histogram_lines(name, histogram, labels=''):
+    sep = ',' if labels else ''
+    lines = []
+    cumulative = 0
+    for bound, count in zip(BUCKETS, histogram.counts):
+        cumulative += count
+        lines.append(f'{name}_bucket{{{labels}{sep}le="{bound}"}} {cumulative}')
+    lines.append(f'{name}_bucket{{{labels}{sep}le="+Inf"}} {histogram.count}')
+    lines.append(f'{_series(name + "_sum", labels)} {histogram.total}')
+    lines.append(f'{_series(name + "_count", labels)} {histogram.count}')
+    return lines
+
+
+def _summary_lines(name, histogram, labels=''):
+    # Percentiles over the most recent RESERVOIR_SIZE samples, as a separate
+    # summary family (a histogram family can't carry quantile samples). Sum
+    # and count are cumulative, as Prometheus expects.
+    sep = ',' if labels else ''
+    lines = [f'{name}{{{labels}{sep}quantile="{q}"}} {histogram.quantile(q)}' for q in (0.5, 0.95, 0.99)]
+    lines.append(f'{_series(name + "_sum", labels)} {histogram.total}')
+    lines.append(f'{_series(name + "_count", labels)} {histogram.count}')
+    return lines
+
+
+def _timing_lines(name, series):
+    # series: [(labels, Histogram)]. Emits the histogram family, then the
+    # recent-percentile summary family as `<name>_recent`, each as one group.
+    lines = [f'# TYPE {name} histogram']
+    for labels, histogram in series:
+        lines.extend(_histogram_lines(name, histogram, labels))
+    lines.append(f'# TYPE {name}_recent summary')
+    for labels, histogram in series:
+        lines.extend(_summary_lines(f'{name}_recent', histogram, labels))
+    return lines
+
+
+def render_metrics(extra_gauges=None):
+    lines = []
+    with metrics._lock:
+        lines.extend(_timing_lines('http_request_duration_seconds', [
+            (f'route="{_label(endpoint)}",method="{method}"', histogram)
+            for (endpoint, method), histogram in sorted(metrics.requests.items())
+        ]))
+        lines.append('# TYPE http_responses_total counter')
+        for (endpoint, status), count in sorted(metrics.statuses.items()):
+            lines.append(f'http_responses_total{{route="{_label(endpoint)}",status="{status}"}} {count}')
+        lines.extend(_timing_lines('db_connect_seconds', [('', metrics.db_connect)]))
+        lines.extend(_timing_lines('db_queries_per_request', [('', metrics.queries_per_request)]))
+        shapes = sorted(metrics.query_shapes.items(), key=lambda item: -item[1][1])[:50]
+        lines.append('# TYPE db_query_seconds_total counter')
+        for sql, (count, total) in shapes:
+            lines.append(f'db_query_seconds_total{{sql="{_label(sql)}"}} {total}')
+        lines.append('# TYPE db_query_count counter')
+        for sql, (count, total) in shapes:
+            lines.append(f'db_query_count{{sql="{_label(sql)}"}} {count}')
+        lines.append('# TYPE db_slow_queries_total counter')
+        lines.append(f'db_slow_queries_total {metrics.slow_queries}')
+
+    for prefix, values in (extra_gauges or {}).items():
+        for key, value in values.items():
+            if isinstance(value, (int, float)):
+                lines.append(f'{prefix}_{key} {value}')
+    return '\n'.join(lines) + '\n'
+
+
+def init_app(app, gauges=None):
+    # `gauges` maps a metric prefix to a callable returning a dict of numbers,
+    # e.g. {'db_pool': lambda: get_pool().stats()}.
+    global slow_query_seconds
+    setting = app.config.get('METRICS_ENABLED', os.environ.get('METRICS_ENABLED', '1'))
+    if setting in (False, '0', 'false', 'no'):
+        return
+    if 'SLOW_QUERY_MS' in app.config:
+        slow_query_seconds = float(app.config['SLOW_QUERY_MS']) / 1000.0
+
+    db_connection.set_cursor_wrapper(TimedCursor)
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+    app.teardown_request(_teardown_request)
+
+    # /metrics is served to clients in METRICS_ALLOW (addresses or networks;
+    # loopback by default) and to anyone presenting METRICS_TOKEN as a
+    # bearer token, or to everyone with METRICS_PUBLIC=1.
+    public = app.config.get('METRICS_PUBLIC', os.environ.get('METRICS_PUBLIC', '0')) not in (False, '0', 'false', 'no')
+    token = app.config.get('METRICS_TOKEN', os.environ.get('METRICS_TOKEN')) or None
+    allow = app.config.get('METRICS_ALLOW', os.environ.get('METRICS_ALLOW', '127.0.0.1,::1'))
+    networks = [ipaddress.ip_network(entry.strip(), strict=False) for entry in allow.split(',') if entry.strip()]
+
+    @app.route('/metrics')
+    def metrics_endpoint():
+        presented = request.headers.get('Authorization', '')
+        authorized = (
+            public
+            or _allowed(request.remote_addr, networks)
+            or (token is not None and hmac.compare_digest(presented, f'Bearer {token}'))
+        )
+        if not authorized:
+            return 'Not found', 404
+        extra = {prefix: collect() for prefix, collect in (gauges or {}).items()}
+        return Response(render_metrics(extra), mimetype='text/plain; version=0.0.4')
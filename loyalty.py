@@ -0,0 +1,167 @@
+# Loyalty points as an append-only ledger plus a materialised balance.
+#
+# Every change is a row in loyalty_ledger; loyalty_points holds the running
+# totals and is only ever changed with single atomic statements: an upsert to
+# add points and a conditional decrement to spend them. Two checkouts racing
+# to spend the same points can't both succeed, because the second one's
+# `total_points_left >= n` no longer matches. reconcile() rebuilds the
+# balances from the ledger if they ever drift.
+#
+# Balance reads go through a short-lived per-user cache that writers clear
+# once their transaction has committed.
+import os
+import threading
+import time
+
+CACHE_TTL = float(os.environ.get('LOYALTY_CACHE_TTL', 30))
+
+SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS loyalty_ledger (
+        id BIGINT AUTO_INCREMENT PRIMARY KEY,
+        user_id INT NOT NULL,
+        delta INT NOT NULL,
+        reason VARCHAR(32) NOT NULL,
+        booking_id INT NULL,
+        created_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        KEY loyalty_ledger_user (user_id, id)
+    )
+    """,
+]
+
+
+class InsufficientPoints(Exception):
+    pass
+
+
+def ensure_schema(cursor):
+    for statement in SCHEMA:
+        cursor.execute(statement)
+
+    # The balance upsert needs loyalty_points.user_id to be unique.
+    cursor.execute("""
+        SELECT COUNT(*) FROM information_schema.statistics
+        WHERE table_schema = DATABASE() AND table_name = 'loyalty_points'
+          AND column_name = 'user_id' AND non_unique = 0 AND seq_in_index = 1
+    """)
+    if cursor.fetchone()[0] == 0:
+        merge_duplicates(cursor)
+        cursor.execute("ALTER TABLE loyalty_points ADD UNIQUE KEY loyalty_points_user (user_id)")
+
+    # Give balances that predate the ledger an opening entry, so reconcile()
+    # reproduces them: lifetime points earned, minus what has been spent.
+    cursor.execute("""
+        INSERT INTO loyalty_ledger (user_id, delta, reason)
+        SELECT lp.user_id, lp.points, 'opening_earned' FROM loyalty_points lp
+        WHERE NOT EXISTS (SELECT 1 FROM loyalty_ledger l WHERE l.user_id = lp.user_id)
+        UNION ALL
+        SELECT lp.user_id, lp.total_points_left - lp.points, 'opening_redeemed' FROM loyalty_points lp
+        WHERE lp.total_points_left <> lp.points
+          AND NOT EXISTS (SELECT 1 FROM loyalty_ledger l WHERE l.user_id = lp.user_id)
+    """)
+
+
+def merge_duplicates(cursor):
+    # Folds every user's extra loyalty_points rows into their first one
+    # (summing both totals), so user_id can be made unique.
+    cursor.execute("""
+        UPDATE loyalty_points lp
+        JOIN (
+            SELECT user_id, MIN(id) AS keep_id, SUM(points) AS points, SUM(total_points_left) AS total_points_left
+            FROM loyalty_points GROUP BY user_id HAVING COUNT(*) > 1
+        ) merged ON lp.id = merged.keep_id
+        SET lp.points = merged.points, lp.total_points_left = merged.total_points_left
+    """)
+    cursor.execute("""
+        DELETE lp FROM loyalty_points lp
+        JOIN loyalty_points earlier ON earlier.user_id = lp.user_id AND earlier.id < lp.id
+    """)
+    return cursor.rowcount
+
+
+# -- writes (caller commits) ---------------------------------------------------
+
+def earn(cursor, user_id, points, booking_id=None, reason='booking'):
+    if points <= 0:
+        return
+    cursor.execute(
+        "INSERT INTO loyalty_ledger (user_id, delta, reason, booking_id) VALUES (%s, %s, %s, %s)",
+        (user_id, points, reason, booking_id)
+    )
+    cursor.execute("""
+        INSERT INTO loyalty_points (user_id, points, total_points_left) VALUES (%s, %s, %s)
+        ON DUPLICATE KEY UPDATE points = points + VALUES(points),
+                                total_points_left = total_points_left + VALUES(total_points_left)
+    """, (user_id, points, points))
+
+
+def redeem(cursor, user_id, points, booking_id=None, reason='redemption'):
+    if points <= 0:
+        return
+    cursor.execute(
+        "UPDATE loyalty_points SET total_points_left = total_points_left - %s WHERE user_id = %s AND total_points_left >= %s",
+        (points, user_id, points)
+    )
+    if cursor.rowcount != 1:
+        raise InsufficientPoints(user_id)
+    cursor.execute(
+        "INSERT INTO loyalty_ledger (user_id, delta, reason, booking_id) VALUES (%s, %s, %s, %s)",
+        (user_id, -points, reason, booking_id)
+    )
+
+
+# -- cached reads ----------------------------------------------------------------
+
+_cache = {}  # username -> (points left, cached until)
+_cache_lock = threading.Lock()
+
+
+def balance(cursor, username):
+    # Takes a dictionary cursor.
+    now = time.monotonic()
+    entry = _cache.get(username)
+    if entry is not None and entry[1] > now:
+        return entry[0]
+
+    cursor.execute("""
+        SELECT lp.total_points_left FROM users u
+        JOIN loyalty_points lp ON lp.user_id = u.id
+        WHERE u.username = %s
+    """, (username,))
+    row = cursor.fetchone()
+    points = row['total_points_left'] if row else 0
+    with _cache_lock:
+        _cache[username] = (points, now + CACHE_TTL)
+    return points
+
+
+def invalidate(username):
+    with _cache_lock:
+        _cache.pop(username, None)
+
+
+# -- reconciliation ----------------------------------------------------------------
+
+def reconcile(connection, batch_size=10000):
+    # Rebuild loyalty_points from the ledger, a range of user ids at a time so
+    # no single statement holds locks over the whole table.
+    cursor = connection.cursor()
+    try:
+        cursor.execute("SELECT COALESCE(MAX(user_id), 0) FROM loyalty_ledger")
+        max_user = cursor.fetchone()[0]
+        rebuilt = 0
+        for low in range(0, max_user + 1, batch_size):
+            cursor.execute("""
+                INSERT INTO loyalty_points (user_id, points, total_points_left)
+                SELECT user_id, SUM(GREATEST(delta, 0)), SUM(delta) FROM loyalty_ledger
+                WHERE user_id >= %s AND user_id < %s
+                GROUP BY user_id
+                ON DUPLICATE KEY UPDATE points = VALUES(points), total_points_left = VALUES(total_points_left)
+            """, (low, low + batch_size))
+            connection.commit()
+            rebuilt += cursor.rowcount
+        with _cache_lock:
+            _cache.clear()
+        return rebuilt
+    finally:
+        cursor.close()
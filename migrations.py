@@ -0,0 +1,402 @@
+# Versioned schema migrations and a query-plan check.
+#
+# Each migration is a (version, name, function) entry in MIGRATIONS and is
+# recorded in schema_migrations once applied. MySQL commits DDL as it goes,
+# so migrations can't be rolled back; instead every step is written to be
+# re-runnable (CREATE ... IF NOT EXISTS, indexes added only when missing) and
+# a migration that failed half way is simply applied again on the next run.
+# New schema changes go at the end of the list with the next version number.
+#
+# verify() pulls the SQL literals out of the modules that serve requests,
+# runs EXPLAIN on each one with sample parameters and reports any full table
+# scan. Run it against a database with realistic volume (benchmarks.seed):
+# on near-empty tables MySQL will happily scan instead of using an index.
+import ast
+import os
+import re
+
+import auth
+import loyalty
+import notification_store
+import ratings
+import refund_jobs
+import schedule_io
+import seat_inventory
+
+LOCK_NAME = 'skybooker_migrations'
+
+BASE_TABLES = [
+    """
+    CREATE TABLE IF NOT EXISTS users (
+        id INT AUTO_INCREMENT PRIMARY KEY,
+        username VARCHAR(255) NOT NULL,
+        password VARCHAR(255) NOT NULL,
+        UNIQUE KEY users_username (username)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS flights (
+        id INT AUTO_INCREMENT PRIMARY KEY,
+        flight_number VARCHAR(20) NOT NULL,
+        source VARCHAR(100) NOT NULL,
+        destination VARCHAR(100) NOT NULL,
+        departure_date DATE NOT NULL,
+        departure_time TIME NULL,
+        arrival_time TIME NULL,
+        duration VARCHAR(20) NULL,
+        price DECIMAL(10, 2) NOT NULL
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS bookings (
+        id INT AUTO_INCREMENT PRIMARY KEY,
+        flight_id INT NOT NULL,
+        username VARCHAR(255) NOT NULL,
+        passenger_name VARCHAR(255) NOT NULL,
+        booking_date DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        payment_status VARCHAR(20) NOT NULL DEFAULT 'pending',
+        final_price DECIMAL(10, 2) NULL,
+        status VARCHAR(20) NOT NULL DEFAULT 'confirmed',
+        refund_status VARCHAR(20) NOT NULL DEFAULT 'NONE'
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS transactions (
+        id INT AUTO_INCREMENT PRIMARY KEY,
+        booking_id INT NOT NULL,
+        username VARCHAR(255) NOT NULL,
+        amount DECIMAL(10, 2) NOT NULL,
+        transaction_type VARCHAR(20) NOT NULL,
+        status VARCHAR(20) NOT NULL,
+        payment_method VARCHAR(50) NULL,
+        discount_applied DECIMAL(10, 2) NOT NULL DEFAULT 0,
+        transaction_date DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS notifications (
+        id INT AUTO_INCREMENT PRIMARY KEY,
+        username VARCHAR(255) NOT NULL,
+        message TEXT NOT NULL,
+        is_read BOOLEAN NOT NULL DEFAULT FALSE,
+        created_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS loyalty_points (
+        id INT AUTO_INCREMENT PRIMARY KEY,
+        user_id INT NOT NULL,
+        points INT NOT NULL DEFAULT 0,
+        total_points_left INT NOT NULL DEFAULT 0
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS feedback (
+        id INT AUTO_INCREMENT PRIMARY KEY,
+        booking_id INT NOT NULL,
+        username VARCHAR(255) NOT NULL,
+        rating INT NOT NULL,
+        comments TEXT NULL,
+        created_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP
+    )
+    """,
+]
+
+# (table, index name, columns, unique). Each index serves the WHERE and ORDER
+# BY of a hot query; InnoDB appends the primary key to secondary indexes, so
+# keyset pages on (..., id) are resolved without a sort.
+INDEXES = [
+    ('users', 'users_username', ('username',), True),
+    ('flights', 'flights_route_date', ('source', 'destination', 'departure_date'), False),
+    ('bookings', 'bookings_user', ('username', 'id'), False),
+    ('bookings', 'bookings_user_status', ('username', 'status', 'id'), False),
+    ('bookings', 'bookings_flight', ('flight_id', 'status'), False),
+    ('transactions', 'transactions_user_date', ('username', 'transaction_date', 'id'), False),
+    ('transactions', 'transactions_booking', ('booking_id', 'status'), False),
+    ('notifications', 'notifications_user_created', ('username', 'created_at', 'id'), False),
+    ('notifications', 'notifications_user_unread', ('username', 'is_read', 'id'), False),
+    ('feedback', 'feedback_booking', ('booking_id',), False),
+]
+
+
+def has_index(cursor, table, columns, unique=False):
+    # True if some index on `table` starts with `columns` (in order), whatever
+    # it's called, so indexes created by hand aren't duplicated.
+    cursor.execute("""
+        SELECT index_name, MIN(non_unique), GROUP_CONCAT(column_name ORDER BY seq_in_index)
+        FROM information_schema.statistics
+        WHERE table_schema = DATABASE() AND table_name = %s
+        GROUP BY index_name
+    """, (table,))
+    wanted = [column.lower() for column in columns]
+    for _, non_unique, indexed in cursor.fetchall():
+        indexed = [column.lower() for column in indexed.split(',')]
+        if indexed[:len(wanted)] == wanted and (not unique or (indexed == wanted and not non_unique)):
+            return True
+    return False
+
+
+def add_index(cursor, table, name, columns, unique=False):
+    if has_index(cursor, table, columns, unique):
+        return False
+    kind = 'UNIQUE INDEX' if unique else 'INDEX'
+    cursor.execute(f"ALTER TABLE {table} ADD {kind} {name} ({', '.join(columns)})")
+    return True
+
+
+def add_column(cursor, table, name, definition):
+    cursor.execute("""
+        SELECT COUNT(*) FROM information_schema.columns
+        WHERE table_schema = DATABASE() AND table_name = %s AND column_name = %s
+    """, (table, name))
+    if cursor.fetchone()[0]:
+        return False
+    cursor.execute(f"ALTER TABLE {table} ADD COLUMN {name} {definition}")
+    return True
+
+
+# -- migrations ------------------------------------------------------------------
+
+def _base_tables(cursor):
+    for statement in BASE_TABLES:
+        cursor.execute(statement)
+
+
+def _hot_query_indexes(cursor):
+    for table, name, columns, unique in INDEXES:
+        add_index(cursor, table, name, columns, unique)
+
+
+def _subsystem_tables(cursor):
+    seat_inventory.ensure_schema(cursor)
+    seat_inventory.sync_inventory(cursor)
+    auth.ensure_schema(cursor)
+    loyalty.ensure_schema(cursor)
+    notification_store.ensure_schema(cursor)
+    notification_store.rebuild_counters(cursor)
+    schedule_io.ensure_schema(cursor)
+
+
+def _booking_fares(cursor):
+    # Fare class and seat count per booking, for pricing.py.
+    add_column(cursor, 'bookings', 'fare_class', "VARCHAR(20) NOT NULL DEFAULT 'economy'")
+    add_column(cursor, 'bookings', 'seats', "INT NOT NULL DEFAULT 1")
+
+
+def _departure_index(cursor):
+    # For `flask prerender-tickets`, which looks flights up by date alone.
+    add_index(cursor, 'flights', 'flights_departure', ('departure_date',))
+
+
+def _feedback_ratings(cursor):
+    # One feedback row per booking, enforced by a unique key, and the rating
+    # aggregates built from what's there.
+    ratings.ensure_schema(cursor)
+    ratings.remove_duplicates(cursor)
+    add_index(cursor, 'feedback', 'feedback_booking_unique', ('booking_id',), unique=True)
+    cursor.execute("""
+        SELECT COUNT(*) FROM information_schema.statistics
+        WHERE table_schema = DATABASE() AND table_name = 'feedback' AND index_name = 'feedback_booking'
+    """)
+    if cursor.fetchone()[0]:
+        cursor.execute("ALTER TABLE feedback DROP INDEX feedback_booking")  # covered by the unique key
+    ratings.rebuild(cursor)
+
+
+MIGRATIONS = [
+    (1, 'base tables', _base_tables),
+    (2, 'hot query indexes', _hot_query_indexes),
+    (3, 'subsystem tables', _subsystem_tables),
+    (4, 'refund jobs', refund_jobs.ensure_schema),
+    (5, 'booking fare class and seats', _booking_fares),
+    (6, 'flight departure date index', _departure_index),
+    (7, 'unique feedback per booking and rating aggregates', _feedback_ratings),
+    (8, 'shared failed login counters', auth.ensure_schema),
+]
+
+
+def _ensure_version_table(cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INT PRIMARY KEY,
+            name VARCHAR(255) NOT NULL,
+            applied_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+
+
+def applied_versions(cursor):
+    _ensure_version_table(cursor)
+    cursor.execute("SELECT version FROM schema_migrations")
+    return {row[0] for row in cursor.fetchall()}
+
+
+def pending(cursor):
+    done = applied_versions(cursor)
+    return [migration for migration in MIGRATIONS if migration[0] not in done]
+
+
+def migrate(connection, target=None, log=print):
+    # Applies pending migrations up to `target` (default: all) and returns
+    # the versions applied. A named lock keeps two deploys from racing.
+    cursor = connection.cursor()
+    cursor.execute("SELECT GET_LOCK(%s, 60)", (LOCK_NAME,))
+    if cursor.fetchone()[0] != 1:
+        cursor.close()
+        raise RuntimeError("Another process is running migrations.")
+    applied = []
+    try:
+        for version, name, apply in pending(cursor):
+            if target is not None and version > target:
+                break
+            log(f"Applying {version}: {name}")
+            apply(cursor)
+            cursor.execute("INSERT INTO schema_migrations (version, name) VALUES (%s, %s)", (version, name))
+            connection.commit()
+            applied.append(version)
+    finally:
+        cursor.execute("SELECT RELEASE_LOCK(%s)", (LOCK_NAME,))
+        cursor.fetchall()
+        cursor.close()
+    return applied
+
+
+# -- query plan check --------------------------------------------------------------
+
+# Modules whose queries run on the request path.
+QUERY_SOURCES = (
+    'app.py', 'async_db.py', 'auth.py', 'booking_service.py', 'flight_index.py', 'history.py',
+    'loyalty.py', 'notification_store.py', 'pricing.py', 'refund_jobs.py', 'seat_inventory.py',
+    'ratings.py', 'ticket_store.py',
+)
+
+# Batch and maintenance functions that are expected to read whole tables.
+FULL_SCAN_OK = {
+    ('flight_index.py', 'load'),
+    ('loyalty.py', 'reconcile'),
+    ('notification_store.py', 'rebuild_counters'),
+    ('auth.py', 'purge_expired_sessions'),
+    ('seat_inventory.py', 'sync_inventory'),
+    ('pricing.py', '_load_factors'),
+    ('ratings.py', 'rebuild'),
+    ('ratings.py', 'remove_duplicates'),
+}
+
+_PLACEHOLDER = re.compile(r'%s')
+_COMPARED = re.compile(r'([A-Za-z_]\w*)\s*(?:=|<>|!=|<=|>=|<|>|BETWEEN|BETWEEN\s+\S+\s+AND)\s*$', re.IGNORECASE)
+_LIMIT = re.compile(r'(?:LIMIT|OFFSET|INTERVAL)\s*$', re.IGNORECASE)
+
+
+class _QueryCollector(ast.NodeVisitor):
+    def __init__(self, filename):
+        self.filename = filename
+        self.function = '<module>'
+        self.queries = []
+
+    def visit_FunctionDef(self, node):
+        outer = self.function
+        # Nested helpers (e.g. booking_service's work()) report their parent
+        if outer == '<module>':
+            self.function = node.name
+        self.generic_visit(node)
+        self.function = outer
+
+    def visit_Call(self, node):
+        func = node.func
+        if isinstance(func, ast.Attribute) and func.attr in ('execute', 'executemany') and node.args:
+            sql, dynamic = _literal_sql(node.args[0])
+            if sql is not None and _checkable(sql):
+                self.queries.append({
+                    'file': self.filename,
+                    'function': self.function,
+                    'line': node.lineno,
+                    'sql': ' '.join(sql.split()),
+                    'dynamic': dynamic,
+                })
+        self.generic_visit(node)
+
+
+def _literal_sql(node):
+    # Plain strings come back as-is. In f-strings a substitution inside
+    # "IN (...)" becomes one placeholder and any other is left out (the
+    # history pages add an optional keyset clause that way).
+    if isinstance(node, ast.Constant) and isinstance(node.value, str):
+        return node.value, False
+    if isinstance(node, ast.JoinedStr):
+        parts = []
+        for value in node.values:
+            if isinstance(value, ast.Constant):
+                parts.append(value.value)
+            elif parts and re.search(r'\bIN\s*\($', parts[-1], re.IGNORECASE):
+                parts.append('%s')
+        return ''.join(parts), True
+    return None, False
+
+
+def _checkable(sql):
+    words = sql.split(None, 1)
+    if not words or words[0].upper() not in ('SELECT', 'UPDATE', 'DELETE'):
+        return False
+    return 'information_schema' not in sql.lower()
+
+
+def collect_queries(root='.', sources=QUERY_SOURCES):
+    queries = []
+    for filename in sources:
+        with open(os.path.join(root, filename), encoding='utf-8') as handle:
+            collector = _QueryCollector(filename)
+            collector.visit(ast.parse(handle.read(), filename))
+            queries.extend(collector.queries)
+    return queries
+
+
+def _sample_value(prefix):
+    # A literal that keeps the optimiser on the same plan as a real
+    # parameter: quoted '1' compares cleanly to both INT and VARCHAR columns.
+    if _LIMIT.search(prefix):
+        return '10'
+    match = _COMPARED.search(prefix)
+    column = match.group(1).lower() if match else ''
+    if 'date' in column or column.endswith('_at'):
+        return "'2030-01-01 00:00:00'"
+    return "'1'"
+
+
+def with_sample_params(sql):
+    out = []
+    last = 0
+    for match in _PLACEHOLDER.finditer(sql):
+        out.append(sql[last:match.start()])
+        out.append(_sample_value(sql[:match.start()]))
+        last = match.end()
+    out.append(sql[last:])
+    return ''.join(out)
+
+
+def verify(connection, root='.'):
+    # Returns (full scans, errors, skipped, number of queries checked).
+    # f-string queries that don't parse without their substitutions are
+    # skipped rather than counted as errors.
+    full_scans = []
+    errors = []
+    skipped = []
+    queries = collect_queries(root)
+    cursor = connection.cursor(dictionary=True)
+    try:
+        for query in queries:
+            try:
+                cursor.execute('EXPLAIN ' + with_sample_params(query['sql']))
+                plan = cursor.fetchall()
+            except Exception as error:
+                connection.rollback()
+                (skipped if query['dynamic'] else errors).append(dict(query, error=str(error)))
+                continue
+            if (query['file'], query['function']) in FULL_SCAN_OK:
+                continue
+            for step in plan:
+                table = step.get('table') or ''
+                if step.get('type') == 'ALL' and not table.startswith('<'):
+                    full_scans.append(dict(query, table=table, rows=step.get('rows')))
+    finally:
+        cursor.close()
+    return full_scans, errors, skipped, len(queries)
@@ -0,0 +1,281 @@
+# Background writer for user notifications.
+#
+# Request handlers call publish() and return straight away. Events go onto a
+# bounded in-process queue and a small pool of worker threads writes them in
+# multi-row INSERTs, either when a batch fills up or when the flush interval
+# passes. Every event is also appended to a per-process spool file before it
+# is queued; the spool is truncated once everything in it has reached the
+# database, and spools left behind by a dead process are replayed on start.
+#
+# When the queue is full, publish() waits briefly and then writes the events
+# itself, so memory stays bounded and nothing is dropped.
+import atexit
+import glob
+import json
+import logging
+import os
+import queue
+import threading
+import time
+
+import notification_store
+from db_connection import get_db_connection
+
+logger = logging.getLogger(__name__)
+
+SPOOL_PREFIX = 'notifications-'
+SPOOL_SUFFIX = '.spool'
+
+
+class NotificationQueue:
+    def __init__(self, connect, spool_dir, max_pending=10000, batch_size=200,
+                 flush_interval=0.5, workers=2, put_timeout=0.5):
+        self._connect = connect
+        self.spool_dir = spool_dir
+        self.max_pending = max_pending
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.workers = workers
+        self.put_timeout = put_timeout
+
+        self._queue = None
+        self._threads = []
+        self._started = False
+        self._pid = None
+        self._stopping = threading.Event()
+        self._start_lock = threading.Lock()
+
+        self._spool = None
+        self._spool_lock = threading.Lock()
+        self._unwritten = 0  # events in the spool not yet committed to the database
+
+        self.published = 0
+        self.written = 0
+        self.batches = 0
+        self.overflow_writes = 0
+        self.write_failures = 0
+
+    def configure(self, spool_dir=None, max_pending=None, batch_size=None, flush_interval=None, workers=None):
+        if spool_dir is not None:
+            self.spool_dir = spool_dir
+        if max_pending is not None:
+            self.max_pending = int(max_pending)
+        if batch_size is not None:
+            self.batch_size = int(batch_size)
+        if flush_interval is not None:
+            self.flush_interval = float(flush_interval)
+        if workers is not None:
+            self.workers = int(workers)
+
+    # -- publishing ----------------------------------------------------------
+
+    def publish(self, username, messages):
+        rows = [(username, message) for message in messages]
+        if not rows:
+            return
+        self._ensure_started()
+        self._append_to_spool(rows)
+        self.published += len(rows)
+        try:
+            self._queue.put(rows, timeout=self.put_timeout)
+        except queue.Full:
+            # Backpressure: the writers can't keep up, so this request pays for
+            # its own insert rather than letting the queue grow without bound.
+            self.overflow_writes += 1
+            if not self._write(rows):
+                # Database trouble as well; wait for room so the workers retry it.
+                self._queue.put(rows)
+
+    def pending(self):
+        return self._queue.qsize() if self._queue else 0
+
+    def stats(self):
+        return {
+            'pending': self.pending(),
+            'unwritten': self._unwritten,
+            'published': self.published,
+            'written': self.written,
+            'batches': self.batches,
+            'overflow_writes': self.overflow_writes,
+            'write_failures': self.write_failures,
+        }
+
+    # -- lifecycle -----------------------------------------------------------
+
+    def start(self):
+        with self._start_lock:
+            if self._started:
+                return
+            os.makedirs(self.spool_dir, exist_ok=True)
+            self._queue = queue.Queue(maxsize=self.max_pending)
+            # A spool already at our path belongs to an earlier process that
+            # had the same pid (pids are reused, e.g. in containers). Move it
+            # aside before opening ours so its rows are replayed rather than
+            # appended to and then truncated away.
+            spool_path = self._spool_path(os.getpid())
+            inherited = self._claim_spool(spool_path)
+            self._spool = open(spool_path, 'a', encoding='utf-8')
+            self._stopping.clear()
+            self._threads = [
+                threading.Thread(target=self._worker, name=f'notification-writer-{i}', daemon=True)
+                for i in range(self.workers)
+            ]
+            for thread in self._threads:
+                thread.start()
+            if self._pid is None:
+                atexit.register(self.stop)
+            self._started = True
+            self._pid = os.getpid()
+        if inherited:
+            self._replay_spool(inherited, spool_path)
+        self._replay_orphaned_spools()
+
+    def stop(self, timeout=5.0):
+        if not self._started:
+            return
+        self.flush(timeout)
+        self._stopping.set()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._started = False
+
+    def flush(self, timeout=5.0):
+        # Wait until everything published so far has been written.
+        deadline = time.monotonic() + timeout
+        while self._unwritten and time.monotonic() < deadline:
+            time.sleep(0.01)
+        return self._unwritten == 0
+
+    def _ensure_started(self):
+        # Started lazily (and again after a fork) so worker threads always
+        # belong to the process that is serving requests.
+        if not self._started or self._pid != os.getpid():
+            if self._started:
+                self._started = False
+                self._unwritten = 0
+            self.start()
+
+    # -- workers -------------------------------------------------------------
+
+    def _worker(self):
+        while not self._stopping.is_set():
+            try:
+                rows = self._queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                continue
+            batch = list(rows)
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.extend(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self._write_with_retry(batch)
+
+    def _write_with_retry(self, rows):
+        delay = 0.1
+        while not self._write(rows):
+            if self._stopping.wait(delay):
+                return  # still in the spool; replayed on next start
+            delay = min(delay * 2, 5.0)
+
+    def _write(self, rows):
+        try:
+            connection = self._connect()
+        except Exception:
+            self.write_failures += 1
+            logger.exception("Could not get a connection to write %d notifications", len(rows))
+            return False
+        try:
+            cursor = connection.cursor()
+            notification_store.insert(cursor, rows)
+            connection.commit()
+            cursor.close()
+        except Exception:
+            self.write_failures += 1
+            logger.exception("Writing %d notifications failed", len(rows))
+            return False
+        finally:
+            connection.close()
+        self.batches += 1
+        self.written += len(rows)
+        self._mark_written(len(rows))
+        return True
+
+    # -- spool ---------------------------------------------------------------
+
+    def _spool_path(self, pid):
+        return os.path.join(self.spool_dir, f'{SPOOL_PREFIX}{pid}{SPOOL_SUFFIX}')
+
+    def _append_to_spool(self, rows):
+        lines = ''.join(json.dumps(row) + '\n' for row in rows)
+        with self._spool_lock:
+            # flush() hands the data to the OS, which is enough to survive a
+            # process restart without paying for an fsync on every request.
+            self._spool.write(lines)
+            self._spool.flush()
+            self._unwritten += len(rows)
+
+    def _mark_written(self, count):
+        with self._spool_lock:
+            self._unwritten -= count
+            if self._unwritten <= 0:
+                self._unwritten = 0
+                self._spool.seek(0)
+                self._spool.truncate()
+
+    def _replay_orphaned_spools(self):
+        pattern = os.path.join(self.spool_dir, f'{SPOOL_PREFIX}*{SPOOL_SUFFIX}')
+        for path in glob.glob(pattern):
+            pid = os.path.basename(path)[len(SPOOL_PREFIX):-len(SPOOL_SUFFIX)]
+            if not pid.isdigit() or int(pid) == os.getpid() or _process_alive(int(pid)):
+                continue
+            claimed = self._claim_spool(path)
+            if claimed:
+                self._replay_spool(claimed, path)
+
+    def _claim_spool(self, path):
+        # Claims the file with an atomic rename so only one process replays it.
+        claimed = f'{path}.replay-{os.getpid()}'
+        try:
+            os.rename(path, claimed)
+        except OSError:
+            return None
+        return claimed
+
+    def _replay_spool(self, claimed, path):
+        with open(claimed, encoding='utf-8') as spool:
+            rows = [tuple(json.loads(line)) for line in spool if line.strip()]
+        for start in range(0, len(rows), self.batch_size):
+            chunk = rows[start:start + self.batch_size]
+            self._append_to_spool(chunk)
+            self._queue.put(chunk)
+        os.remove(claimed)
+        logger.info("Replayed %d spooled notifications from %s", len(rows), path)
+
+
+def _process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def init_app(app):
+    notification_queue.configure(
+        spool_dir=app.config.get('NOTIFICATION_SPOOL_DIR', os.environ.get('NOTIFICATION_SPOOL_DIR', os.path.join(app.instance_path, 'spool'))),
+        max_pending=app.config.get('NOTIFICATION_MAX_PENDING', os.environ.get('NOTIFICATION_MAX_PENDING')),
+        batch_size=app.config.get('NOTIFICATION_BATCH_SIZE', os.environ.get('NOTIFICATION_BATCH_SIZE')),
+        flush_interval=app.config.get('NOTIFICATION_FLUSH_INTERVAL', os.environ.get('NOTIFICATION_FLUSH_INTERVAL')),
+        workers=app.config.get('NOTIFICATION_WORKERS', os.environ.get('NOTIFICATION_WORKERS')),
+    )
+
+
+# Shared per-process queue; booking_service publishes to it after each commit.
+notification_queue = NotificationQueue(get_db_connection, spool_dir=os.path.join('instance', 'spool'))
@@ -0,0 +1,151 @@
+# Reads and writes for the notifications table.
+#
+# Pages are fetched with keyset pagination on (created_at, id) instead of
+# pulling a user's whole history, and each user's unread total lives in
+# notification_counters so the badge never has to count rows. The counter is
+# bumped in the same transaction as the inserts and lowered by however many
+# rows mark_read() actually flipped.
+from datetime import datetime
+
+PAGE_SIZE = 20
+POLL_LIMIT = 50
+
+SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS notification_counters (
+        username VARCHAR(255) PRIMARY KEY,
+        unread INT NOT NULL DEFAULT 0
+    )
+    """,
+]
+
+
+def ensure_schema(cursor):
+    for statement in SCHEMA:
+        cursor.execute(statement)
+
+
+def insert(cursor, rows):
+    # rows: [(username, message), ...]
+    if not rows:
+        return
+    per_user = {}
+    for username, _ in rows:
+        per_user[username] = per_user.get(username, 0) + 1
+
+    # A user with no counter row yet (one who predates the counters table)
+    # gets one seeded with their current unread count before the new rows go
+    # in, so the increment below starts from the real total rather than 0.
+    # Users with nothing unread are left to the increment.
+    cursor.executemany("""
+        INSERT INTO notification_counters (username, unread)
+        SELECT %s, COUNT(*) FROM notifications
+        WHERE username = %s AND is_read = FALSE
+          AND NOT EXISTS (SELECT 1 FROM notification_counters WHERE username = %s)
+        HAVING COUNT(*) > 0
+        ON DUPLICATE KEY UPDATE unread = unread
+    """, [(username, username, username) for username in per_user])
+
+    cursor.executemany("INSERT INTO notifications (username, message) VALUES (%s, %s)", rows)
+    cursor.executemany("""
+        INSERT INTO notification_counters (username, unread) VALUES (%s, %s)
+        ON DUPLICATE KEY UPDATE unread = unread + VALUES(unread)
+    """, list(per_user.items()))
+
+
+def encode_cursor(row):
+    return f"{row['id']}:{row['created_at'].isoformat()}"
+
+
+def decode_cursor(value):
+    try:
+        row_id, created_at = value.split(':', 1)
+        return datetime.fromisoformat(created_at), int(row_id)
+    except (AttributeError, ValueError):
+        return None
+
+
+def page(cursor, username, before=None, limit=PAGE_SIZE):
+    # Newest first. Returns (rows, cursor for the next page or None).
+    position = decode_cursor(before) if before else None
+    if position:
+        created_at, row_id = position
+        cursor.execute("""
+            SELECT * FROM notifications
+            WHERE username = %s AND (created_at < %s OR (created_at = %s AND id < %s))
+            ORDER BY created_at DESC, id DESC
+            LIMIT %s
+        """, (username, created_at, created_at, row_id, limit + 1))
+    else:
+        cursor.execute("""
+            SELECT * FROM notifications
+            WHERE username = %s
+            ORDER BY created_at DESC, id DESC
+            LIMIT %s
+        """, (username, limit + 1))
+    rows = cursor.fetchall()
+    next_cursor = encode_cursor(rows[limit - 1]) if len(rows) > limit else None
+    return rows[:limit], next_cursor
+
+
+def since(cursor, username, after_id, limit=POLL_LIMIT):
+    # Notifications newer than `after_id`, oldest first, for polling clients.
+    cursor.execute("""
+        SELECT id, message, is_read, created_at FROM notifications
+        WHERE username = %s AND id > %s
+        ORDER BY id
+        LIMIT %s
+    """, (username, after_id, limit))
+    return cursor.fetchall()
+
+
+def unread_count(cursor, username, seed=True):
+    cursor.execute("SELECT unread FROM notification_counters WHERE username = %s", (username,))
+    row = cursor.fetchone()
+    if row is not None:
+        return row['unread']
+    # No counter yet (user predates the counters table); seed it once. Reads
+    # that may be on a replica pass seed=False and just count.
+    cursor.execute(
+        "SELECT COUNT(*) AS unread FROM notifications WHERE username = %s AND is_read = FALSE",
+        (username,)
+    )
+    unread = cursor.fetchone()['unread']
+    if not seed:
+        return unread
+    cursor.execute(
+        "INSERT IGNORE INTO notification_counters (username, unread) VALUES (%s, %s)",
+        (username, unread)
+    )
+    return unread
+
+
+def mark_read(cursor, username, up_to_id=None):
+    # Only flips rows that are still unread, and only up to the newest id the
+    # user has seen, so notifications that arrive meanwhile stay unread.
+    if up_to_id is None:
+        cursor.execute("SELECT MAX(id) AS max_id FROM notifications WHERE username = %s", (username,))
+        up_to_id = cursor.fetchone()['max_id']
+        if up_to_id is None:
+            return 0
+    cursor.execute("""
+        UPDATE notifications SET is_read = TRUE
+        WHERE username = %s AND is_read = FALSE AND id <= %s
+    """, (username, up_to_id))
+    changed = cursor.rowcount
+    if changed:
+        cursor.execute(
+            "UPDATE notification_counters SET unread = GREATEST(unread - %s, 0) WHERE username = %s",
+            (changed, username)
+        )
+    return changed
+
+
+def rebuild_counters(cursor):
+    # Recompute every user's unread total from the notifications table.
+    cursor.execute("""
+        INSERT INTO notification_counters (username, unread)
+        SELECT username, SUM(is_read = FALSE) FROM notifications GROUP BY username
+        ON DUPLICATE KEY UPDATE unread = VALUES(unread)
+    """)
+    return cursor.rowcount
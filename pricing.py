@@ -0,0 +1,420 @@
+# Fares per cabin class and passenger count, with load-factor pricing and
+# loyalty point redemption.
+#
+# A seat's fare is the flight's base price x the class multiplier x a load
+# multiplier that steps up as the flight fills (LOAD_BANDS). FareTable keeps
+# that fare for every flight and every class in one precomputed array, built
+# from the flight index and the seat_inventory counters, so pricing a page of
+# search results is a single batched lookup rather than per-row arithmetic.
+# After a booking or a flight index refresh, the next lookup re-prices just
+# the flights that changed, patching their rows in place (and inserting or
+# dropping rows for flights added to or removed from the index). The whole
+# table is rebuilt, with every load re-read, every FARE_TABLE_TTL seconds and
+# after the flight index is reloaded. NumPy is optional; without it the table
+# is plain lists.
+#
+# Single quotes (the payment page and checkout) are cached for
+# QUOTE_CACHE_TTL seconds and dropped when the flight is booked.
+import bisect
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+
+try:
+    import numpy as np
+except ImportError:  # optional: plain lists are used without it
+    np = None
+
+from db_connection import get_db_connection
+from flight_index import flight_index
+
+FARE_TABLE_TTL = float(os.environ.get('FARE_TABLE_TTL', 60))
+QUOTE_CACHE_TTL = float(os.environ.get('QUOTE_CACHE_TTL', 15))
+QUOTE_CACHE_SIZE = 10000
+MAX_PASSENGERS = 9
+
+POINT_VALUE = 0.1                   # 1 point = $0.10 discount
+DOLLARS_PER_POINT_EARNED = 10       # 1 point earned per $10 spent
+
+# classType values from the search form -> multiplier on the base price
+CLASS_MULTIPLIERS = {
+    'economy': 1.0,
+    'business': 2.5,
+    'first-class': 4.0,
+}
+CLASSES = tuple(CLASS_MULTIPLIERS)
+DEFAULT_CLASS = 'economy'
+
+# Load factor (share of seats sold) at which each multiplier starts
+LOAD_BANDS = [
+    (0.0, 1.0),
+    (0.5, 1.1),
+    (0.7, 1.25),
+    (0.85, 1.45),
+    (0.95, 1.7),
+]
+_LOAD_THRESHOLDS = [threshold for threshold, _ in LOAD_BANDS[1:]]
+_LOAD_MULTIPLIERS = [multiplier for _, multiplier in LOAD_BANDS]
+
+
+def fare_class(value):
+    return value if value in CLASS_MULTIPLIERS else DEFAULT_CLASS
+
+
+def passenger_count(value):
+    try:
+        count = int(value)
+    except (TypeError, ValueError):
+        return 1
+    return min(max(count, 1), MAX_PASSENGERS)
+
+
+def load_multiplier(load):
+    return _LOAD_MULTIPLIERS[bisect.bisect_right(_LOAD_THRESHOLDS, load)]
+
+
+def seat_fare(price, class_type=DEFAULT_CLASS, load=0.0):
+    return round(float(price) * CLASS_MULTIPLIERS[fare_class(class_type)] * load_multiplier(load), 2)
+
+
+def with_points(total, points_to_redeem):
+    # Loyalty redemption on top of a quoted total.
+    discount = points_to_redeem * POINT_VALUE
+    final_price = max(0, float(total) - discount)
+    points_earned = int(final_price // DOLLARS_PER_POINT_EARNED)
+    return discount, final_price, points_earned
+
+
+def _fare_rows(base, loads):
+    # Per-seat fares, one row per flight and one column per class.
+    if np is not None:
+        multipliers = np.asarray(_LOAD_MULTIPLIERS)[np.searchsorted(_LOAD_THRESHOLDS, loads, side='right')]
+        classes = np.asarray([CLASS_MULTIPLIERS[name] for name in CLASSES])
+        return np.round(base[:, None] * classes[None, :] * multipliers[:, None], 2)
+    return [[seat_fare(price, name, load) for name in CLASSES] for price, load in zip(base, loads)]
+
+
+class FareTable:
+    def __init__(self, connect, ttl=60.0):
+        self._connect = connect
+        self.ttl = ttl
+
+        self._lock = threading.Lock()
+        self._build_lock = threading.Lock()
+        self._ids = []       # sorted flight ids
+        self._loads = []     # load factor per flight
+        self._fares = []     # per-seat fare per flight and class
+        self._dirty = set()  # booked since the last build
+        self._version = None # flight index version the table was built from
+        self._loaded_at = 0.0
+        self.builds = 0
+        self.patches = 0
+        self.revision = 0    # bumped whenever any fare may have changed
+
+    def configure(self, ttl=None):
+        if ttl is not None:
+            self.ttl = float(ttl)
+
+    def stats(self):
+        return {'flights': len(self._ids), 'builds': self.builds, 'patches': self.patches, 'numpy': int(np is not None)}
+
+    def invalidate(self, flight_id=None):
+        # A booking changed this flight's load; with no id, reload every load.
+        with self._lock:
+            if flight_id is None:
+                self._loaded_at = 0.0
+            else:
+                self._dirty.add(int(flight_id))
+
+    def current_revision(self):
+        # The revision after any due rebuild or patch, for cache keys.
+        self._maybe_build()
+        return self.revision
+
+    def fares(self, flights, class_type=DEFAULT_CLASS, passengers=1):
+        # Total fare for `passengers` seats on each flight, in order.
+        self._maybe_build()
+        with self._lock:
+            ids, fares = self._ids, self._fares
+        column = CLASSES.index(fare_class(class_type))
+        wanted = [int(flight['id']) for flight in flights]
+
+        if np is not None:
+            wanted = np.asarray(wanted, dtype=np.int64)
+            positions = np.minimum(np.searchsorted(ids, wanted), max(len(ids) - 1, 0))
+            found = ids[positions] == wanted if len(ids) else np.zeros(len(wanted), dtype=bool)
+            totals = np.where(found, fares[positions, column] if len(ids) else 0.0, np.nan) * passengers
+            totals = np.round(totals, 2).tolist()
+        else:
+            totals = []
+            for flight_id in wanted:
+                position = bisect.bisect_left(ids, flight_id)
+                if position < len(ids) and ids[position] == flight_id:
+                    totals.append(round(fares[position][column] * passengers, 2))
+                else:
+                    totals.append(float('nan'))
+
+        # Flights added after the last build are priced as empty until then.
+        return [
+            round(seat_fare(flight['price'], class_type) * passengers, 2) if math.isnan(total) else total
+            for flight, total in zip(flights, totals)
+        ]
+
+    def build(self, reuse_loads=False):
+        # Rebuilds the table from the flight index. With reuse_loads, only the
+        # load factors of new and recently booked flights are read again.
+        with self._lock:
+            dirty = set(self._dirty)
+            self._dirty.clear()
+            known = dict(zip(list(self._ids), list(self._loads))) if reuse_loads else None
+        version = flight_index.version
+        flights = sorted(flight_index.all_flights(), key=lambda flight: flight['id'])
+        ids = [flight['id'] for flight in flights]
+        if known is None:
+            loads = self._load_factors()
+        else:
+            stale = [flight_id for flight_id in ids if flight_id in dirty or flight_id not in known]
+            loads = dict(known)
+            fresh = self._load_factors(stale)
+            for flight_id in stale:
+                loads[flight_id] = fresh.get(flight_id, 0.0)
+        self.load(flights, loads, version, reloaded=known is None)
+
+    def load(self, flights, loads, version=None, reloaded=True):
+        # Installs fares for `flights` (sorted by id) given {flight id: load factor}.
+        ids = [flight['id'] for flight in flights]
+        base = [float(flight['price']) for flight in flights]
+        load = [loads.get(flight_id, 0.0) for flight_id in ids]
+        if np is not None:
+            ids = np.asarray(ids, dtype=np.int64)
+            base = np.asarray(base, dtype=np.float64)
+            load = np.asarray(load, dtype=np.float64)
+        fares = _fare_rows(base, load)
+
+        # Swapped in whole, so readers never see a half-built table.
+        with self._lock:
+            self._ids, self._loads, self._fares = ids, load, fares
+            self._version = flight_index.version if version is None else version
+            if reloaded:
+                self._loaded_at = time.monotonic()
+            self.builds += 1
+            self.revision += 1
+
+    def patch(self, flight_ids, version=None):
+        # Re-prices just these flights from the flight index and their current
+        # loads. Rows already in the table are updated in place; flights new
+        # to the index are inserted at their sorted position, and flights no
+        # longer in it are dropped.
+        wanted = sorted({int(flight_id) for flight_id in flight_ids})
+        rows = {flight_id: flight_index.get(flight_id) for flight_id in wanted}
+        loads = self._load_factors([flight_id for flight_id in wanted if rows[flight_id] is not None])
+        alive = [rows[flight_id] is not None for flight_id in wanted]
+        base = [float(rows[flight_id]['price']) if rows[flight_id] else 0.0 for flight_id in wanted]
+        load = [loads.get(flight_id, 0.0) for flight_id in wanted]
+        if np is not None:
+            wanted = np.asarray(wanted, dtype=np.int64)
+            alive = np.asarray(alive, dtype=bool)
+            base = np.asarray(base, dtype=np.float64)
+            load = np.asarray(load, dtype=np.float64)
+        fares = _fare_rows(base, load)
+
+        with self._lock:
+            if np is not None:
+                self._patch_arrays(wanted, alive, load, fares)
+            else:
+                self._patch_lists(wanted, alive, load, fares)
+            self._version = flight_index.version if version is None else version
+            self.patches += 1
+            self.revision += 1
+
+    def _patch_arrays(self, wanted, alive, load, fares):
+        # Caller holds the lock.
+        ids = self._ids
+        positions = np.searchsorted(ids, wanted)
+        present = np.zeros(len(wanted), dtype=bool)
+        if len(ids):
+            inside = positions < len(ids)
+            present[inside] = ids[positions[inside]] == wanted[inside]
+        update = present & alive
+        self._loads[positions[update]] = load[update]
+        self._fares[positions[update]] = fares[update]
+
+        drop, add = present & ~alive, ~present & alive
+        if drop.any() or add.any():
+            # Structural changes go into new arrays, so readers holding the
+            # old ones are unaffected.
+            keep = np.ones(len(ids), dtype=bool)
+            keep[positions[drop]] = False
+            ids, loads, rows = ids[keep], self._loads[keep], self._fares[keep]
+            at = np.searchsorted(ids, wanted[add])
+            self._ids = np.insert(ids, at, wanted[add])
+            self._loads = np.insert(loads, at, load[add])
+            self._fares = np.insert(rows, at, fares[add], axis=0)
+
+    def _patch_lists(self, wanted, alive, load, fares):
+        # Caller holds the lock.
+        ids, loads, rows = self._ids, self._loads, self._fares
+        copied = False
+        for flight_id, live, flight_load, fare_row in zip(wanted, alive, load, fares):
+            position = bisect.bisect_left(ids, flight_id)
+            present = position < len(ids) and ids[position] == flight_id
+            if present and live:
+                loads[position], rows[position] = flight_load, fare_row
+                continue
+            if not present and not live:
+                continue
+            if not copied:
+                ids, loads, rows = list(ids), list(loads), list(rows)
+                copied = True
+            if present:
+                del ids[position], loads[position], rows[position]
+            else:
+                ids.insert(position, flight_id)
+                loads.insert(position, flight_load)
+                rows.insert(position, fare_row)
+        self._ids, self._loads, self._fares = ids, loads, rows
+
+    def _maybe_build(self):
+        if (not self._dirty and self._version == flight_index.version
+                and self._loaded_at and time.monotonic() - self._loaded_at <= self.ttl):
+            return
+        with self._build_lock:
+            if not self._loaded_at or time.monotonic() - self._loaded_at > self.ttl:
+                self.build()
+                return
+            version = flight_index.version
+            changed = set() if self._version == version else flight_index.changed_since(self._version)
+            if changed is None:
+                # The index was reloaded; anything may have changed.
+                self.build(reuse_loads=True)
+                return
+            with self._lock:
+                dirty = set(self._dirty)
+                self._dirty.clear()
+            self.patch(changed | dirty, version)
+
+    def _load_factors(self, flight_ids=None):
+        query = "SELECT flight_id, capacity, available FROM seat_inventory"
+        params = ()
+        if flight_ids is not None:
+            if not flight_ids:
+                return {}
+            query += f" WHERE flight_id IN ({', '.join(['%s'] * len(flight_ids))})"
+            params = tuple(flight_ids)
+        connection = self._connect()
+        try:
+            cursor = connection.cursor(dictionary=True)
+            cursor.execute(query, params)
+            rows = cursor.fetchall()
+            cursor.close()
+        finally:
+            connection.close()
+        return {
+            row['flight_id']: 1 - row['available'] / row['capacity'] if row['capacity'] else 0.0
+            for row in rows
+        }
+
+
+class QuoteCache:
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        self._entries = OrderedDict()  # (flight id, class, passengers) -> (quote, cached until)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[1] < now:
+                self._entries.pop(key, None)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, quote):
+        with self._lock:
+            self._entries[key] = (quote, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def discard_flight(self, flight_id):
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == flight_id]:
+                del self._entries[key]
+
+    def stats(self):
+        return {'entries': len(self._entries), 'hits': self.hits, 'misses': self.misses}
+
+
+fare_table = FareTable(get_db_connection, FARE_TABLE_TTL)
+quote_cache = QuoteCache(QUOTE_CACHE_SIZE, QUOTE_CACHE_TTL)
+
+
+def quote(flight, class_type=DEFAULT_CLASS, passengers=1):
+    class_type = fare_class(class_type)
+    passengers = passenger_count(passengers)
+    key = (int(flight['id']), class_type, passengers)
+    cached = quote_cache.get(key)
+    if cached is not None:
+        return cached
+    total = fare_table.fares([flight], class_type, passengers)[0]
+    result = {
+        'flight_id': key[0],
+        'class_type': class_type,
+        'passengers': passengers,
+        'fare': round(total / passengers, 2),
+        'total': total,
+    }
+    quote_cache.put(key, result)
+    return result
+
+
+def invalidate(flight_id):
+    # Called after a booking or cancellation changes the flight's load.
+    fare_table.invalidate(flight_id)
+    quote_cache.discard_flight(int(flight_id))
+
+
+def price_flights(flights_by_number, class_type=DEFAULT_CLASS, passengers=1):
+    # Copies of the grouped search results with `price` set to the total fare,
+    # priced in one batch.
+    flights = [flight for group in flights_by_number.values() for flight in group]
+    totals = iter(fare_table.fares(flights, class_type, passengers))
+    return {
+        number: [dict(flight, price=next(totals)) for flight in group]
+        for number, group in flights_by_number.items()
+    }
+
+
+def price_itineraries(itineraries, class_type=DEFAULT_CLASS, passengers=1):
+    # Same for route_search results (one-way itineraries or round-trip pairs).
+    # Itineraries keep the order route search ranked them in by base fare.
+    def one_way(itinerary, totals):
+        legs = [dict(leg, price=next(totals)) for leg in itinerary['legs']]
+        return dict(itinerary, legs=legs, price=round(sum(leg['price'] for leg in legs), 2))
+
+    trips = [part for itinerary in itineraries for part in (
+        (itinerary['outbound'], itinerary['return']) if 'outbound' in itinerary else (itinerary,)
+    )]
+    totals = iter(fare_table.fares([leg for trip in trips for leg in trip['legs']], class_type, passengers))
+    priced = []
+    for itinerary in itineraries:
+        if 'outbound' in itinerary:
+            out, back = one_way(itinerary['outbound'], totals), one_way(itinerary['return'], totals)
+            priced.append({'outbound': out, 'return': back, 'price': round(out['price'] + back['price'], 2)})
+        else:
+            priced.append(one_way(itinerary, totals))
+    return priced
+
+
+def init_app(app):
+    fare_table.configure(ttl=app.config.get('FARE_TABLE_TTL', os.environ.get('FARE_TABLE_TTL')))
+    quote_cache.ttl = float(app.config.get('QUOTE_CACHE_TTL', QUOTE_CACHE_TTL))
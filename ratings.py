@@ -0,0 +1,212 @@
+# Feedback ratings, aggregated per flight number and per route.
+#
+# flight_ratings and route_ratings hold a running sum and count of ratings,
+# bumped in the same transaction as each feedback insert, so an average is
+# one primary-key read instead of an aggregate over feedback. rebuild()
+# recomputes both from the feedback table if they ever drift.
+#
+# feedback.booking_id is unique: a booking gets one rating, and a repeat
+# submission is turned away by the duplicate-key error.
+#
+# Search results look ratings up for all their flight numbers in one query;
+# the results are cached per key for RATINGS_CACHE_TTL seconds.
+import os
+import threading
+import time
+
+import mysql.connector
+
+CACHE_TTL = float(os.environ.get('RATINGS_CACHE_TTL', 60))
+MIN_RATING = 1
+MAX_RATING = 5
+DUPLICATE_KEY = 1062  # ER_DUP_ENTRY
+
+SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS flight_ratings (
+        flight_number VARCHAR(20) PRIMARY KEY,
+        rating_sum BIGINT NOT NULL DEFAULT 0,
+        rating_count INT NOT NULL DEFAULT 0
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS route_ratings (
+        source VARCHAR(100) NOT NULL,
+        destination VARCHAR(100) NOT NULL,
+        rating_sum BIGINT NOT NULL DEFAULT 0,
+        rating_count INT NOT NULL DEFAULT 0,
+        PRIMARY KEY (source, destination)
+    )
+    """,
+]
+
+
+class InvalidRating(Exception):
+    pass
+
+
+def ensure_schema(cursor):
+    for statement in SCHEMA:
+        cursor.execute(statement)
+
+
+def parse_rating(value):
+    try:
+        rating = int(value)
+    except (TypeError, ValueError):
+        raise InvalidRating(value)
+    if not MIN_RATING <= rating <= MAX_RATING:
+        raise InvalidRating(value)
+    return rating
+
+
+def average(rating_sum, rating_count):
+    return round(rating_sum / rating_count, 2) if rating_count else None
+
+
+# -- writes (caller commits) ---------------------------------------------------
+
+def submit(cursor, booking, username, rating, comments):
+    # Records feedback for one of the user's bookings and folds the rating
+    # into the aggregates. Returns False if the booking already has feedback.
+    # A plain INSERT rather than INSERT IGNORE, which would also turn bad
+    # data (truncated comments, invalid values) into a silent "already rated".
+    try:
+        cursor.execute("""
+            INSERT INTO feedback (booking_id, username, rating, comments)
+            VALUES (%s, %s, %s, %s)
+        """, (booking['id'], username, rating, comments))
+    except mysql.connector.IntegrityError as e:
+        if e.errno == DUPLICATE_KEY:
+            return False
+        raise
+
+    cursor.execute("""
+        INSERT INTO flight_ratings (flight_number, rating_sum, rating_count)
+        SELECT flight_number, %s, 1 FROM flights WHERE id = %s
+        ON DUPLICATE KEY UPDATE rating_sum = rating_sum + VALUES(rating_sum), rating_count = rating_count + 1
+    """, (rating, booking['flight_id']))
+    cursor.execute("""
+        INSERT INTO route_ratings (source, destination, rating_sum, rating_count)
+        SELECT source, destination, %s, 1 FROM flights WHERE id = %s
+        ON DUPLICATE KEY UPDATE rating_sum = rating_sum + VALUES(rating_sum), rating_count = rating_count + 1
+    """, (rating, booking['flight_id']))
+    return True
+
+
+# -- cached reads ----------------------------------------------------------------
+
+_cache = {}  # ('flight', number) or ('route', source, destination) -> (rating, cached until)
+_cache_lock = threading.Lock()
+
+
+def cache_epoch():
+    # Moves on every CACHE_TTL seconds; cached pages that show ratings put it
+    # in their key so they are no staler than the ratings cache.
+    return int(time.monotonic() // CACHE_TTL) if CACHE_TTL > 0 else time.monotonic()
+
+
+def lookup(connect, flight_numbers=(), routes=()):
+    # {flight number: rating} and {(source, destination): rating}, where a
+    # rating is {'average': ..., 'count': ...}, or None if there are none.
+    # Only keys missing from the cache are queried, each kind in one query.
+    now = time.monotonic()
+    wanted = [('flight', number) for number in flight_numbers] + [('route',) + tuple(route) for route in routes]
+    found = {}
+    missing = []
+    for key in wanted:
+        entry = _cache.get(key)
+        if entry is not None and entry[1] > now:
+            found[key] = entry[0]
+        else:
+            missing.append(key)
+
+    if missing:
+        fetched = _fetch(connect, missing)
+        with _cache_lock:
+            for key in missing:
+                found[key] = fetched.get(key)
+                _cache[key] = (found[key], now + CACHE_TTL)
+
+    by_number = {key[1]: found[key] for key in wanted if key[0] == 'flight'}
+    by_route = {key[1:]: found[key] for key in wanted if key[0] == 'route'}
+    return by_number, by_route
+
+
+def _fetch(connect, keys):
+    numbers = [key[1] for key in keys if key[0] == 'flight']
+    routes = [key[1:] for key in keys if key[0] == 'route']
+    fetched = {}
+    connection = connect()
+    try:
+        cursor = connection.cursor(dictionary=True)
+        if numbers:
+            cursor.execute(f"""
+                SELECT flight_number, rating_sum, rating_count FROM flight_ratings
+                WHERE flight_number IN ({', '.join(['%s'] * len(numbers))})
+            """, numbers)
+            for row in cursor.fetchall():
+                fetched[('flight', row['flight_number'])] = {
+                    'average': average(row['rating_sum'], row['rating_count']),
+                    'count': row['rating_count'],
+                }
+        if routes:
+            cursor.execute(f"""
+                SELECT source, destination, rating_sum, rating_count FROM route_ratings
+                WHERE (source, destination) IN ({', '.join(['(%s, %s)'] * len(routes))})
+            """, [value for route in routes for value in route])
+            for row in cursor.fetchall():
+                fetched[('route', row['source'], row['destination'])] = {
+                    'average': average(row['rating_sum'], row['rating_count']),
+                    'count': row['rating_count'],
+                }
+        cursor.close()
+    finally:
+        connection.close()
+    return fetched
+
+
+def invalidate(flight_number=None, route=None):
+    with _cache_lock:
+        if flight_number is None and route is None:
+            _cache.clear()
+        if flight_number is not None:
+            _cache.pop(('flight', flight_number), None)
+        if route is not None:
+            _cache.pop(('route',) + tuple(route), None)
+
+
+# -- maintenance ---------------------------------------------------------------------
+
+def rebuild(cursor):
+    # Recompute both aggregates from the feedback table (caller commits).
+    cursor.execute("DELETE FROM flight_ratings")
+    cursor.execute("""
+        INSERT INTO flight_ratings (flight_number, rating_sum, rating_count)
+        SELECT f.flight_number, SUM(fb.rating), COUNT(*)
+        FROM feedback fb
+        JOIN bookings b ON fb.booking_id = b.id
+        JOIN flights f ON b.flight_id = f.id
+        GROUP BY f.flight_number
+    """)
+    flights = cursor.rowcount
+    cursor.execute("DELETE FROM route_ratings")
+    cursor.execute("""
+        INSERT INTO route_ratings (source, destination, rating_sum, rating_count)
+        SELECT f.source, f.destination, SUM(fb.rating), COUNT(*)
+        FROM feedback fb
+        JOIN bookings b ON fb.booking_id = b.id
+        JOIN flights f ON b.flight_id = f.id
+        GROUP BY f.source, f.destination
+    """)
+    invalidate()
+    return flights, cursor.rowcount
+
+
+def remove_duplicates(cursor):
+    # Keeps the first feedback row per booking, so booking_id can be unique.
+    cursor.execute("""
+        DELETE fb FROM feedback fb
+        JOIN feedback earlier ON earlier.booking_id = fb.booking_id AND earlier.id < fb.id
+    """)
+    return cursor.rowcount
@@ -0,0 +1,268 @@
+# Read/write splitting across a primary and any number of read replicas.
+#
+# get_db_connection() always goes to the primary. Read-only routes use
+# get_read_connection() instead, which hands out a connection from one of
+# the healthy replicas (round-robin, or the one with the lowest recent ping
+# time) and falls back to the primary when none is usable.
+#
+# A background thread pings every replica each DB_REPLICA_CHECK_INTERVAL
+# seconds, keeps a moving average of its latency and reads its replication
+# lag; replicas that fail or fall more than DB_REPLICA_MAX_LAG seconds behind
+# are skipped until they recover. A replica whose pool is merely exhausted
+# is busy, not broken: that read goes to the primary, but the replica stays
+# in rotation. A server that isn't replicating from
+# anything reports no lag, so two independent local instances work for
+# testing.
+#
+# After a user writes (checkout, cancel, refund), stick_to_primary() marks
+# their session so their reads stay on the primary for
+# DB_READ_YOUR_WRITES_SECONDS and they see their own changes immediately.
+import itertools
+import logging
+import os
+import threading
+import time
+
+from flask import g, has_app_context, has_request_context, session
+
+from db_connection import ConnectionPool, PoolTimeout, get_db_connection, load_config, mysql_connector_factory
+
+logger = logging.getLogger(__name__)
+
+STICKY_KEY = 'read_primary_until'
+LATENCY_WEIGHT = 0.3  # weight of the newest sample in the latency average
+
+DEFAULTS = {
+    'DB_REPLICAS': '',                  # comma-separated host[:port] list
+    'DB_REPLICA_POOL_SIZE': 10,
+    'DB_REPLICA_SELECTION': 'round_robin',
+    'DB_REPLICA_CHECK_INTERVAL': 5.0,
+    'DB_REPLICA_MAX_LAG': 30.0,
+    'DB_READ_YOUR_WRITES_SECONDS': 10.0,
+}
+
+
+class Replica:
+    def __init__(self, name, pool):
+        self.name = name
+        self.pool = pool
+        self.healthy = True
+        self.latency = 0.0
+        self.lag = None
+        self.failures = 0
+        self.busy = 0       # reads sent to the primary because the pool was exhausted
+        self.served = 0
+
+
+class ReplicaSet:
+    def __init__(self, replicas, selection='round_robin', check_interval=5.0, max_lag=30.0):
+        self.replicas = replicas
+        self.selection = selection
+        self.check_interval = check_interval
+        self.max_lag = max_lag
+        self.fallbacks = 0
+
+        self._turn = itertools.count()
+        self._checker = None
+        self._checker_pid = None
+        self._checker_lock = threading.Lock()
+        self._stopping = threading.Event()
+
+    def choose(self):
+        healthy = [replica for replica in self.replicas if replica.healthy]
+        if not healthy:
+            return None
+        if self.selection == 'least_latency':
+            return min(healthy, key=lambda replica: replica.latency)
+        return healthy[next(self._turn) % len(healthy)]
+
+    def acquire(self):
+        # A connection to a healthy replica, or None if there isn't one.
+        self._ensure_checker()
+        replica = self.choose()
+        if replica is None:
+            self.fallbacks += 1
+            return None
+        try:
+            connection = replica.pool.acquire()
+        except PoolTimeout:
+            # Every connection is in use: a load spike, not a failure.
+            replica.busy += 1
+            self.fallbacks += 1
+            return None
+        except Exception:
+            logger.warning("Replica %s unavailable; reading from the primary", replica.name, exc_info=True)
+            replica.healthy = False
+            replica.failures += 1
+            self.fallbacks += 1
+            return None
+        replica.served += 1
+        return connection
+
+    def check(self):
+        for replica in self.replicas:
+            try:
+                started = time.perf_counter()
+                connection = replica.pool.acquire()
+                try:
+                    cursor = connection.cursor(dictionary=True)
+                    cursor.execute("SELECT 1")
+                    cursor.fetchall()
+                    elapsed = time.perf_counter() - started
+                    replica.lag = _replication_lag(cursor)
+                    cursor.close()
+                finally:
+                    connection.close()
+            except PoolTimeout:
+                continue  # too busy to check this round; keep its last state
+            except Exception:
+                if replica.healthy:
+                    logger.warning("Replica %s failed its health check", replica.name, exc_info=True)
+                replica.healthy = False
+                replica.failures += 1
+                continue
+            replica.latency = elapsed if not replica.latency else (
+                LATENCY_WEIGHT * elapsed + (1 - LATENCY_WEIGHT) * replica.latency
+            )
+            replica.healthy = replica.lag is None or replica.lag <= self.max_lag
+
+    def stats(self):
+        stats = {'replicas': len(self.replicas), 'fallbacks': self.fallbacks}
+        stats['healthy'] = sum(1 for replica in self.replicas if replica.healthy)
+        for i, replica in enumerate(self.replicas):
+            stats[f'r{i}_healthy'] = int(replica.healthy)
+            stats[f'r{i}_latency_seconds'] = replica.latency
+            stats[f'r{i}_served'] = replica.served
+            stats[f'r{i}_busy'] = replica.busy
+            if replica.lag is not None:
+                stats[f'r{i}_lag_seconds'] = replica.lag
+        return stats
+
+    def close(self):
+        self._stopping.set()
+        for replica in self.replicas:
+            replica.pool.close_all()
+
+    def _ensure_checker(self):
+        # Started lazily, and again after a fork, like the notification workers.
+        if self._checker_pid == os.getpid():
+            return
+        with self._checker_lock:
+            if self._checker_pid == os.getpid():
+                return
+            self._stopping.clear()
+            self._checker = threading.Thread(target=self._check_loop, name='replica-health', daemon=True)
+            self._checker.start()
+            self._checker_pid = os.getpid()
+
+    def _check_loop(self):
+        while not self._stopping.wait(self.check_interval):
+            self.check()
+
+
+def _replication_lag(cursor):
+    # Seconds behind the source, or None when this server isn't a replica.
+    for statement, column in (('SHOW REPLICA STATUS', 'Seconds_Behind_Source'),
+                              ('SHOW SLAVE STATUS', 'Seconds_Behind_Master')):
+        try:
+            cursor.execute(statement)
+        except Exception:
+            continue  # older or newer server; try the other spelling
+        row = cursor.fetchone()
+        cursor.fetchall()
+        if row is None:
+            return None
+        lag = row.get(column)
+        # NULL means replication is stopped: treat it as too far behind.
+        return float('inf') if lag is None else float(lag)
+    return None
+
+
+_replica_set = None
+read_your_writes_seconds = DEFAULTS['DB_READ_YOUR_WRITES_SECONDS']
+
+
+def configure(settings=None):
+    global _replica_set, read_your_writes_seconds
+    settings = dict(DEFAULTS, **(settings or {}))
+    read_your_writes_seconds = float(settings['DB_READ_YOUR_WRITES_SECONDS'])
+    if _replica_set is not None:
+        _replica_set.close()
+        _replica_set = None
+
+    hosts = [host.strip() for host in str(settings['DB_REPLICAS']).split(',') if host.strip()]
+    if not hosts:
+        return None
+    base = load_config()
+    replicas = []
+    for host in hosts:
+        name, _, port = host.partition(':')
+        config = dict(base, DB_HOST=name, DB_PORT=int(port or base['DB_PORT']))
+        pool = ConnectionPool(
+            mysql_connector_factory(config),
+            size=int(settings['DB_REPLICA_POOL_SIZE']),
+            min_idle=base['DB_POOL_MIN_IDLE'],
+            timeout=base['DB_POOL_TIMEOUT'],
+            idle_timeout=base['DB_POOL_IDLE_TIMEOUT'],
+            ping_after=base['DB_POOL_PING_AFTER'],
+        )
+        replicas.append(Replica(host, pool))
+    _replica_set = ReplicaSet(
+        replicas,
+        selection=settings['DB_REPLICA_SELECTION'],
+        check_interval=float(settings['DB_REPLICA_CHECK_INTERVAL']),
+        max_lag=float(settings['DB_REPLICA_MAX_LAG']),
+    )
+    return _replica_set
+
+
+def get_replica_set():
+    return _replica_set
+
+
+def stick_to_primary(seconds=None):
+    # Keep this user's reads on the primary for a while after they write.
+    if has_request_context():
+        session[STICKY_KEY] = time.time() + (read_your_writes_seconds if seconds is None else seconds)
+
+
+def _sticky():
+    if not has_request_context():
+        return False
+    until = session.get(STICKY_KEY)
+    if until is None:
+        return False
+    if until <= time.time():
+        session.pop(STICKY_KEY, None)
+        return False
+    return True
+
+
+def get_read_connection():
+    # Same contract as get_db_connection(), but may be served by a replica.
+    if _replica_set is None or _sticky():
+        return get_db_connection()
+    started = time.perf_counter()
+    connection = _replica_set.acquire()
+    if connection is None:
+        return get_db_connection()
+    if has_app_context():
+        g.setdefault('_db_connections', []).append(connection)
+        g.db_connect_seconds = g.get('db_connect_seconds', 0.0) + time.perf_counter() - started
+    return connection
+
+
+def close():
+    # Closes every replica connection (the launcher calls this before forking).
+    global _replica_set
+    if _replica_set is not None:
+        _replica_set.close()
+        _replica_set = None
+
+
+def replica_stats():
+    return _replica_set.stats() if _replica_set is not None else {'replicas': 0}
+
+
+def init_app(app):
+    configure({key: app.config.get(key, os.environ.get(key, default)) for key, default in DEFAULTS.items()})
@@ -0,0 +1,371 @@
+# Queued, idempotent refund processing.
+#
+# A refund request only inserts a row into refund_jobs, keyed by an
+# idempotency key derived from the booking id (never taken from the client),
+# so double submits and retried requests can't queue a second refund. The refund_jobs table is the
+# queue: any number of worker threads, in any number of processes, claim due
+# jobs in batches with SELECT ... FOR UPDATE SKIP LOCKED (MySQL 8), then apply
+# the whole batch with a handful of set-based UPDATEs in one transaction.
+#
+# A claimed job gets a lease (next_attempt_at in the future); if its worker
+# dies, the job becomes due again when the lease runs out. Failed batches are
+# retried job by job, and a job that keeps failing backs off exponentially
+# until it is marked failed after MAX_ATTEMPTS.
+import logging
+import os
+import threading
+
+from db_connection import get_db_connection
+from notification_queue import notification_queue
+from ticket_store import ticket_store
+
+logger = logging.getLogger(__name__)
+
+MAX_ATTEMPTS = int(os.environ.get('REFUND_MAX_ATTEMPTS', 5))
+LEASE_SECONDS = 60
+BACKOFF_SECONDS = 5         # first retry delay, doubled per attempt
+MAX_BACKOFF_SECONDS = 600
+STATUS_LIMIT = 50
+
+SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS refund_jobs (
+        id BIGINT AUTO_INCREMENT PRIMARY KEY,
+        idempotency_key VARCHAR(64) NOT NULL,
+        booking_id INT NOT NULL,
+        username VARCHAR(255) NOT NULL,
+        status VARCHAR(16) NOT NULL DEFAULT 'queued',
+        attempts INT NOT NULL DEFAULT 0,
+        next_attempt_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        last_error VARCHAR(255) NULL,
+        created_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        finished_at DATETIME NULL,
+        UNIQUE KEY refund_jobs_key (idempotency_key),
+        KEY refund_jobs_due (status, next_attempt_at),
+        KEY refund_jobs_user (username, id)
+    )
+    """,
+]
+
+
+def ensure_schema(cursor):
+    for statement in SCHEMA:
+        cursor.execute(statement)
+
+
+def default_key(booking_id):
+    return f'refund-{booking_id}'
+
+
+def _placeholders(values):
+    return ', '.join(['%s'] * len(values))
+
+
+# -- enqueueing (request path) -------------------------------------------------
+
+def request_refund(connection, username, booking_id):
+    # Queues a refund for one of the user's cancelled bookings. Returns the
+    # job (new or existing) or None if the booking can't be refunded. There
+    # is one key per booking, so a booking can only ever have one job.
+    key = default_key(booking_id)
+    cursor = connection.cursor(dictionary=True)
+    try:
+        cursor.execute("""
+            INSERT IGNORE INTO refund_jobs (idempotency_key, booking_id, username)
+            SELECT %s, id, username FROM bookings
+            WHERE id = %s AND username = %s AND status = 'cancelled'
+              AND (refund_status IS NULL OR refund_status <> 'REFUNDED')
+        """, (key, booking_id, username))
+        if not cursor.rowcount:
+            # A job that ran out of attempts is queued again from scratch.
+            cursor.execute("""
+                UPDATE refund_jobs j
+                JOIN bookings b ON b.id = j.booking_id AND b.username = j.username
+                SET j.status = 'queued', j.attempts = 0, j.next_attempt_at = NOW(),
+                    j.last_error = NULL, j.finished_at = NULL
+                WHERE j.idempotency_key = %s AND j.username = %s AND j.status = 'failed'
+                  AND b.status = 'cancelled' AND (b.refund_status IS NULL OR b.refund_status <> 'REFUNDED')
+            """, (key, username))
+        if cursor.rowcount:
+            cursor.execute("UPDATE bookings SET refund_status = 'PENDING' WHERE id = %s", (booking_id,))
+        cursor.execute("""
+            SELECT booking_id, status, attempts, last_error FROM refund_jobs WHERE idempotency_key = %s
+        """, (key,))
+        job = cursor.fetchone()
+        connection.commit()
+    except Exception:
+        connection.rollback()
+        raise
+    finally:
+        cursor.close()
+
+    if job is None or job['booking_id'] != booking_id:
+        return None
+    refund_processor.wake()
+    return job
+
+
+def cancel_flight(connection, flight_id):
+    # Cancels every live booking on a flight and queues their refunds, in a
+    # few statements whatever the passenger count. Seats are not put back on
+    # sale: the flight itself is being cancelled. Returns the booking count.
+    cursor = connection.cursor(dictionary=True)
+    try:
+        cursor.execute("""
+            INSERT IGNORE INTO refund_jobs (idempotency_key, booking_id, username)
+            SELECT CONCAT('refund-', id), id, username FROM bookings
+            WHERE flight_id = %s AND (status IS NULL OR status <> 'cancelled')
+        """, (flight_id,))
+        cursor.execute("""
+            SELECT id, username FROM bookings
+            WHERE flight_id = %s AND (status IS NULL OR status <> 'cancelled')
+        """, (flight_id,))
+        booked = cursor.fetchall()
+        cursor.execute("""
+            UPDATE bookings SET status = 'cancelled', refund_status = 'PENDING'
+            WHERE flight_id = %s AND (status IS NULL OR status <> 'cancelled')
+        """, (flight_id,))
+        cancelled = cursor.rowcount
+        connection.commit()
+    except Exception:
+        connection.rollback()
+        raise
+    finally:
+        cursor.close()
+
+    passengers = {}
+    for row in booked:
+        ticket_store.invalidate(row['id'])
+        passengers[row['username']] = passengers.get(row['username'], 0) + 1
+    for username, bookings in passengers.items():
+        notification_queue.publish(username, [
+            f"Flight {flight_id} has been cancelled. A refund for {bookings} booking(s) is on its way."
+        ])
+    refund_processor.wake()
+    return cancelled
+
+
+def status(cursor, username):
+    # The user's recent refund jobs, newest first, for the /refunds page to poll.
+    cursor.execute("""
+        SELECT booking_id, status, attempts, created_at, finished_at
+        FROM refund_jobs WHERE username = %s
+        ORDER BY id DESC LIMIT %s
+    """, (username, STATUS_LIMIT))
+    return cursor.fetchall()
+
+
+# -- processing (workers) --------------------------------------------------------
+
+def claim(connection, batch_size):
+    # Leases up to batch_size due jobs to the caller. A job still marked
+    # processing has outlived its lease (its worker died); one that has
+    # already used up its attempts that way is marked failed, not retried.
+    cursor = connection.cursor(dictionary=True)
+    try:
+        cursor.execute("""
+            SELECT id, booking_id, username, status, attempts FROM refund_jobs
+            WHERE status IN ('queued', 'processing') AND next_attempt_at <= NOW()
+            ORDER BY next_attempt_at
+            LIMIT %s
+            FOR UPDATE SKIP LOCKED
+        """, (batch_size,))
+        jobs = cursor.fetchall()
+        abandoned = [job['id'] for job in jobs if job['status'] == 'processing' and job['attempts'] >= MAX_ATTEMPTS]
+        if abandoned:
+            cursor.execute(f"""
+                UPDATE refund_jobs SET status = 'failed', last_error = 'worker lease expired'
+                WHERE id IN ({_placeholders(abandoned)})
+            """, abandoned)
+            jobs = [job for job in jobs if job['id'] not in abandoned]
+        if jobs:
+            ids = [job['id'] for job in jobs]
+            cursor.execute(f"""
+                UPDATE refund_jobs
+                SET status = 'processing', attempts = attempts + 1,
+                    next_attempt_at = NOW() + INTERVAL %s SECOND
+                WHERE id IN ({_placeholders(ids)})
+            """, (LEASE_SECONDS, *ids))
+        connection.commit()
+        return jobs
+    except Exception:
+        connection.rollback()
+        raise
+    finally:
+        cursor.close()
+
+
+def apply(connection, jobs):
+    # Refunds a batch of claimed jobs in one transaction.
+    ids = [job['id'] for job in jobs]
+    marks = _placeholders(ids)
+    cursor = connection.cursor()
+    try:
+        cursor.execute(f"""
+            UPDATE transactions t
+            JOIN refund_jobs j ON t.booking_id = j.booking_id AND t.username = j.username
+            SET t.status = 'refunded'
+            WHERE j.id IN ({marks}) AND t.status = 'success'
+        """, ids)
+        cursor.execute(f"""
+            UPDATE bookings b
+            JOIN refund_jobs j ON b.id = j.booking_id AND b.username = j.username
+            SET b.refund_status = 'REFUNDED'
+            WHERE j.id IN ({marks}) AND b.status = 'cancelled'
+        """, ids)
+        cursor.execute(f"""
+            UPDATE refund_jobs SET status = 'done', last_error = NULL, finished_at = NOW()
+            WHERE id IN ({marks})
+        """, ids)
+        connection.commit()
+    except Exception:
+        connection.rollback()
+        raise
+    finally:
+        cursor.close()
+
+
+def fail(connection, jobs, error):
+    ids = [job['id'] for job in jobs]
+    cursor = connection.cursor()
+    try:
+        cursor.execute(f"""
+            UPDATE refund_jobs
+            SET status = IF(attempts >= %s, 'failed', 'queued'),
+                next_attempt_at = NOW() + INTERVAL LEAST(%s * POW(2, attempts - 1), %s) SECOND,
+                last_error = %s
+            WHERE id IN ({_placeholders(ids)})
+        """, (MAX_ATTEMPTS, BACKOFF_SECONDS, MAX_BACKOFF_SECONDS, str(error)[:255], *ids))
+        connection.commit()
+    finally:
+        cursor.close()
+
+
+class RefundProcessor:
+    def __init__(self, connect, workers=2, batch_size=500, poll_interval=2.0):
+        self._connect = connect
+        self.workers = workers
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+
+        self._threads = []
+        self._started = False
+        self._pid = None
+        self._wake = threading.Event()
+        self._stopping = threading.Event()
+        self._start_lock = threading.Lock()
+
+        self.processed = 0
+        self.batches = 0
+        self.failures = 0
+
+    def configure(self, workers=None, batch_size=None, poll_interval=None):
+        if workers is not None:
+            self.workers = int(workers)
+        if batch_size is not None:
+            self.batch_size = int(batch_size)
+        if poll_interval is not None:
+            self.poll_interval = float(poll_interval)
+
+    def stats(self):
+        return {'processed': self.processed, 'batches': self.batches, 'failures': self.failures}
+
+    def ensure_started(self):
+        # Starts this process's workers if they aren't running (first use,
+        # or first use after a fork), so jobs left queued by a restart are
+        # picked up without waiting for a new refund request.
+        if self.workers <= 0:
+            return False  # processed by `flask process-refunds` instead
+        if not self._started or self._pid != os.getpid():
+            self.start()
+        return True
+
+    def wake(self):
+        # New work: start the workers if needed and skip their poll wait.
+        if self.ensure_started():
+            self._wake.set()
+
+    def start(self):
+        with self._start_lock:
+            if self._started and self._pid == os.getpid():
+                return
+            self._stopping.clear()
+            self._threads = [
+                threading.Thread(target=self._worker, name=f'refund-worker-{i}', daemon=True)
+                for i in range(self.workers)
+            ]
+            for thread in self._threads:
+                thread.start()
+            self._started = True
+            self._pid = os.getpid()
+
+    def stop(self, timeout=5.0):
+        self._stopping.set()
+        self._wake.set()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._started = False
+
+    def run_once(self):
+        # Claims and processes one batch; returns how many jobs it handled.
+        connection = self._connect()
+        try:
+            jobs = claim(connection, self.batch_size)
+            if not jobs:
+                return 0
+            try:
+                apply(connection, jobs)
+                done = jobs
+            except Exception:
+                # Retry one by one so a single bad row can't hold back the batch.
+                logger.exception("Refund batch of %d failed; retrying jobs individually", len(jobs))
+                done = []
+                for job in jobs:
+                    try:
+                        apply(connection, [job])
+                        done.append(job)
+                    except Exception as error:
+                        self.failures += 1
+                        fail(connection, [job], error)
+            self.batches += 1
+            self.processed += len(done)
+        finally:
+            connection.close()
+
+        for job in done:
+            ticket_store.invalidate(job['booking_id'])
+            notification_queue.publish(job['username'], [
+                f"Your refund for booking #{job['booking_id']} has been processed."
+            ])
+        return len(jobs)
+
+    def _worker(self):
+        delay = self.poll_interval
+        while not self._stopping.is_set():
+            self._wake.clear()
+            try:
+                handled = self.run_once()
+                delay = self.poll_interval
+            except Exception:
+                logger.exception("Refund worker could not process jobs")
+                handled = 0
+                delay = min(delay * 2, MAX_BACKOFF_SECONDS)
+            if handled < self.batch_size:
+                self._wake.wait(delay)
+
+
+def init_app(app):
+    refund_processor.configure(
+        workers=app.config.get('REFUND_WORKERS', os.environ.get('REFUND_WORKERS')),
+        batch_size=app.config.get('REFUND_BATCH_SIZE', os.environ.get('REFUND_BATCH_SIZE')),
+        poll_interval=app.config.get('REFUND_POLL_INTERVAL', os.environ.get('REFUND_POLL_INTERVAL')),
+    )
+    # Started by the first request each serving process handles (after any
+    # fork), not at import, so CLI commands don't run workers.
+    @app.before_request
+    def _start_refund_processor():
+        refund_processor.ensure_started()
+
+
+# Per-process worker pool; started by the process's first request.
+refund_processor = RefundProcessor(get_db_connection)
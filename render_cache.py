@@ -0,0 +1,126 @@
+# Caching for rendered templates.
+#
+# Static pages (/home, /help) are rendered once per process and then served
+# from memory. Flight result pages are cached under a key that includes the
+# search parameters and the flight index version, so any change to flight
+# inventory makes the old entries unreachable and they age out of the LRU.
+#
+# Every cached response carries a strong ETag, so browsers that revalidate
+# get a 304 with no body.
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from functools import wraps
+
+from flask import current_app, make_response, render_template, request
+
+MAX_ENTRIES = int(os.environ.get('RENDER_CACHE_MAX_ENTRIES', 512))
+
+
+class CachedPage:
+    __slots__ = ('body', 'etag')
+
+    def __init__(self, body):
+        self.body = body.encode('utf-8') if isinstance(body, str) else body
+        self.etag = hashlib.sha1(self.body).hexdigest()
+
+
+class RenderCache:
+    def __init__(self, max_entries=MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.not_modified = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key, body):
+        entry = CachedPage(body)
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return entry
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'not_modified': self.not_modified,
+            }
+
+
+render_cache = RenderCache()
+
+
+def enabled():
+    # Off by default in debug mode, where templates are reloaded from disk.
+    setting = current_app.config.get('RENDER_CACHE', os.environ.get('RENDER_CACHE'))
+    if setting is None:
+        return not current_app.debug
+    return setting not in (False, '0', 'false', 'no')
+
+
+def respond(entry):
+    response = make_response(entry.body)
+    response.set_etag(entry.etag)
+    # Pages sit behind login, so only the browser may keep them, and it has
+    # to revalidate (cheaply, via the ETag) on each use.
+    response.headers['Cache-Control'] = 'private, no-cache'
+    response.make_conditional(request)
+    if response.status_code == 304:
+        render_cache.not_modified += 1
+    return response
+
+
+def cached_render(key, template_name, **context):
+    if not enabled():
+        return render_template(template_name, **context)
+    entry = render_cache.get(key)
+    if entry is None:
+        entry = render_cache.put(key, render_template(template_name, **context))
+    return respond(entry)
+
+
+def cached_render_lazy(key, template_name, build_context):
+    # Like cached_render, but the context is only worked out on a miss, so a
+    # hit skips the lookups behind the page as well as the render. The key
+    # has to cover everything the context depends on.
+    if not enabled():
+        return render_template(template_name, **build_context())
+    entry = render_cache.get(key)
+    if entry is None:
+        entry = render_cache.put(key, render_template(template_name, **build_context()))
+    return respond(entry)
+
+
+def cached_page(view):
+    # Full-page cache for views whose output doesn't depend on the request.
+    @wraps(view)
+    def decorated_function(*args, **kwargs):
+        if not enabled():
+            return view(*args, **kwargs)
+        key = ('page', request.path)
+        entry = render_cache.get(key)
+        if entry is None:
+            entry = render_cache.put(key, view(*args, **kwargs))
+        return respond(entry)
+    return decorated_function
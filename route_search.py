@@ -0,0 +1,287 @@
+# Direct and connecting itinerary search over the in-memory flight schedule.
+#
+# Flights are turned into a time-dependent graph: each airport has its
+# departures sorted by time, so the flights that can follow an arrival are a
+# bisect away. search() is a best-first (Dijkstra-style) label search ordered
+# by price or by total journey time. A connection has to leave at least
+# MIN_CONNECTION minutes and at most MAX_LAYOVER minutes after the previous
+# leg lands. Labels are pruned by max price and max duration, never revisit
+# an airport, and are dropped when an earlier label at the same airport
+# already arrived sooner, for less, with no more legs.
+#
+# The graph follows flight_index: flights the index reports as changed are
+# patched in, and the graph is rebuilt only after a full index reload.
+import heapq
+import os
+import threading
+from bisect import bisect_left, bisect_right
+from datetime import date, datetime, time, timedelta
+
+from flight_index import date_key, flight_index
+
+MIN_CONNECTION = int(os.environ.get('ROUTE_MIN_CONNECTION_MINUTES', 45))
+MAX_LAYOVER = int(os.environ.get('ROUTE_MAX_LAYOVER_MINUTES', 12 * 60))
+NO_DATE_HORIZON_DAYS = 7  # searches without a date look this far ahead
+PARETO_LIMIT = 16         # labels remembered per airport
+
+_EPOCH = datetime(2000, 1, 1)
+
+
+def _minutes(moment):
+    return int((moment - _EPOCH).total_seconds() // 60)
+
+
+def _clock(value):
+    # TIME columns come back from mysql.connector as timedelta; allow strings too.
+    if value is None:
+        return timedelta()
+    if isinstance(value, timedelta):
+        return value
+    if isinstance(value, time):
+        return timedelta(hours=value.hour, minutes=value.minute, seconds=value.second)
+    parts = [int(part) for part in str(value).split(':')]
+    while len(parts) < 3:
+        parts.append(0)
+    return timedelta(hours=parts[0], minutes=parts[1], seconds=parts[2])
+
+
+def _day(value):
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date):
+        return value
+    return date.fromisoformat(str(value)[:10])
+
+
+def parse_date(value):
+    # A date from a query string as 'YYYY-MM-DD', or None if it isn't one.
+    if not value:
+        return None
+    try:
+        return _day(value).isoformat()
+    except ValueError:
+        return None
+
+
+class Leg:
+    __slots__ = ('flight', 'origin', 'destination', 'departs', 'arrives', 'price')
+
+    def __init__(self, flight):
+        self.flight = flight
+        self.origin = flight['source']
+        self.destination = flight['destination']
+        day = datetime.combine(_day(flight['departure_date']), time())
+        departs = day + _clock(flight.get('departure_time'))
+        arrives = day + _clock(flight.get('arrival_time'))
+        if arrives <= departs:
+            arrives += timedelta(days=1)  # overnight flight
+        self.departs = _minutes(departs)
+        self.arrives = _minutes(arrives)
+        self.price = float(flight['price'])
+
+    def slot(self):
+        # Everything the search looks at; seat counts and the like aren't in it.
+        return (self.origin, self.destination, self.departs, self.arrives, self.price)
+
+
+def _leg(flight):
+    try:
+        return Leg(flight)
+    except (KeyError, TypeError, ValueError):
+        return None  # incomplete schedule row
+
+
+class RouteGraph:
+    def __init__(self, flights, min_connection=MIN_CONNECTION, max_layover=MAX_LAYOVER):
+        self.min_connection = min_connection
+        self.max_layover = max_layover
+        self._legs_by_id = {}
+        by_airport = {}
+        for flight in flights:
+            leg = _leg(flight)
+            if leg is None:
+                continue
+            self._legs_by_id[flight['id']] = leg
+            by_airport.setdefault(leg.origin, []).append(leg)
+        self._airports = {}  # airport -> (departure times, legs), both sorted by time
+        for airport, legs in by_airport.items():
+            self._install(airport, legs)
+
+    def _install(self, airport, legs):
+        # Times and legs are swapped in together, so a search never sees one
+        # without the other.
+        if legs:
+            legs.sort(key=lambda leg: leg.departs)
+            self._airports[airport] = ([leg.departs for leg in legs], legs)
+        else:
+            self._airports.pop(airport, None)
+
+    def update(self, flights):
+        # Applies changed flights ({flight id: row, or None if removed}).
+        # Rows whose schedule and fare are unchanged (a booking only moved the
+        # seat count) just replace the stored row; otherwise the departures
+        # of the airports involved are rebuilt as new lists. Callers serialise
+        # updates; searches can run alongside.
+        removed, added = {}, {}
+        for flight_id, row in flights.items():
+            old = self._legs_by_id.get(flight_id)
+            new = _leg(row) if row is not None else None
+            if old is not None and new is not None and old.slot() == new.slot():
+                old.flight = row
+                continue
+            if old is not None:
+                del self._legs_by_id[flight_id]
+                removed.setdefault(old.origin, set()).add(old)
+            if new is not None:
+                self._legs_by_id[flight_id] = new
+                added.setdefault(new.origin, []).append(new)
+        for airport in set(removed) | set(added):
+            gone = removed.get(airport, ())
+            legs = [leg for leg in self._airports.get(airport, ((), ()))[1] if leg not in gone]
+            self._install(airport, legs + added.get(airport, []))
+        return len(removed) + len(added)
+
+    def _departures(self, airport, earliest, latest):
+        entry = self._airports.get(airport)
+        if not entry:
+            return ()
+        times, legs = entry
+        start = bisect_left(times, earliest)
+        end = bisect_right(times, latest, lo=start)
+        return legs[start:end]
+
+    def search(self, origin, destination, departure_date=None, max_stops=2, limit=10,
+               max_price=None, max_duration=None, sort='price'):
+        # Returns up to `limit` itineraries, best first. `max_duration` is in minutes.
+        if not origin or not destination or origin == destination:
+            return []
+        if departure_date:
+            window_start = _minutes(datetime.combine(_day(departure_date), time()))
+            window_end = window_start + 24 * 60 - 1
+        else:
+            window_start = _minutes(datetime.combine(date.today(), time()))
+            window_end = window_start + NO_DATE_HORIZON_DAYS * 24 * 60
+        max_legs = max_stops + 1
+        by_duration = sort == 'duration'
+
+        heap = []
+        sequence = 0
+
+        def push(price, departs, arrives, legs):
+            nonlocal sequence
+            duration = arrives - departs
+            if max_price is not None and price > max_price:
+                return
+            if max_duration is not None and duration > max_duration:
+                return
+            score = (duration, price) if by_duration else (price, duration)
+            sequence += 1
+            heapq.heappush(heap, (score, sequence, price, departs, arrives, legs))
+
+        for leg in self._departures(origin, window_start, window_end):
+            push(leg.price, leg.departs, leg.arrives, (leg,))
+
+        results = []
+        settled = {}  # airport -> [(arrives, price, leg count)]
+        while heap and len(results) < limit:
+            _, _, price, departs, arrives, legs = heapq.heappop(heap)
+            airport = legs[-1].destination
+            if airport == destination:
+                results.append(_itinerary(legs, price))
+                continue
+            if len(legs) >= max_legs:
+                continue
+
+            labels = settled.setdefault(airport, [])
+            if any(a <= arrives and p <= price and n <= len(legs) for a, p, n in labels):
+                continue
+            if len(labels) >= PARETO_LIMIT:
+                continue
+            labels.append((arrives, price, len(legs)))
+
+            visited = {origin}
+            visited.update(leg.destination for leg in legs)
+            for leg in self._departures(airport, arrives + self.min_connection, arrives + self.max_layover):
+                if leg.destination in visited:
+                    continue
+                push(price + leg.price, departs, leg.arrives, legs + (leg,))
+        return results
+
+
+def _itinerary(legs, price):
+    layovers = [legs[i + 1].departs - legs[i].arrives for i in range(len(legs) - 1)]
+    return {
+        'legs': [leg.flight for leg in legs],
+        'flight_numbers': [leg.flight['flight_number'] for leg in legs],
+        'stops': len(legs) - 1,
+        'via': [leg.destination for leg in legs[:-1]],
+        'price': round(price, 2),
+        'departs': _EPOCH + timedelta(minutes=legs[0].departs),
+        'arrives': _EPOCH + timedelta(minutes=legs[-1].arrives),
+        'duration_minutes': legs[-1].arrives - legs[0].departs,
+        'layover_minutes': layovers,
+    }
+
+
+def round_trip(graph, origin, destination, departure_date, return_date, limit=10, **options):
+    # Best outbound and return itineraries searched separately, then paired
+    # up by combined price (or duration) without a full cross product.
+    outbound = graph.search(origin, destination, departure_date, limit=limit, **options)
+    inbound = graph.search(destination, origin, return_date, limit=limit, **options)
+    if not outbound or not inbound:
+        return []
+    by_duration = options.get('sort') == 'duration'
+
+    def key(itinerary):
+        return itinerary['duration_minutes'] if by_duration else itinerary['price']
+
+    pairs = []
+    for out in outbound:
+        for back in inbound:
+            if back['departs'] <= out['arrives']:
+                continue
+            pairs.append((key(out) + key(back), out, back))
+    pairs.sort(key=lambda pair: pair[0])
+    return [
+        {'outbound': out, 'return': back, 'price': round(out['price'] + back['price'], 2)}
+        for _, out, back in pairs[:limit]
+    ]
+
+
+_graph = None
+_graph_version = None
+_graph_lock = threading.Lock()
+
+
+def current_graph():
+    # The graph for the current flight index. When the index changes, only
+    # the flights it reports as changed are applied; the graph is rebuilt
+    # from scratch only after the index itself has been reloaded. The
+    # version is read before any flights, so a refresh in between can only
+    # make the graph newer than the version it is kept under.
+    global _graph, _graph_version
+    version = flight_index.current_version()
+    if _graph is None or _graph_version != version:
+        with _graph_lock:
+            version = flight_index.version
+            if _graph is not None and _graph_version == version:
+                return _graph
+            changed = flight_index.changed_since(_graph_version) if _graph is not None else None
+            if changed is None:
+                _graph = RouteGraph(flight_index.all_flights())
+            else:
+                _graph.update({flight_id: flight_index.get(flight_id) for flight_id in changed})
+            _graph_version = version
+    return _graph
+
+
+def search_itineraries(origin, destination, departure_date=None, return_date=None, **options):
+    # Malformed dates find nothing rather than failing the request.
+    departure_day = parse_date(date_key(departure_date))
+    return_day = parse_date(date_key(return_date))
+    if (departure_date and departure_day is None) or (return_date and return_day is None):
+        return []
+    graph = current_graph()
+    if return_date:
+        return round_trip(graph, origin, destination, departure_day, return_day, **options)
+    return graph.search(origin, destination, departure_day, **options)
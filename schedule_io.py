@@ -0,0 +1,236 @@
+# Bulk schedule import and streaming data export.
+#
+# Imports read CSV or JSONL (optionally gzipped) one row at a time and upsert
+# into flights with multi-row INSERT ... ON DUPLICATE KEY UPDATE statements,
+# committing every `chunk_size` rows, so memory stays flat whatever the file
+# size and a failure only rolls back the current chunk. A flight is
+# identified by (flight_number, departure_date); re-importing a schedule
+# updates times and prices in place.
+#
+# Exports walk bookings or transactions in primary-key order, `batch_size`
+# rows per query, and write each batch out before fetching the next.
+import csv
+import gzip
+import io
+import json
+import sys
+import time
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+
+FLIGHT_COLUMNS = (
+    'flight_number', 'source', 'destination', 'departure_date',
+    'departure_time', 'arrival_time', 'duration', 'price',
+)
+REQUIRED_COLUMNS = ('flight_number', 'source', 'destination', 'departure_date', 'price')
+
+EXPORTS = {
+    'bookings': (
+        'id', 'flight_id', 'username', 'passenger_name', 'booking_date',
+        'payment_status', 'final_price', 'fare_class', 'seats', 'status', 'refund_status',
+    ),
+    'transactions': (
+        'id', 'booking_id', 'username', 'amount', 'transaction_type', 'status',
+        'payment_method', 'discount_applied', 'transaction_date',
+    ),
+}
+DATE_COLUMNS = {'bookings': 'booking_date', 'transactions': 'transaction_date'}
+
+BATCH_SIZE = 1000    # rows per multi-row statement
+CHUNK_SIZE = 20000   # rows per transaction
+PROGRESS_EVERY = 50000
+
+UPSERT_FLIGHT = """
+    INSERT INTO flights ({columns}) VALUES ({placeholders})
+    ON DUPLICATE KEY UPDATE {updates}
+""".format(
+    columns=', '.join(FLIGHT_COLUMNS),
+    placeholders=', '.join(['%s'] * len(FLIGHT_COLUMNS)),
+    updates=', '.join(f'{column} = VALUES({column})' for column in FLIGHT_COLUMNS if column not in ('flight_number', 'departure_date')),
+)
+
+
+def ensure_schema(cursor):
+    # Upserts need a unique key on (flight_number, departure_date).
+    cursor.execute("""
+        SELECT COUNT(*) FROM information_schema.statistics
+        WHERE table_schema = DATABASE() AND table_name = 'flights'
+          AND index_name = 'flights_number_date'
+    """)
+    if cursor.fetchone()[0] == 0:
+        cursor.execute("ALTER TABLE flights ADD UNIQUE KEY flights_number_date (flight_number, departure_date)")
+
+
+# -- reading -------------------------------------------------------------------
+
+def _open_text(path):
+    if path == '-':
+        return io.TextIOWrapper(sys.stdin.buffer, encoding='utf-8', newline='')
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rt', encoding='utf-8', newline='')
+    return open(path, encoding='utf-8', newline='')
+
+
+def detect_format(path):
+    name = path[:-3] if path.endswith('.gz') else path
+    if name.endswith(('.jsonl', '.ndjson', '.json')):
+        return 'jsonl'
+    return 'csv'
+
+
+def read_records(handle, fmt):
+    # Yields (line number, dict) pairs without reading the whole file.
+    if fmt == 'jsonl':
+        for number, line in enumerate(handle, start=1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield number, json.loads(line)
+            except ValueError:
+                yield number, None
+    else:
+        reader = csv.DictReader(handle)
+        for record in reader:
+            yield reader.line_num, record
+
+
+def flight_row(record):
+    # Turns one input record into a tuple in FLIGHT_COLUMNS order, or None
+    # if it can't be imported.
+    if not isinstance(record, dict):
+        return None
+    record = {str(key).strip().lower(): value for key, value in record.items() if key is not None}
+    for column in REQUIRED_COLUMNS:
+        value = record.get(column)
+        if value is None or str(value).strip() == '':
+            return None
+    try:
+        departure_date = date.fromisoformat(str(record['departure_date']).strip()[:10])
+        price = Decimal(str(record['price']).strip())
+    except (ValueError, ArithmeticError):
+        return None
+    row = []
+    for column in FLIGHT_COLUMNS:
+        if column == 'departure_date':
+            row.append(departure_date)
+        elif column == 'price':
+            row.append(price)
+        else:
+            value = record.get(column)
+            row.append(str(value).strip() if value not in (None, '') else None)
+    return tuple(row)
+
+
+# -- import ----------------------------------------------------------------------
+
+def import_schedule(connection, path, fmt=None, batch_size=BATCH_SIZE, chunk_size=CHUNK_SIZE, progress=None):
+    # Returns a summary dict. `progress` is called with it every PROGRESS_EVERY rows.
+    fmt = fmt or detect_format(path)
+    stats = {'read': 0, 'imported': 0, 'rejected': 0, 'rejected_lines': [], 'seconds': 0.0}
+    started = time.perf_counter()
+    cursor = connection.cursor()
+    batch = []
+    in_chunk = 0
+
+    def flush():
+        nonlocal batch, in_chunk
+        if batch:
+            cursor.executemany(UPSERT_FLIGHT, batch)
+            stats['imported'] += len(batch)
+            in_chunk += len(batch)
+            batch = []
+        if in_chunk >= chunk_size:
+            connection.commit()
+            in_chunk = 0
+
+    try:
+        with _open_text(path) as handle:
+            for number, record in read_records(handle, fmt):
+                stats['read'] += 1
+                row = flight_row(record)
+                if row is None:
+                    stats['rejected'] += 1
+                    if len(stats['rejected_lines']) < 20:
+                        stats['rejected_lines'].append(number)
+                    continue
+                batch.append(row)
+                if len(batch) >= batch_size:
+                    flush()
+                if progress and stats['read'] % PROGRESS_EVERY == 0:
+                    stats['seconds'] = time.perf_counter() - started
+                    progress(stats)
+            flush()
+            connection.commit()
+    except Exception:
+        connection.rollback()
+        raise
+    finally:
+        cursor.close()
+
+    stats['seconds'] = time.perf_counter() - started
+    return stats
+
+
+def rate(stats):
+    return stats['read'] / stats['seconds'] if stats['seconds'] else 0.0
+
+
+# -- export ----------------------------------------------------------------------
+
+def _plain(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    if isinstance(value, timedelta):
+        seconds = int(value.total_seconds())
+        return f'{seconds // 3600:02d}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}'
+    if isinstance(value, Decimal):
+        return str(value)
+    if isinstance(value, bytes):
+        return value.decode('utf-8', 'replace')
+    return value
+
+
+def iter_rows(connection, table, since=None, batch_size=BATCH_SIZE):
+    # Keyset walk over the primary key: each query is a short index range
+    # scan, and only one batch is held in memory at a time.
+    columns = EXPORTS[table]
+    query = f"SELECT {', '.join(columns)} FROM {table} WHERE id > %s"
+    params = []
+    if since is not None:
+        query += f" AND {DATE_COLUMNS[table]} >= %s"
+        params.append(since)
+    query += " ORDER BY id LIMIT %s"
+
+    cursor = connection.cursor()
+    last_id = 0
+    try:
+        while True:
+            cursor.execute(query, (last_id, *params, batch_size))
+            rows = cursor.fetchall()
+            if not rows:
+                return
+            for row in rows:
+                yield row
+            last_id = rows[-1][0]
+            if len(rows) < batch_size:
+                return
+    finally:
+        cursor.close()
+
+
+def export_table(connection, table, out, fmt='csv', since=None, batch_size=BATCH_SIZE):
+    columns = EXPORTS[table]
+    count = 0
+    if fmt == 'csv':
+        writer = csv.writer(out)
+        writer.writerow(columns)
+        for row in iter_rows(connection, table, since, batch_size):
+            writer.writerow([_plain(value) for value in row])
+            count += 1
+    else:
+        for row in iter_rows(connection, table, since, batch_size):
+            out.write(json.dumps({column: _plain(value) for column, value in zip(columns, row)}))
+            out.write('\n')
+            count += 1
+    return count
@@ -0,0 +1,182 @@
+# Per-flight seat counters and short-lived seat holds.
+#
+# Seats are taken with a conditional decrement (`available >= n` in the WHERE
+# clause), so two buyers racing for the last seat can never both succeed: the
+# row lock serialises them and the loser's UPDATE matches zero rows. Holds
+# reserve seats while the user is on the payment page and are either consumed
+# by checkout or handed back by release_expired_holds().
+#
+# All functions take a dictionary cursor and leave committing to the caller,
+# so they can run inside the booking_service transactions.
+import os
+from datetime import datetime, timedelta
+
+DEFAULT_CAPACITY = int(os.environ.get('DEFAULT_FLIGHT_CAPACITY', 180))
+HOLD_SECONDS = int(os.environ.get('SEAT_HOLD_SECONDS', 600))
+
+SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS seat_inventory (
+        flight_id INT PRIMARY KEY,
+        capacity INT NOT NULL,
+        available INT NOT NULL,
+        CONSTRAINT seat_inventory_non_negative CHECK (available >= 0)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS seat_holds (
+        id INT AUTO_INCREMENT PRIMARY KEY,
+        flight_id INT NOT NULL,
+        username VARCHAR(255) NOT NULL,
+        seats INT NOT NULL,
+        expires_at DATETIME NOT NULL,
+        UNIQUE KEY seat_holds_flight_user (flight_id, username),
+        KEY seat_holds_expires (expires_at)
+    )
+    """,
+]
+
+
+class SoldOut(Exception):
+    pass
+
+
+def ensure_schema(cursor):
+    for statement in SCHEMA:
+        cursor.execute(statement)
+
+
+def sync_inventory(cursor, capacity=DEFAULT_CAPACITY):
+    # Backfill counters for flights that don't have one yet.
+    cursor.execute("""
+        INSERT IGNORE INTO seat_inventory (flight_id, capacity, available)
+        SELECT id, %s, %s FROM flights
+    """, (capacity, capacity))
+    return cursor.rowcount
+
+
+def ensure_inventory(cursor, flight_id, capacity=DEFAULT_CAPACITY):
+    cursor.execute("""
+        INSERT IGNORE INTO seat_inventory (flight_id, capacity, available)
+        SELECT id, %s, %s FROM flights WHERE id = %s
+    """, (capacity, capacity, flight_id))
+
+
+def available_seats(cursor, flight_id):
+    cursor.execute("SELECT available FROM seat_inventory WHERE flight_id = %s", (flight_id,))
+    row = cursor.fetchone()
+    return row['available'] if row else None
+
+
+def reserve(cursor, flight_id, seats=1):
+    for attempt in range(2):
+        cursor.execute(
+            "UPDATE seat_inventory SET available = available - %s WHERE flight_id = %s AND available >= %s",
+            (seats, flight_id, seats)
+        )
+        if cursor.rowcount == 1:
+            return
+        if attempt == 0:
+            # Either the flight has no counter yet, or it's full and some of
+            # its seats are sitting in expired holds. Fix both and retry once.
+            ensure_inventory(cursor, flight_id)
+            _release_expired(cursor, datetime.now(), flight_id)
+    raise SoldOut(flight_id)
+
+
+def release(cursor, flight_id, seats=1):
+    cursor.execute(
+        "UPDATE seat_inventory SET available = LEAST(capacity, available + %s) WHERE flight_id = %s",
+        (seats, flight_id)
+    )
+
+
+def hold(cursor, flight_id, username, seats=1, hold_seconds=HOLD_SECONDS):
+    # Reserve seats for `username` until the hold expires. Calling it again
+    # (e.g. reloading the payment page) just extends the existing hold.
+    # The row is upserted before it is read, so the locking read always hits
+    # an existing row; FOR UPDATE on a missing one takes a gap lock, and two
+    # first-time holds then deadlock on each other's inserts. A new row holds
+    # no seats until _adjust() reserves them (a SoldOut rolls it back).
+    expires_at = datetime.now() + timedelta(seconds=hold_seconds)
+    cursor.execute("""
+        INSERT INTO seat_holds (flight_id, username, seats, expires_at) VALUES (%s, %s, 0, %s)
+        ON DUPLICATE KEY UPDATE expires_at = VALUES(expires_at)
+    """, (flight_id, username, expires_at))
+    existing = _locked_hold(cursor, flight_id, username)
+    _adjust(cursor, flight_id, existing['seats'], seats)
+    cursor.execute("UPDATE seat_holds SET seats = %s WHERE id = %s", (seats, existing['id']))
+    return expires_at
+
+
+def consume_hold(cursor, flight_id, username, seats=1):
+    # Turns the user's hold into sold seats, or takes seats directly if there
+    # is no hold. A hold that has expired but not been swept yet still owns its
+    # seats, so it is honoured.
+    existing = _locked_hold(cursor, flight_id, username)
+    if existing is None:
+        reserve(cursor, flight_id, seats)
+        return
+    _adjust(cursor, flight_id, existing['seats'], seats)
+    cursor.execute("DELETE FROM seat_holds WHERE id = %s", (existing['id'],))
+
+
+def release_expired_holds(connection, batch_size=1000):
+    # Batch job: hand seats from expired holds back to their flights.
+    cursor = connection.cursor(dictionary=True)
+    released = 0
+    try:
+        cutoff = datetime.now()
+        while True:
+            count = _release_expired(cursor, cutoff, limit=batch_size)
+            connection.commit()
+            released += count
+            if count < batch_size:
+                return released
+    finally:
+        cursor.close()
+
+
+def _locked_hold(cursor, flight_id, username):
+    cursor.execute(
+        "SELECT id, seats FROM seat_holds WHERE flight_id = %s AND username = %s FOR UPDATE",
+        (flight_id, username)
+    )
+    return cursor.fetchone()
+
+
+def _adjust(cursor, flight_id, held, wanted):
+    if wanted > held:
+        reserve(cursor, flight_id, wanted - held)
+    elif wanted < held:
+        release(cursor, flight_id, held - wanted)
+
+
+def _release_expired(cursor, cutoff, flight_id=None, limit=1000):
+    # Locks the expired holds first so a concurrent hold()/consume_hold() on
+    # the same row waits for us instead of re-using seats we're handing back.
+    query = "SELECT id, flight_id, seats FROM seat_holds WHERE expires_at <= %s"
+    params = [cutoff]
+    if flight_id is not None:
+        query += " AND flight_id = %s"
+        params.append(flight_id)
+    query += " ORDER BY id LIMIT %s FOR UPDATE"
+    params.append(limit)
+    cursor.execute(query, params)
+    rows = cursor.fetchall()
+    if not rows:
+        return 0
+
+    per_flight = {}
+    ids = []
+    for row in rows:
+        ids.append(row['id'])
+        per_flight[row['flight_id']] = per_flight.get(row['flight_id'], 0) + row['seats']
+
+    cursor.executemany(
+        "UPDATE seat_inventory SET available = LEAST(capacity, available + %s) WHERE flight_id = %s",
+        [(seats, held_flight) for held_flight, seats in per_flight.items()]
+    )
+    placeholders = ', '.join(['%s'] * len(ids))
+    cursor.execute(f"DELETE FROM seat_holds WHERE id IN ({placeholders})", ids)
+    return len(ids)
@@ -0,0 +1,179 @@
+# Production launcher: a pre-forking gunicorn server with the app preloaded.
+#
+#   python serve.py --workers 4 --bind 0.0.0.0:8000
+#
+# The master process imports the app, compiles every template and warms the
+# flight index, fare table and route graph once; workers are forked from it
+# and share that memory copy-on-write, so a new worker is ready in
+# milliseconds. Database connections are never shared across the fork: the
+# master closes its own before forking and each worker opens a fresh pool.
+#
+# `kill -HUP <master pid>` replaces the workers gracefully: new ones are
+# forked, and the old ones stop accepting, finish their in-flight requests
+# (up to --graceful-timeout), flush queued notifications and exit. The code
+# itself is only reloaded on a full restart, since it is preloaded.
+#
+# Each phase of startup is logged, and every worker logs how long after the
+# launcher started it served its first request (benchmarks/bench_startup.py
+# measures the same from outside). Needs `pip install gunicorn`.
+import argparse
+import logging
+import os
+import time
+
+STARTED = time.perf_counter()
+
+from gunicorn.app.base import BaseApplication  # noqa: E402
+
+logger = logging.getLogger('serve')
+
+DEFAULTS = {
+    'SERVE_BIND': '0.0.0.0:8000',
+    'SERVE_WORKERS': os.cpu_count() or 2,
+    'SERVE_THREADS': 4,
+    'SERVE_TIMEOUT': 30,
+    'SERVE_GRACEFUL_TIMEOUT': 30,
+}
+
+timings = {}  # startup phase -> seconds
+
+
+def _timed(phase, fn, *args):
+    started = time.perf_counter()
+    result = fn(*args)
+    timings[phase] = time.perf_counter() - started
+    return result
+
+
+def _import_app():
+    import app as application
+    return application.app
+
+
+def _compile_templates(flask_app):
+    # Parsing and compiling happens once here instead of on each worker's first render.
+    names = flask_app.jinja_env.list_templates(extensions=['html'])
+    for name in names:
+        flask_app.jinja_env.get_template(name)
+    return len(names)
+
+
+def _warm(flask_app):
+    import pricing
+    import route_search
+    from flight_index import flight_index
+
+    with flask_app.app_context():
+        if not flight_index.warm():
+            return False
+        route_search.current_graph()
+        pricing.fare_table.build()
+    return True
+
+
+def _log_first_request():
+    # Registered before the fork, so it runs once in every worker.
+    global _first_request_pid
+    if _first_request_pid != os.getpid():
+        _first_request_pid = os.getpid()
+        logger.info(
+            "Worker %s served its first request %.0f ms after launch",
+            os.getpid(), (time.perf_counter() - STARTED) * 1000,
+        )
+
+
+_first_request_pid = None
+
+
+def preload():
+    flask_app = _timed('import', _import_app)
+    templates = _timed('templates', _compile_templates, flask_app)
+    warmed = _timed('warmup', _warm, flask_app)
+    flask_app.before_request(_log_first_request)
+
+    # Don't let workers inherit the master's database sockets.
+    import read_replicas
+    from db_connection import get_pool
+    get_pool().close_all()
+    read_replicas.close()
+
+    timings['preload'] = time.perf_counter() - STARTED
+    logger.info(
+        "Preloaded in %.0f ms (import %.0f ms, %d templates %.0f ms, warmup %.0f ms%s)",
+        timings['preload'] * 1000, timings['import'] * 1000, templates, timings['templates'] * 1000,
+        timings['warmup'] * 1000, '' if warmed else ', failed: warming on first request',
+    )
+    return flask_app
+
+
+def post_fork(server, worker):
+    forked = time.perf_counter()
+    flask_app = server.app.application
+    import read_replicas
+    from db_connection import DEFAULT_CONFIG, configure_pool
+
+    # Fresh pools in the worker, with min_idle connections opened up front.
+    pool = configure_pool({key: flask_app.config[key] for key in DEFAULT_CONFIG if key in flask_app.config})
+    read_replicas.init_app(flask_app)
+    try:
+        connections = [pool.acquire() for _ in range(pool.min_idle)]
+        for connection in connections:
+            connection.close()
+    except Exception:
+        logger.warning("Worker %s could not pre-open database connections", worker.pid, exc_info=True)
+
+    logger.info("Worker %s ready in %.0f ms", worker.pid, (time.perf_counter() - forked) * 1000)
+
+
+def worker_exit(server, worker):
+    # Drain what the worker still holds in memory before it goes.
+    from notification_queue import notification_queue
+    from refund_jobs import refund_processor
+
+    refund_processor.stop()
+    notification_queue.stop()
+
+
+class Launcher(BaseApplication):
+    def __init__(self, options):
+        self.options = options
+        self.application = None
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        if self.application is None:
+            self.application = preload()
+        return self.application
+
+
+def main():
+    settings = {key: os.environ.get(key, default) for key, default in DEFAULTS.items()}
+    parser = argparse.ArgumentParser(description='Run the app on a pre-forking server')
+    parser.add_argument('--bind', default=settings['SERVE_BIND'])
+    parser.add_argument('--workers', type=int, default=int(settings['SERVE_WORKERS']))
+    parser.add_argument('--threads', type=int, default=int(settings['SERVE_THREADS']), help='threads per worker')
+    parser.add_argument('--timeout', type=int, default=int(settings['SERVE_TIMEOUT']), help='seconds before a stuck worker is restarted')
+    parser.add_argument('--graceful-timeout', type=int, default=int(settings['SERVE_GRACEFUL_TIMEOUT']),
+                        help='seconds old workers get to finish requests on reload or shutdown')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(process)d %(name)s %(levelname)s %(message)s')
+    Launcher({
+        'bind': args.bind,
+        'workers': args.workers,
+        'threads': args.threads,
+        'worker_class': 'gthread',
+        'timeout': args.timeout,
+        'graceful_timeout': args.graceful_timeout,
+        'preload_app': True,
+        'post_fork': post_fork,
+        'worker_exit': worker_exit,
+    }).run()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,281 @@
+# Server-side sessions.
+#
+# The session cookie only carries a random session id (signed with the app's
+# SECRET_KEY); the session data lives in a store keyed by that id:
+#
+#   memory  an in-process LRU with a sliding TTL. Fastest, but every worker
+#           process has its own sessions and they go away on restart.
+#   sqlite  a SQLite file (WAL mode) shared by every process on the host, so
+#           logins survive worker restarts and any worker can serve any user.
+#
+# Lookups are by primary key. Expired sessions are not deleted one by one:
+# whichever request first finds SESSION_SWEEP_INTERVAL seconds have passed
+# sweeps up to SESSION_SWEEP_BATCH of them in one go. Logging out deletes the
+# session from the store, and logging in issues a fresh id.
+import logging
+import os
+import secrets
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import SessionInterface, SessionMixin
+from itsdangerous import BadSignature, Signer
+from werkzeug.datastructures import CallbackDict
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    'SESSION_BACKEND': 'sqlite',        # memory or sqlite
+    'SESSION_SQLITE_PATH': None,        # default: <instance path>/sessions.sqlite3
+    'SESSION_TTL': int(os.environ.get('AUTH_SESSION_TTL', 7 * 24 * 3600)),
+    'SESSION_MAX_ENTRIES': 100000,      # memory backend only
+    'SESSION_SWEEP_INTERVAL': 60.0,
+    'SESSION_SWEEP_BATCH': 1000,
+}
+
+
+class MemoryStore:
+    def __init__(self, ttl, size=100000):
+        self.ttl = ttl
+        self.size = size
+        # sid -> (data, expires at). Every read or write moves the entry to the
+        # end and pushes its expiry out by ttl, so the front of the dict is
+        # always the entry that expires first.
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, sid):
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(sid)
+            if entry is None:
+                return None
+            if entry[1] <= now:
+                del self._entries[sid]
+                return None
+            self._entries[sid] = (entry[0], now + self.ttl)
+            self._entries.move_to_end(sid)
+            # The expiry the cookie was last issued with, so the interface
+            # still knows when to send a fresh one.
+            return entry
+
+    def save(self, sid, data):
+        with self._lock:
+            self._entries[sid] = (data, time.time() + self.ttl)
+            self._entries.move_to_end(sid)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def delete(self, sid):
+        with self._lock:
+            self._entries.pop(sid, None)
+
+    def sweep(self, batch):
+        now = time.time()
+        removed = 0
+        with self._lock:
+            while self._entries and removed < batch:
+                sid, (_, expires_at) = next(iter(self._entries.items()))
+                if expires_at > now:
+                    break
+                del self._entries[sid]
+                removed += 1
+        return removed
+
+    def stats(self):
+        return {'sessions': len(self._entries)}
+
+
+class SQLiteStore:
+    SCHEMA = [
+        """
+        CREATE TABLE IF NOT EXISTS sessions (
+            sid TEXT PRIMARY KEY,
+            data TEXT NOT NULL,
+            expires_at REAL NOT NULL
+        ) WITHOUT ROWID
+        """,
+        "CREATE INDEX IF NOT EXISTS sessions_expires ON sessions (expires_at)",
+    ]
+
+    def __init__(self, path, ttl):
+        self.path = path
+        self.ttl = ttl
+        self._local = threading.local()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        connection = self._connection()
+        for statement in self.SCHEMA:
+            connection.execute(statement)
+
+    def _connection(self):
+        # One connection per thread, reopened after a fork.
+        connection = getattr(self._local, 'connection', None)
+        if connection is None or self._local.pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=5.0, isolation_level=None)
+            connection.execute("PRAGMA journal_mode = WAL")
+            connection.execute("PRAGMA synchronous = NORMAL")
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    def get(self, sid):
+        row = self._connection().execute(
+            "SELECT data, expires_at FROM sessions WHERE sid = ? AND expires_at > ?", (sid, time.time())
+        ).fetchone()
+        return (row[0], row[1]) if row else None
+
+    def save(self, sid, data):
+        self._connection().execute(
+            "INSERT OR REPLACE INTO sessions (sid, data, expires_at) VALUES (?, ?, ?)",
+            (sid, data, time.time() + self.ttl)
+        )
+
+    def delete(self, sid):
+        self._connection().execute("DELETE FROM sessions WHERE sid = ?", (sid,))
+
+    def sweep(self, batch):
+        cursor = self._connection().execute("""
+            DELETE FROM sessions WHERE sid IN (
+                SELECT sid FROM sessions WHERE expires_at <= ? ORDER BY expires_at LIMIT ?
+            )
+        """, (time.time(), batch))
+        return cursor.rowcount
+
+    def stats(self):
+        return {'sessions': self._connection().execute("SELECT COUNT(*) FROM sessions").fetchone()[0]}
+
+
+class ServerSession(CallbackDict, SessionMixin):
+    def __init__(self, initial=None, sid=None, expires_at=None):
+        def on_update(session):
+            session.modified = True
+
+        super().__init__(initial, on_update)
+        self.sid = sid
+        self.expires_at = expires_at
+        self.new = sid is None
+        self.modified = False
+        self.rotate = False
+
+    def regenerate(self):
+        # Give the session a new id on the next save (call on login).
+        self.rotate = True
+        self.modified = True
+
+
+class ServerSessionInterface(SessionInterface):
+    serializer = TaggedJSONSerializer()
+
+    def __init__(self, store, sweep_interval=60.0, sweep_batch=1000):
+        self.store = store
+        self.sweep_interval = sweep_interval
+        self.sweep_batch = sweep_batch
+        self._swept_at = time.monotonic()
+        self._sweep_lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.swept = 0
+
+    def _signer(self, app):
+        return Signer(app.secret_key, salt='session-id')
+
+    def load(self, app, cookie_value):
+        # (sid, data dict, expires at) for a cookie value, or None. Also used
+        # by asgi.py for the routes it serves without Flask.
+        if not cookie_value:
+            return None
+        try:
+            sid = self._signer(app).unsign(cookie_value).decode('ascii')
+        except (BadSignature, UnicodeDecodeError):
+            return None
+        record = self.store.get(sid)
+        if record is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return sid, self.serializer.loads(record[0]), record[1]
+
+    def open_session(self, app, request):
+        loaded = self.load(app, request.cookies.get(self.get_cookie_name(app)))
+        if loaded is None:
+            return ServerSession()
+        sid, data, expires_at = loaded
+        return ServerSession(data, sid=sid, expires_at=expires_at)
+
+    def save_session(self, app, session, response):
+        self._maybe_sweep()
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+
+        if not session:
+            if session.sid is not None:
+                self.store.delete(session.sid)  # logout or cleared session
+            if session.modified and not session.new:
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+
+        if session.rotate and session.sid is not None:
+            self.store.delete(session.sid)
+            session.sid = None
+        # Unchanged sessions are only rewritten once they are half way to
+        # expiring, so most requests don't write to the store at all.
+        refresh = session.expires_at is None or session.expires_at - time.time() < self.store.ttl / 2
+        if not session.modified and not refresh:
+            return
+
+        new = session.sid is None
+        if new:
+            session.sid = secrets.token_urlsafe(32)
+        self.store.save(session.sid, self.serializer.dumps(dict(session)))
+        response.set_cookie(
+            name,
+            self._signer(app).sign(session.sid).decode('ascii'),
+            max_age=int(self.store.ttl),
+            httponly=self.get_cookie_httponly(app),
+            domain=domain,
+            path=path,
+            secure=self.get_cookie_secure(app),
+            samesite=self.get_cookie_samesite(app),
+        )
+
+    def _maybe_sweep(self):
+        if time.monotonic() - self._swept_at < self.sweep_interval:
+            return
+        if not self._sweep_lock.acquire(blocking=False):
+            return
+        try:
+            self._swept_at = time.monotonic()
+            self.swept += self.store.sweep(self.sweep_batch)
+        except Exception:
+            logger.exception("Session sweep failed")
+        finally:
+            self._sweep_lock.release()
+
+    def stats(self):
+        stats = {'hits': self.hits, 'misses': self.misses, 'swept': self.swept}
+        stats.update(self.store.stats())
+        return stats
+
+
+def init_app(app):
+    settings = {key: app.config.get(key, os.environ.get(key, default)) for key, default in DEFAULTS.items()}
+    ttl = float(settings['SESSION_TTL'])
+    if settings['SESSION_BACKEND'] == 'memory':
+        store = MemoryStore(ttl, int(settings['SESSION_MAX_ENTRIES']))
+    elif settings['SESSION_BACKEND'] == 'sqlite':
+        path = settings['SESSION_SQLITE_PATH'] or os.path.join(app.instance_path, 'sessions.sqlite3')
+        store = SQLiteStore(path, ttl)
+    else:
+        raise ValueError(f"Unknown SESSION_BACKEND {settings['SESSION_BACKEND']!r}")
+    app.session_interface = ServerSessionInterface(
+        store,
+        sweep_interval=float(settings['SESSION_SWEEP_INTERVAL']),
+        sweep_batch=int(settings['SESSION_SWEEP_BATCH']),
+    )
+    return app.session_interface
@@ -0,0 +1,67 @@
+import pytest
+
+pytest.importorskip('flask')
+pytest.importorskip('mysql.connector')
+
+from admission import MemoryBuckets, SQLiteBuckets, _spend
+
+
+def test_missing_bucket_starts_full():
+    tokens, wait = _spend([('user:a', 1.0, 3)], {}, now=100.0)
+    assert (tokens, wait) == ([2.0], 0)
+
+
+def test_empty_bucket_reports_wait_and_spends_nothing():
+    tokens, wait = _spend([('user:a', 2.0, 3)], {'user:a': (0.0, 100.0)}, now=100.0)
+    assert tokens == [0.0]
+    assert wait == pytest.approx(0.5)
+
+
+def test_refill_is_capped_at_burst():
+    tokens, wait = _spend([('user:a', 1.0, 3)], {'user:a': (0.0, 0.0)}, now=1000.0)
+    assert (tokens, wait) == ([2.0], 0)
+
+
+def test_partial_refill_waits_for_the_rest():
+    tokens, wait = _spend([('user:a', 0.5, 10)], {'user:a': (0.25, 10.0)}, now=11.0)
+    assert tokens == [pytest.approx(0.75)]
+    assert wait == pytest.approx(0.5)
+
+
+def test_all_buckets_or_none():
+    limits = [('ip:1', 10.0, 50), ('user:a', 1.0, 5)]
+    buckets = {'ip:1': (20.0, 100.0), 'user:a': (0.0, 100.0)}
+    tokens, wait = _spend(limits, buckets, now=100.0)
+    assert tokens == [20.0, 0.0]  # the IP bucket keeps its token too
+    assert wait == pytest.approx(1.0)
+
+    tokens, wait = _spend(limits, buckets, now=101.0)
+    assert wait == 0
+    assert tokens == [pytest.approx(29.0), pytest.approx(0.0)]
+
+
+def test_memory_buckets_take_until_empty_then_refill():
+    buckets = MemoryBuckets()
+    limits = [('user:a', 1.0, 2)]
+    assert buckets.take(limits, now=0.0) == 0
+    assert buckets.take(limits, now=0.0) == 0
+    assert buckets.take(limits, now=0.0) == pytest.approx(1.0)
+    assert buckets.take(limits, now=1.0) == 0
+
+
+def test_memory_buckets_sweep_idle():
+    buckets = MemoryBuckets()
+    buckets.take([('user:a', 1.0, 2)], now=0.0)
+    buckets.take([('user:b', 1.0, 2)], now=50.0)
+    assert buckets.sweep(30.0, now=60.0) == 1
+    assert buckets.stats() == {'buckets': 1}
+
+
+def test_sqlite_buckets_are_shared_through_the_file(tmp_path):
+    path = str(tmp_path / 'admission.sqlite3')
+    first, second = SQLiteBuckets(path), SQLiteBuckets(path)
+    limits = [('user:a', 1.0, 2)]
+    assert first.take(limits, now=0.0) == 0
+    assert second.take(limits, now=0.0) == 0
+    assert first.take(limits, now=0.0) == pytest.approx(1.0)
+    assert second.stats() == {'buckets': 1}
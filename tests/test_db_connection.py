@@ -0,0 +1,121 @@
+import sqlite3
+
+import pytest
+
+pytest.importorskip('flask')
+pytest.importorskip('mysql.connector')
+
+from flask import Flask
+
+import db_connection
+from db_connection import ConnectionPool, PoolTimeout, get_db_connection
+
+
+def sqlite_connect():
+    return sqlite3.connect(':memory:', check_same_thread=False)
+
+
+def make_pool(**options):
+    return ConnectionPool(sqlite_connect, **options)
+
+
+def test_released_connection_is_reused():
+    pool = make_pool(size=2)
+    first = pool.acquire()
+    raw = first._raw
+    first.close()
+
+    second = pool.acquire()
+    assert second._raw is raw
+    assert pool.stats()['open'] == 1
+    assert pool.stats()['checkouts'] == 2
+
+
+def test_close_twice_releases_once():
+    pool = make_pool(size=2)
+    connection = pool.acquire()
+    connection.close()
+    connection.close()
+    assert connection.released
+    assert pool.stats()['idle'] == 1
+
+
+def test_exhausted_pool_times_out():
+    pool = make_pool(size=1, timeout=0.05)
+    held = pool.acquire()
+    with pytest.raises(PoolTimeout):
+        pool.acquire()
+    assert pool.stats()['checkout_failures'] == 1
+
+    held.close()
+    pool.acquire().close()
+
+
+def test_release_rolls_back_unfinished_transaction():
+    pool = make_pool(size=1)
+    connection = pool.acquire()
+    cursor = connection.cursor()
+    cursor.execute("CREATE TABLE t (x INTEGER)")
+    connection.commit()
+    cursor.execute("INSERT INTO t VALUES (1)")
+    connection.close()
+
+    again = pool.acquire()
+    assert again.cursor().execute("SELECT COUNT(*) FROM t").fetchone()[0] == 0
+
+
+def test_discard_closes_instead_of_returning():
+    pool = make_pool(size=1)
+    connection = pool.acquire()
+    raw = connection._raw
+    connection.discard()
+    connection.close()  # no-op once discarded
+
+    stats = pool.stats()
+    assert (stats['open'], stats['idle'], stats['discarded']) == (0, 0, 1)
+    assert pool.acquire()._raw is not raw
+
+
+def test_stale_idle_connection_is_replaced():
+    pool = make_pool(size=1, ping_after=0.0)
+    connection = pool.acquire()
+    raw = connection._raw
+    connection.close()
+    raw.close()  # dies while idle
+
+    fresh = pool.acquire()
+    assert fresh._raw is not raw
+    assert pool.stats()['discarded'] == 1
+    assert pool.stats()['open'] == 1
+
+
+@pytest.fixture
+def app(monkeypatch):
+    monkeypatch.setattr(db_connection, '_pool', None)
+    db_connection.configure_pool({'DB_POOL_SIZE': 2}, connect=sqlite_connect)
+    app = Flask(__name__)
+    app.teardown_appcontext(db_connection.release_request_connections)
+    return app
+
+
+def test_teardown_returns_connections_a_route_left_open(app):
+    @app.route('/leak')
+    def leak():
+        get_db_connection()
+        get_db_connection()
+        return 'ok'
+
+    assert app.test_client().get('/leak').status_code == 200
+    stats = db_connection.get_pool().stats()
+    assert (stats['in_use'], stats['idle']) == (0, 2)
+
+
+def test_teardown_skips_connections_already_closed(app):
+    @app.route('/tidy')
+    def tidy():
+        get_db_connection().close()
+        return 'ok'
+
+    app.test_client().get('/tidy')
+    stats = db_connection.get_pool().stats()
+    assert (stats['open'], stats['idle']) == (1, 1)
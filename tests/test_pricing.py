@@ -0,0 +1,115 @@
+import random
+
+import pytest
+
+pytest.importorskip('flask')
+pytest.importorskip('mysql.connector')
+
+import pricing
+
+
+class FakeIndex:
+    # Just enough of flight_index for FareTable: versioned rows and a change log.
+    def __init__(self, rows):
+        self.rows = {row['id']: row for row in rows}
+        self.version = 1
+        self.changes = []
+
+    def get(self, flight_id):
+        return self.rows.get(int(flight_id))
+
+    def all_flights(self):
+        return list(self.rows.values())
+
+    def changed_since(self, version):
+        return {flight_id for changed_at, flight_id in self.changes if changed_at > version}
+
+    def put(self, flight_id, price=None):
+        if price is None:
+            self.rows.pop(flight_id, None)
+        else:
+            self.rows[flight_id] = {'id': flight_id, 'price': price}
+        self.version += 1
+        self.changes.append((self.version, flight_id))
+
+
+class StaticLoadTable(pricing.FareTable):
+    def __init__(self, loads, **options):
+        super().__init__(connect=None, **options)
+        self.loads = loads
+
+    def _load_factors(self, flight_ids=None):
+        wanted = self.loads if flight_ids is None else flight_ids
+        return {flight_id: self.loads.get(flight_id, 0.0) for flight_id in wanted}
+
+
+@pytest.fixture(params=['numpy', 'lists'])
+def index(request, monkeypatch):
+    if request.param == 'numpy':
+        pytest.importorskip('numpy')
+    else:
+        monkeypatch.setattr(pricing, 'np', None)
+    index = FakeIndex({'id': flight_id, 'price': 100 + flight_id} for flight_id in range(1, 40, 2))
+    monkeypatch.setattr(pricing, 'flight_index', index)
+    return index
+
+
+def all_fares(table, index):
+    flights = sorted(index.all_flights(), key=lambda flight: flight['id'])
+    return {name: table.fares(flights, name, 2) for name in pricing.CLASSES}
+
+
+def rebuilt_fares(index, loads):
+    table = StaticLoadTable(loads)
+    table.build()
+    return all_fares(table, index)
+
+
+def test_fares_apply_class_and_load_multipliers(index):
+    table = StaticLoadTable({1: 0.9})
+    fares = table.fares([index.get(1), index.get(3)], 'business', 3)
+    assert fares == [round(round(101 * 2.5 * 1.45, 2) * 3, 2), round(103 * 2.5 * 3, 2)]
+
+
+def test_index_changes_are_patched_not_rebuilt(index):
+    table = StaticLoadTable({}, ttl=3600)
+    table.fares([index.get(1)])
+    index.put(3, 500)    # repriced
+    index.put(4, 250)    # new
+    index.put(5)         # removed
+    index.put(99)        # never existed
+
+    assert all_fares(table, index) == rebuilt_fares(index, {})
+    assert (table.builds, table.patches) == (1, 1)
+
+
+def test_booking_repricing_is_patched(index):
+    loads = {}
+    table = StaticLoadTable(loads, ttl=3600)
+    table.fares([index.get(7)])
+    revision = table.current_revision()
+
+    loads[7] = 0.96
+    table.invalidate(7)
+    assert table.fares([index.get(7)]) == [round(107 * 1.7, 2)]
+    assert table.current_revision() > revision
+    assert table.builds == 1
+
+
+def test_random_patches_match_rebuild(index):
+    rng = random.Random(3)
+    loads = {}
+    table = StaticLoadTable(loads, ttl=3600)
+    table.fares([])
+    for _ in range(150):
+        flight_id = rng.randrange(1, 60)
+        roll = rng.random()
+        if roll < 0.35:
+            index.put(flight_id, rng.randrange(50, 500))
+        elif roll < 0.55:
+            index.put(flight_id)
+        else:
+            loads[flight_id] = rng.random()
+            table.invalidate(flight_id)
+        assert all_fares(table, index) == rebuilt_fares(index, loads)
+    assert table.builds == 1
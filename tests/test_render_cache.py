@@ -0,0 +1,67 @@
+import pytest
+
+pytest.importorskip('flask')
+
+from flask import Flask
+
+import render_cache
+from render_cache import RenderCache, cached_page
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(render_cache, 'render_cache', RenderCache(max_entries=4))
+    app = Flask(__name__)
+    app.config['RENDER_CACHE'] = '1'
+    calls = []
+
+    @app.route('/page')
+    @cached_page
+    def page():
+        calls.append(1)
+        return 'hello'
+
+    client = app.test_client()
+    client.calls = calls
+    return client
+
+
+def test_cached_page_carries_strong_etag(client):
+    response = client.get('/page')
+    etag, weak = response.get_etag()
+    assert response.status_code == 200
+    assert etag == render_cache.CachedPage('hello').etag
+    assert not weak
+    assert response.headers['Cache-Control'] == 'private, no-cache'
+
+
+def test_matching_if_none_match_gets_304(client):
+    etag = client.get('/page').get_etag()[0]
+    response = client.get('/page', headers={'If-None-Match': f'"{etag}"'})
+    assert response.status_code == 304
+    assert response.data == b''
+    assert render_cache.render_cache.not_modified == 1
+
+
+def test_stale_etag_gets_full_body(client):
+    client.get('/page')
+    response = client.get('/page', headers={'If-None-Match': '"something-else"'})
+    assert response.status_code == 200
+    assert response.data == b'hello'
+
+
+def test_view_runs_once_per_cached_key(client):
+    client.get('/page')
+    client.get('/page')
+    assert len(client.calls) == 1
+    assert render_cache.render_cache.stats()['hits'] == 1
+
+
+def test_lru_evicts_oldest_entry():
+    cache = RenderCache(max_entries=2)
+    cache.put('a', 'A')
+    cache.put('b', 'B')
+    cache.get('a')
+    cache.put('c', 'C')
+    assert cache.get('b') is None
+    assert cache.get('a').body == b'A'
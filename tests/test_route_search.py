@@ -0,0 +1,115 @@
+import random
+from datetime import date, timedelta
+
+import pytest
+
+pytest.importorskip('flask')
+pytest.importorskip('mysql.connector')
+
+import route_search
+from route_search import RouteGraph
+
+DAY = date(2030, 5, 1)
+
+
+def flight(flight_id, source, destination, departs, arrives, price, day=DAY):
+    return {
+        'id': flight_id, 'flight_number': f'F{flight_id}', 'source': source, 'destination': destination,
+        'departure_date': day, 'departure_time': departs, 'arrival_time': arrives, 'price': price,
+    }
+
+
+def numbers(itineraries):
+    return [itinerary['flight_numbers'] for itinerary in itineraries]
+
+
+@pytest.fixture
+def schedule():
+    return [
+        flight(1, 'AAA', 'CCC', '08:00', '14:00', 400),
+        flight(2, 'AAA', 'BBB', '08:00', '09:00', 100),
+        flight(3, 'BBB', 'CCC', '10:00', '11:00', 100),  # 60 min connection
+        flight(4, 'BBB', 'CCC', '09:15', '10:15', 50),   # too tight to make
+    ]
+
+
+def test_cheapest_connection_first(schedule):
+    results = RouteGraph(schedule).search('AAA', 'CCC', DAY)
+    assert numbers(results) == [['F2', 'F3'], ['F1']]
+    assert results[0]['price'] == 200
+    assert results[0]['via'] == ['BBB']
+    assert results[0]['layover_minutes'] == [60]
+
+
+def test_connection_shorter_than_minimum_is_skipped(schedule):
+    results = RouteGraph(schedule, min_connection=45).search('AAA', 'CCC', DAY)
+    assert ['F2', 'F4'] not in numbers(results)
+    assert ['F2', 'F4'] in numbers(RouteGraph(schedule, min_connection=10).search('AAA', 'CCC', DAY))
+
+
+def test_sort_by_duration_and_max_stops(schedule):
+    graph = RouteGraph(schedule)
+    assert numbers(graph.search('AAA', 'CCC', DAY, sort='duration')) == [['F2', 'F3'], ['F1']]
+    assert numbers(graph.search('AAA', 'CCC', DAY, max_stops=0)) == [['F1']]
+    assert numbers(graph.search('AAA', 'CCC', DAY, max_price=150)) == []
+
+
+def test_other_days_are_not_searched(schedule):
+    assert RouteGraph(schedule).search('AAA', 'CCC', DAY + timedelta(days=1)) == []
+
+
+def test_overnight_flight_lands_next_day():
+    [result] = RouteGraph([flight(1, 'AAA', 'BBB', '23:00', '01:30', 80)]).search('AAA', 'BBB', DAY)
+    assert result['duration_minutes'] == 150
+
+
+def test_round_trip_return_leaves_after_outbound_lands():
+    graph = RouteGraph([
+        flight(1, 'AAA', 'BBB', '08:00', '10:00', 100),
+        flight(2, 'BBB', 'AAA', '18:00', '20:00', 120),
+        flight(3, 'BBB', 'AAA', '07:00', '09:00', 10),  # same day, before the outbound lands
+    ])
+    [pair] = route_search.round_trip(graph, 'AAA', 'BBB', DAY, DAY)
+    assert pair['outbound']['flight_numbers'] == ['F1']
+    assert pair['return']['flight_numbers'] == ['F2']
+    assert pair['price'] == 220
+
+
+def test_update_matches_rebuild():
+    rng = random.Random(7)
+    airports = 'ABCDE'
+
+    def random_flight(flight_id):
+        hour = rng.randrange(24)
+        return flight(flight_id, rng.choice(airports), rng.choice(airports), f'{hour}:{rng.randrange(60)}',
+                      f'{(hour + rng.randrange(1, 5)) % 24}:00', rng.randrange(50, 300),
+                      day=DAY + timedelta(days=rng.randrange(2)))
+
+    rows = {flight_id: random_flight(flight_id) for flight_id in range(120)}
+    graph = RouteGraph(rows.values())
+    for _ in range(60):
+        changed = {}
+        for _ in range(rng.randrange(1, 4)):
+            flight_id = rng.randrange(140)
+            roll = rng.random()
+            if roll < 0.3:
+                rows.pop(flight_id, None)
+                changed[flight_id] = None
+            elif roll < 0.6 and flight_id in rows:
+                rows[flight_id] = dict(rows[flight_id], seats=rng.randrange(9))  # no schedule change
+                changed[flight_id] = rows[flight_id]
+            else:
+                rows[flight_id] = random_flight(flight_id)
+                changed[flight_id] = rows[flight_id]
+        graph.update(changed)
+
+        rebuilt = RouteGraph(rows.values())
+        for origin in airports:
+            for destination in airports:
+                assert numbers(graph.search(origin, destination, DAY)) == numbers(rebuilt.search(origin, destination, DAY))
+
+
+def test_malformed_dates_find_nothing():
+    assert route_search.parse_date('2030-13-40') is None
+    assert route_search.parse_date('2030-05-01') == '2030-05-01'
+    assert route_search.search_itineraries('AAA', 'CCC', 'not-a-date') == []
@@ -0,0 +1,60 @@
+from datetime import date
+from decimal import Decimal
+
+from schedule_io import FLIGHT_COLUMNS, flight_row
+
+
+def record(**overrides):
+    values = {
+        'flight_number': 'SB101', 'source': 'Delhi', 'destination': 'Mumbai',
+        'departure_date': '2030-05-01', 'departure_time': '08:30', 'arrival_time': '10:45',
+        'duration': '2h 15m', 'price': '4999.50',
+    }
+    values.update(overrides)
+    return values
+
+
+def test_row_follows_column_order():
+    row = flight_row(record())
+    assert len(row) == len(FLIGHT_COLUMNS)
+    assert dict(zip(FLIGHT_COLUMNS, row)) == {
+        'flight_number': 'SB101', 'source': 'Delhi', 'destination': 'Mumbai',
+        'departure_date': date(2030, 5, 1), 'departure_time': '08:30', 'arrival_time': '10:45',
+        'duration': '2h 15m', 'price': Decimal('4999.50'),
+    }
+
+
+def test_headers_and_values_are_normalised():
+    row = flight_row({' Flight_Number ': ' SB101 ', 'SOURCE': 'Delhi', 'Destination': 'Mumbai',
+                      'departure_date': '2030-05-01T08:30:00', 'price': 120})
+    values = dict(zip(FLIGHT_COLUMNS, row))
+    assert values['flight_number'] == 'SB101'
+    assert values['departure_date'] == date(2030, 5, 1)
+    assert values['price'] == Decimal('120')
+    assert values['departure_time'] is None
+    assert values['duration'] is None
+
+
+def test_missing_required_column_is_rejected():
+    assert flight_row(record(source='')) is None
+    assert flight_row(record(price=None)) is None
+    values = record()
+    del values['destination']
+    assert flight_row(values) is None
+
+
+def test_unparseable_values_are_rejected():
+    assert flight_row(record(departure_date='01/05/2030')) is None
+    assert flight_row(record(price='free')) is None
+
+
+def test_non_mapping_is_rejected():
+    assert flight_row(['SB101', 'Delhi']) is None
+    assert flight_row(None) is None
+
+
+def test_csv_extra_fields_are_ignored():
+    # csv.DictReader puts surplus fields under the key None
+    values = record()
+    values[None] = ['surplus']
+    assert flight_row(values) == flight_row(record())
@@ -0,0 +1,206 @@
+# Pre-rendered ticket documents.
+#
+# A ticket is rendered once, when the booking is paid for (or ahead of time
+# by `flask prerender-tickets` for flights leaving in the next day), and the
+# HTML is written to a content-addressed store on disk:
+#
+#   <TICKET_CACHE_DIR>/objects/ab/abcdef...   the document, named by its SHA-256
+#   <TICKET_CACHE_DIR>/index/<n>/<booking id> {"digest": ..., "username": ...}
+#
+# /ticket looks the booking up in the index and redirects to
+# /tickets/<booking id>/<digest>, which never changes content and so is
+# served with a strong ETag and a year-long cache lifetime. Cancelling or
+# refunding a booking drops its index entry; the next view renders it again.
+# Every process on the host shares the same directory.
+import hashlib
+import json
+import os
+import tempfile
+import time
+
+from flask import make_response, render_template, request
+
+CACHE_DIR = os.environ.get('TICKET_CACHE_DIR')
+MAX_AGE = 365 * 24 * 3600
+INDEX_FANOUT = 1000
+PRERENDER_BATCH = 500
+
+TICKET_QUERY = """
+    SELECT f.*, b.id AS booking_id, b.username, b.passenger_name, b.booking_date,
+           b.final_price, b.fare_class, b.seats
+    FROM bookings b
+    JOIN flights f ON b.flight_id = f.id
+"""
+
+
+class TicketStore:
+    def __init__(self, root=None):
+        self.root = root
+        self.rendered = 0
+        self.hits = 0
+
+    def configure(self, root=None):
+        if root is not None:
+            self.root = root
+
+    def stats(self):
+        return {'rendered': self.rendered, 'hits': self.hits}
+
+    def _object_path(self, digest):
+        return os.path.join(self.root, 'objects', digest[:2], digest)
+
+    def _index_path(self, booking_id):
+        return os.path.join(self.root, 'index', str(int(booking_id) % INDEX_FANOUT), str(int(booking_id)))
+
+    def _write(self, path, data):
+        # Write-then-rename, so readers in other processes never see half a file.
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        handle, temp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+        try:
+            with os.fdopen(handle, 'wb') as temp:
+                temp.write(data)
+            os.replace(temp_path, path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+
+    def lookup(self, booking_id):
+        # The index entry for a booking, or None if it hasn't been rendered.
+        try:
+            with open(self._index_path(booking_id), encoding='utf-8') as handle:
+                entry = json.load(handle)
+        except (FileNotFoundError, ValueError):
+            return None
+        if not os.path.exists(self._object_path(entry['digest'])):
+            return None
+        self.hits += 1
+        return entry
+
+    def read(self, digest):
+        try:
+            with open(self._object_path(digest), 'rb') as handle:
+                return handle.read()
+        except FileNotFoundError:
+            return None
+
+    def put(self, booking_id, username, body):
+        body = body.encode('utf-8') if isinstance(body, str) else body
+        digest = hashlib.sha256(body).hexdigest()
+        path = self._object_path(digest)
+        if not os.path.exists(path):
+            self._write(path, body)
+        entry = {'digest': digest, 'username': username}
+        self._write(self._index_path(booking_id), json.dumps(entry).encode('utf-8'))
+        self.rendered += 1
+        return entry
+
+    def invalidate(self, booking_id):
+        try:
+            os.unlink(self._index_path(booking_id))
+        except FileNotFoundError:
+            pass
+
+    def prune(self, older_than=MAX_AGE):
+        # Deletes documents no booking points at any more (after cancellations
+        # and refunds) once they are older than `older_than` seconds.
+        referenced = set()
+        index_root = os.path.join(self.root, 'index')
+        for directory, _, names in os.walk(index_root):
+            for name in names:
+                if name.startswith('.tmp-'):
+                    continue
+                try:
+                    with open(os.path.join(directory, name), encoding='utf-8') as handle:
+                        referenced.add(json.load(handle)['digest'])
+                except (FileNotFoundError, ValueError):
+                    continue
+        cutoff = time.time() - older_than
+        removed = 0
+        for directory, _, names in os.walk(os.path.join(self.root, 'objects')):
+            for name in names:
+                path = os.path.join(directory, name)
+                if name in referenced:
+                    continue
+                try:
+                    if os.path.getmtime(path) < cutoff:
+                        os.unlink(path)
+                        removed += 1
+                except FileNotFoundError:
+                    continue
+        return removed
+
+
+def render(row):
+    # The ticket page for one row of TICKET_QUERY.
+    flight = dict(row, price=row['final_price'] if row['final_price'] is not None else row['price'])
+    return render_template(
+        'ticket.html',
+        flight=flight,
+        passenger_name=row['passenger_name'],
+        departure_date=row['departure_date'],
+        passengers=row['seats'],
+        class_type=row['fare_class'],
+        booking_date=row['booking_date'],
+    )
+
+
+def ensure_ticket(cursor, booking_id, username):
+    # The user's ticket for a booking, rendered and stored if it isn't yet.
+    # None if the booking doesn't exist or belongs to someone else.
+    entry = ticket_store.lookup(booking_id)
+    if entry is not None:
+        return entry if entry['username'] == username else None
+    cursor.execute(TICKET_QUERY + " WHERE b.id = %s AND b.username = %s", (booking_id, username))
+    row = cursor.fetchone()
+    if row is None:
+        return None
+    return ticket_store.put(booking_id, username, render(row))
+
+
+def respond(digest, body):
+    response = make_response(body)
+    response.set_etag(digest)
+    # The URL includes the digest, so its content can never change.
+    response.headers['Cache-Control'] = f'private, max-age={MAX_AGE}, immutable'
+    response.make_conditional(request)
+    return response
+
+
+def prerender_departing(connection, hours=24, batch_size=PRERENDER_BATCH, progress=None):
+    # Renders tickets for live bookings on flights leaving in the next `hours`.
+    cursor = connection.cursor(dictionary=True)
+    try:
+        cursor.execute("""
+            SELECT id FROM flights
+            WHERE departure_date BETWEEN CURDATE() AND DATE(NOW() + INTERVAL %s HOUR)
+              AND TIMESTAMP(departure_date, COALESCE(departure_time, '00:00:00'))
+                  BETWEEN NOW() AND NOW() + INTERVAL %s HOUR
+        """, (hours, hours))
+        flight_ids = [row['id'] for row in cursor.fetchall()]
+        rendered = 0
+        for start in range(0, len(flight_ids), batch_size):
+            chunk = flight_ids[start:start + batch_size]
+            cursor.execute(
+                TICKET_QUERY + f" WHERE b.flight_id IN ({', '.join(['%s'] * len(chunk))}) AND b.status <> 'cancelled'",
+                chunk
+            )
+            for row in cursor.fetchall():
+                if ticket_store.lookup(row['booking_id']) is None:
+                    ticket_store.put(row['booking_id'], row['username'], render(row))
+                    rendered += 1
+            if progress:
+                progress(min(start + batch_size, len(flight_ids)), len(flight_ids), rendered)
+        return rendered
+    finally:
+        cursor.close()
+
+
+def init_app(app):
+    ticket_store.configure(
+        root=app.config.get('TICKET_CACHE_DIR', CACHE_DIR or os.path.join(app.instance_path, 'tickets')),
+    )
+
+
+# Shared by every request in this process; the files are shared across processes.
+ticket_store = TicketStore(CACHE_DIR)